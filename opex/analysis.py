@@ -2,10 +2,23 @@
 
 from __future__ import annotations  # PEP 563
 
-from typing import NamedTuple, Optional
+from typing import Callable, Dict, List, NamedTuple, Optional
 
 # TODO Create a Position type where id is required and replace Position with some sort of prototype
 
+# The score of a position in which the side to move has been mated
+MATE_SCORE = 10000
+
+# Values of Position.terminal
+NOT_TERMINAL = 0
+CHECKMATE = 1
+STALEMATE = 2
+INSUFFICIENT_MATERIAL = 3
+
+# Stages of an expansion in the frontier, a shallow analysis of a new position or a deep analysis of a screened one
+STAGE_EXPAND = 'expand'
+STAGE_DEEPEN = 'deepen'
+
 
 class Position(NamedTuple):
     """Information nececessary to store the analysis of a position."""
@@ -14,12 +27,87 @@ class Position(NamedTuple):
     score: float
     depth: int
     pv: str
+    visits: int = 0
+    legal_move_count: int = 0
+    expanded_count: int = 0
+    terminal: int = NOT_TERMINAL
 
     def with_position_id(self, position_id: int) -> Position:
-        return Position(position_id, self.fen, self.score, self.depth, self.pv)
+        return Position(
+            position_id, self.fen, self.score, self.depth, self.pv, self.visits, self.legal_move_count,
+            self.expanded_count, self.terminal)
+
+    def with_status(self, legal_move_count: int, terminal: int) -> Position:
+        """Adds the bookkeeping which is written once when the position is created."""
+        return Position(
+            self.position_id, self.fen, self.score, self.depth, self.pv, self.visits, legal_move_count,
+            self.expanded_count, terminal)
+
+    def is_fully_expanded(self) -> bool:
+        """Whether every legal move from this position leads to a stored position."""
+        return self.expanded_count >= self.legal_move_count
 
 
 class ParentRelationship(NamedTuple):
     """A pair of parent id and the move which resulted in the child."""
     parent_id: int
     move: str
+
+
+class FrontierEntry(NamedTuple):
+    """A move from a stored parent position whose resulting position has not been inserted or analyzed deeply yet."""
+    parent_id: int
+    move: str
+    parent_fen: str
+    stage: str = STAGE_EXPAND
+
+
+class EngineAnalysis(NamedTuple):
+    """The analysis of a position by a single engine."""
+    nickname: str
+    score: float
+    depth: int
+    pv: str
+
+
+## Methods for reconciling the analysis of multiple engines
+
+
+def _deepest(analyses: List[EngineAnalysis]) -> EngineAnalysis:
+    """Selects the deepest analysis, preferring the first engine on ties."""
+    return max(analyses, key=lambda analysis: analysis.depth)
+
+
+def _reconcile_deepest(fen: str, analyses: List[EngineAnalysis]) -> Position:
+    """Uses the analysis of the engine which searched the deepest."""
+    deepest = _deepest(analyses)
+    return Position(None, fen, deepest.score, deepest.depth, deepest.pv)
+
+
+def _reconcile_mean(fen: str, analyses: List[EngineAnalysis]) -> Position:
+    """Uses the mean score of all engines with the pv of the deepest."""
+    deepest = _deepest(analyses)
+    score = sum(analysis.score for analysis in analyses) / len(analyses)
+    return Position(None, fen, score, deepest.depth, deepest.pv)
+
+
+def _reconcile_pessimistic(fen: str, analyses: List[EngineAnalysis]) -> Position:
+    """Uses the analysis with the lowest score for the side to move."""
+    worst = min(analyses, key=lambda analysis: analysis.score)
+    return Position(None, fen, worst.score, worst.depth, worst.pv)
+
+
+RECONCILIATION_POLICIES: Dict[str, Callable[[str, List[EngineAnalysis]], Position]] = {
+    'deepest': _reconcile_deepest,
+    'mean': _reconcile_mean,
+    'pessimistic': _reconcile_pessimistic,
+}
+
+
+def reconcile_analyses(fen: str, analyses: List[EngineAnalysis], policy: str) -> Position:
+    """Combines the analysis of one or more engines into a single authoritative position."""
+    if not analyses:
+        raise ValueError(f'No analysis to reconcile for \'{fen}\'')
+    if policy not in RECONCILIATION_POLICIES:
+        raise ValueError(f'Unknown reconciliation policy \'{policy}\'')
+    return RECONCILIATION_POLICIES[policy](fen, analyses)
@@ -0,0 +1,201 @@
+"""Annotation of games with the analyzed tree: where each game left the book and what each book move cost.
+
+Games are split from pgn files as text and parsed and annotated in a pool of processes, in batches. Each process opens
+its own read only connection to the database and looks up every position of a batch at once. Annotated games are
+written in the order in which they were read.
+"""
+
+import collections
+from concurrent import futures
+import csv
+import io
+import os
+
+from chess import pgn
+
+from opex import db_wrapper
+from opex.analysis import Position
+
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO
+
+OUTPUT_FORMATS = ['csv', 'pgn']
+CSV_COLUMNS = ['game', 'white', 'black', 'result', 'book_plies', 'exit_move', 'max_drop', 'drops']
+
+# The number of games in each task handed to a process
+DEFAULT_BATCH_SIZE = 200
+# Batches in flight for each process, so that processes do not wait for work while results are written in order
+_BATCHES_IN_FLIGHT_PER_PROCESS = 4
+
+
+class GameAnnotation(NamedTuple):
+    """How a game follows the book."""
+    # The number of moves, counted for both sides, which lead to analyzed positions
+    book_plies: int
+    # The first move which leaves the book in standard algebraic notation, or None if the game never left it
+    exit_move: Optional[str]
+    # The centipawns lost by each book move compared to the score of the position before it
+    drops: List[float]
+
+
+def split_games(lines: Iterable[str]) -> Iterator[str]:
+    """Splits the lines of a pgn file into the text of each game without parsing the moves.
+
+    A game starts at the first header line after the moves of the previous game.
+    """
+    game: List[str] = []
+    in_moves = False
+    for line in lines:
+        if line.startswith('[') and in_moves:
+            yield ''.join(game)
+            game = []
+            in_moves = False
+        elif line.strip() and not line.startswith('['):
+            in_moves = True
+        game.append(line)
+    if any(line.strip() for line in game):
+        yield ''.join(game)
+
+
+def move_drop(parent: Position, child: Position) -> float:
+    """The centipawns lost by a move from the point of view of the player who made it.
+
+    Scores are relative to the side to move, so the score of the child is negated. Analysis of the child is not always
+    as deep as the analysis of its parent, so a move may look better than the best move, which counts as no loss.
+    """
+    return max(0.0, parent.score + child.score)
+
+
+def annotate_game(game: pgn.Game, positions: Dict[str, Position]) -> GameAnnotation:
+    """Follows the main line of a game through the positions of the book, keyed by fen."""
+    board = game.board()
+    parent = positions.get(board.fen())
+    book_plies = 0
+    drops: List[float] = []
+    for move in game.mainline_moves():
+        san = board.san(move)
+        board.push(move)
+        child = positions.get(board.fen())
+        if parent is None or child is None:
+            return GameAnnotation(book_plies, san, drops)
+        book_plies += 1
+        drops.append(move_drop(parent, child))
+        parent = child
+    return GameAnnotation(book_plies, None, drops)
+
+
+def game_fens(game: pgn.Game) -> Iterator[str]:
+    """The fens of the positions of the main line of a game, starting before the first move."""
+    board = game.board()
+    yield board.fen()
+    for move in game.mainline_moves():
+        board.push(move)
+        yield board.fen()
+
+
+def add_comments(game: pgn.Game, game_annotation: GameAnnotation) -> None:
+    """Comments the book moves of a game with their drop and the move which left the book."""
+    nodes = list(game.mainline())
+    for node, drop in zip(nodes, game_annotation.drops):
+        node.comment = f'book, drop {drop:g}'
+    if game_annotation.exit_move is not None:
+        nodes[game_annotation.book_plies].comment = 'left book'
+
+
+def format_csv_row(game_number: int, game: pgn.Game, game_annotation: GameAnnotation) -> str:
+    """Formats the annotation of a game as a line of csv."""
+    row = io.StringIO()
+    csv.writer(
+        row, lineterminator='\n').writerow(
+            [
+                game_number,
+                game.headers.get('White', ''),
+                game.headers.get('Black', ''),
+                game.headers.get('Result', ''),
+                game_annotation.book_plies,
+                game_annotation.exit_move or '',
+                f'{max(game_annotation.drops, default=0.0):g}',
+                ' '.join(f'{drop:g}' for drop in game_annotation.drops),
+            ])
+    return row.getvalue()
+
+
+def annotate_batch(database: db_wrapper.Database, first_game_number: int, texts: List[str], output_format: str) -> str:
+    """Annotates a batch of games with a single lookup of all of their positions and formats the output."""
+    games = {
+        game_number: game
+        for game_number, game in enumerate((pgn.read_game(io.StringIO(text)) for text in texts), first_game_number)
+        if game is not None
+    }
+    positions = database.get_positions(fen for game in games.values() for fen in game_fens(game))
+    output: List[str] = []
+    for game_number, game in games.items():
+        game_annotation = annotate_game(game, positions)
+        if output_format == 'csv':
+            output.append(format_csv_row(game_number, game, game_annotation))
+        else:
+            add_comments(game, game_annotation)
+            output.append(f'{game}\n\n')
+    return ''.join(output)
+
+
+# The read only database of a process in the pool
+_process_databases: Dict[str, db_wrapper.Database] = {}
+
+
+def _open_process_database(database_path: str) -> None:
+    _process_databases['database'] = db_wrapper.Database(database_path, read_only=True)
+
+
+def _annotate_batch_in_process(first_game_number: int, texts: List[str], output_format: str) -> str:
+    return annotate_batch(_process_databases['database'], first_game_number, texts, output_format)
+
+
+def batches(texts: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    """Groups the text of games into batches."""
+    batch: List[str] = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_games(pgn_paths: Iterable[str]) -> Iterator[str]:
+    """Streams the text of each game in a sequence of pgn files."""
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding='utf-8-sig', errors='replace') as pgn_file:
+            yield from split_games(pgn_file)
+
+
+def annotate_files(
+        database_path: str,
+        pgn_paths: Iterable[str],
+        output: TextIO,
+        output_format: str = 'csv',
+        processes: Optional[int] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Annotates the games of pgn files against a database with a pool of processes and returns the number of games.
+
+    Only a bounded number of batches is read ahead of the output, so files of any size are streamed.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format \'{output_format}\'')
+    # Fail before starting the pool if the database does not exist
+    db_wrapper.Database(database_path, read_only=True).close()
+    processes = processes or os.cpu_count() or 1
+    if output_format == 'csv':
+        csv.writer(output, lineterminator='\n').writerow(CSV_COLUMNS)
+    game_count = 0
+    with futures.ProcessPoolExecutor(processes, initializer=_open_process_database,
+                                     initargs=(database_path,)) as executor:
+        in_flight: Deque[futures.Future[str]] = collections.deque()
+        for batch in batches(read_games(pgn_paths), batch_size):
+            if len(in_flight) >= processes * _BATCHES_IN_FLIGHT_PER_PROCESS:
+                output.write(in_flight.popleft().result())
+            in_flight.append(executor.submit(_annotate_batch_in_process, game_count + 1, batch, output_format))
+            game_count += len(batch)
+        while in_flight:
+            output.write(in_flight.popleft().result())
+    return game_count
@@ -0,0 +1,188 @@
+"""Benchmarks of engine configurations, to find how many engines, threads and hash analyze the most positions per hour.
+
+Every engine of a configuration analyzes the same fixed sample of positions at the same time, each with its own hash,
+so the throughput of a configuration is the number of analyses which all of its engines finish in an hour.
+"""
+
+from concurrent import futures
+import contextlib
+import os
+import re
+import time
+
+import chess
+from chess import engine
+
+from opex import engines
+from opex import settings_loader
+from opex.settings_loader import Json
+
+import typing
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+# Positions from common openings, which are analyzed by every configuration
+SAMPLE_LINES = [
+    'e2e4 e7e5 g1f3 b8c6 f1b5',
+    'd2d4 d7d5 c2c4 e7e6 b1c3 g8f6',
+    'e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6',
+    'd2d4 g8f6 c2c4 g7g6 b1c3 f8g7 e2e4 d7d6',
+    'c2c4 e7e5 b1c3 g8f6 g2g3',
+    'e2e4 e7e6 d2d4 d7d5 b1c3 f8b4',
+    'e2e4 c7c6 d2d4 d7d5 e4e5 c8f5',
+    'g1f3 d7d5 g2g3 g8f6 f1g2 c7c6 e1g1',
+]
+
+# The hash sizes in MB of each engine which are tried by default
+DEFAULT_HASH_SIZES = [64, 256, 1024]
+
+# The fraction of physical memory which the hash of all copies may use between them by default
+DEFAULT_HASH_MEMORY_FRACTION = 0.5
+
+
+class EngineConfiguration(NamedTuple):
+    """A number of copies of an engine which analyze positions at once, and the threads and hash of each copy."""
+    engine_count: int
+    threads: int
+    hash_size: int
+
+
+class BenchmarkResult(NamedTuple):
+    """How quickly the engines of a configuration analyzed the sample."""
+    configuration: EngineConfiguration
+    # The mean number of seconds for an engine to analyze a position to the depth
+    time_to_depth: float
+    positions_per_hour: float
+
+
+def sample_boards(count: Optional[int] = None) -> List[chess.Board]:
+    """The boards at the end of the first count sample lines."""
+    boards: List[chess.Board] = []
+    for line in SAMPLE_LINES[:count]:
+        board = chess.Board()
+        for move in line.split():
+            board.push_uci(move)
+        boards.append(board)
+    return boards
+
+
+def default_max_total_hash() -> int:
+    """MB of hash which all copies may use between them by default, raising a ValueError if memory is unknown."""
+    try:
+        physical_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError) as error:
+        raise ValueError('The physical memory of this machine is unknown, use --max-total-hash') from error
+    return int(physical_memory * DEFAULT_HASH_MEMORY_FRACTION) // 2**20
+
+
+def candidate_configurations(cores: int, hash_sizes: Iterable[int], max_total_hash: int) -> List[EngineConfiguration]:
+    """Configurations which use every core, with a power of two threads for each engine.
+
+    Configurations whose engines would use more than max_total_hash MB of hash between them are left out.
+    """
+    configurations: List[EngineConfiguration] = []
+    threads = 1
+    while threads <= cores:
+        engine_count = cores // threads
+        for hash_size in hash_sizes:
+            if engine_count * hash_size <= max_total_hash:
+                configurations.append(EngineConfiguration(engine_count, threads, hash_size))
+        threads *= 2
+    return configurations
+
+
+def configured_options(
+        default_options: List[engine.Option], options: engine.ConfigMapping,
+        configuration: EngineConfiguration) -> engine.ConfigMapping:
+    """The options of an engine with the threads and hash of a configuration, raising a ValueError if out of range."""
+    configured = dict(options)
+    configured['Threads'] = configuration.threads
+    configured['Hash'] = configuration.hash_size
+    settings_loader.check_engine_options(default_options, configured)
+    return configured
+
+
+def benchmark(
+        open_engine: Callable[[engine.ConfigMapping], engine.SimpleEngine],
+        options: engine.ConfigMapping,
+        engine_count: int,
+        boards: List[chess.Board],
+        depth: int,
+        early_stop: Optional[engines.EarlyStop] = None) -> BenchmarkResult:
+    """Analyzes every board with each of engine_count engines opened with the options, all engines at once.
+
+    The time to open the engines is not measured.
+    """
+
+    def analyze_all(uci_engine: engine.SimpleEngine) -> List[float]:
+        times: List[float] = []
+        for board in boards:
+            start = time.perf_counter()
+            engines.analyze_board(uci_engine, 'autotune', board, depth, early_stop)
+            times.append(time.perf_counter() - start)
+        return times
+
+    with contextlib.ExitStack() as stack:
+        uci_engines = [stack.enter_context(open_engine(options)) for _ in range(engine_count)]
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=engine_count) as executor:
+            times = [
+                analysis_time for engine_times in executor.map(analyze_all, uci_engines)
+                for analysis_time in engine_times
+            ]
+        elapsed = time.perf_counter() - start
+    configuration = EngineConfiguration(
+        engine_count, typing.cast(int, options['Threads']), typing.cast(int, options['Hash']))
+    return BenchmarkResult(configuration, sum(times) / len(times), len(times) / elapsed * 3600)
+
+
+def autotune(
+        open_engine: Callable[[engine.ConfigMapping], engine.SimpleEngine],
+        default_options: List[engine.Option],
+        options: engine.ConfigMapping,
+        configurations: Iterable[EngineConfiguration],
+        boards: List[chess.Board],
+        depth: int,
+        early_stop: Optional[engines.EarlyStop] = None) -> List[BenchmarkResult]:
+    """Benchmarks each configuration whose threads and hash are in the range of the engine, best first."""
+    results: List[BenchmarkResult] = []
+    for configuration in configurations:
+        try:
+            configuration_options = configured_options(default_options, options, configuration)
+        except ValueError as error:
+            print(f'Skipping {configuration}: {error}')
+            continue
+        results.append(
+            benchmark(open_engine, configuration_options, configuration.engine_count, boards, depth, early_stop))
+    return sorted(results, key=lambda result: -result.positions_per_hour)
+
+
+def format_results(results: List[BenchmarkResult]) -> List[str]:
+    """Formats benchmark results as a table."""
+    output = ['Engines  Threads  Hash (MB)  Time to depth (s)  Positions per hour']
+    for configuration, time_to_depth, positions_per_hour in results:
+        output.append(
+            f'{configuration.engine_count:>7}  {configuration.threads:>7}  {configuration.hash_size:>9}  '
+            f'{time_to_depth:>17.2f}  {positions_per_hour:>18.0f}')
+    return output
+
+
+def copy_nickname(nickname: str, copy_number: int) -> str:
+    """The nickname of a copy of an engine, the first copy is the engine itself."""
+    return nickname if copy_number == 1 else f'{nickname}-{copy_number}'
+
+
+def tuned_engine_settings(engine_settings: List[Json], nickname: str, engine_count: int) -> List[Json]:
+    """The engine settings with engine_count copies of an engine in place of the engine and its previous copies."""
+    copy_pattern = re.compile(re.escape(nickname) + r'-\d+')
+    original = next(engine_setting for engine_setting in engine_settings if engine_setting['nickname'] == nickname)
+    tuned: List[Json] = []
+    for engine_setting in engine_settings:
+        if engine_setting is original:
+            tuned.extend(
+                dict(original, nickname=copy_nickname(nickname, copy_number))
+                for copy_number in range(1, engine_count + 1))
+        elif not copy_pattern.fullmatch(typing.cast(str, engine_setting['nickname'])):
+            tuned.append(engine_setting)
+        elif engine_setting['path'] != original['path']:
+            tuned.append(engine_setting)
+    return tuned
@@ -2,13 +2,89 @@
 
 from __future__ import annotations  # PEP 563
 
+import contextlib
 import os
 import sqlite3
-import sys
+import time
+import urllib.request
 
+from opex.analysis import EngineAnalysis
+from opex.analysis import FrontierEntry
+from opex.analysis import ParentRelationship
 from opex.analysis import Position
+from opex.analysis import STAGE_EXPAND
 
-from typing import Any, Dict, Optional, Tuple
+import typing
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+FRONTIER_PENDING = 'pending'
+FRONTIER_IN_FLIGHT = 'in_flight'
+# Expansions whose analysis failed MAX_EXPANSION_ATTEMPTS times, which are kept but never claimed again
+FRONTIER_FAILED = 'failed'
+
+# The number of times the analysis of an expansion may fail before it is given up
+MAX_EXPANSION_ATTEMPTS = 3
+
+# The priority which an expansion loses each time its analysis fails, so that other expansions are tried first
+FAILED_EXPANSION_PRIORITY_PENALTY = 100
+
+# Expect to find db.schema in same directory as this module
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.schema')
+
+# The version of db.schema which a database has been migrated to, kept in its user_version
+SCHEMA_VERSION = 2
+
+# Columns which were added to the tables of db.schema after databases started being kept between runs, in the order
+# they were added, which a database created before them is migrated to have
+_ADDED_COLUMNS = [
+    ('openings', 'visits DEFAULT 0'),
+    ('openings', 'legal_move_count DEFAULT 0'),
+    ('openings', 'expanded_count DEFAULT 0'),
+    ('openings', 'fully_expanded DEFAULT 1'),
+    ('openings', 'terminal DEFAULT 0'),
+    ('openings', 'tree_score'),
+    ('frontier', 'priority DEFAULT 0'),
+    ('frontier', 'stage DEFAULT \'expand\''),
+    ('frontier', 'attempts DEFAULT 0'),
+]
+
+# The number of keys in each statement of a bulk lookup, well below the limit on sqlite variables
+BULK_LOOKUP_CHUNK_SIZE = 500
+
+# The value of the auto_vacuum pragma when free pages are reclaimed with incremental_vacuum
+_AUTO_VACUUM_INCREMENTAL = 2
+
+# The number of rows of a source database merged in each transaction
+MERGE_BATCH_SIZE = 100000
+
+# The columns of a position in the order of the fields of Position
+POSITION_COLUMNS = (
+    'openings.id, openings.fen, openings.score, openings.depth, openings.pv, openings.visits, '
+    'openings.legal_move_count, openings.expanded_count, openings.terminal')
+
+_CHILD_POSITIONS_QUERY = (
+    f'SELECT {POSITION_COLUMNS}, game_dag.parent_id, game_dag.move '
+    'FROM game_dag '
+    'JOIN openings '
+    'ON game_dag.child_id = openings.id ')
+
+
+class PruneResult(NamedTuple):
+    """The number of moves which were judged hopeless and the number of positions which were deleted."""
+    edge_count: int
+    position_count: int
+
+
+class MergeResult(NamedTuple):
+    """The number of positions and edges which a merge added."""
+    position_count: int
+    edge_count: int
+
+
+def _position_from_row(row: Dict[str, Any]) -> Position:
+    return Position(
+        row['id'], row['fen'], row['score'], row['depth'], row['pv'], row['visits'], row['legal_move_count'],
+        row['expanded_count'], row['terminal'])
 
 
 def _get_position_or_none(cursor: sqlite3.Cursor) -> Optional[Position]:
@@ -17,22 +93,64 @@ def _get_position_or_none(cursor: sqlite3.Cursor) -> Optional[Position]:
     if row is None:
         return None
     assert cursor.fetchone() is None
-    return Position(row['id'], row['fen'], row['score'], row['depth'], row['pv'])
+    return _position_from_row(row)
+
+
+def chunks(keys: Iterable[Any]) -> Iterator[List[Any]]:
+    """Splits keys into lists small enough to bind to a single statement, without duplicates."""
+    chunk: List[Any] = []
+    for key in dict.fromkeys(keys):
+        chunk.append(key)
+        if len(chunk) == BULK_LOOKUP_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def placeholders(chunk: List[Any]) -> str:
+    return ', '.join('?' * len(chunk))
+
+
+def schema_statements() -> Tuple[List[str], List[str]]:
+    """The statements of the schema which create tables and those which create indexes."""
+    with open(SCHEMA_PATH) as schema:
+        statements = [statement.strip() for statement in schema.read().split(';') if statement.strip()]
+    indexes = [statement for statement in statements if statement.split('(')[0].split()[1] in ('INDEX', 'UNIQUE')]
+    return [statement for statement in statements if statement not in indexes], indexes
 
 
 class Database:
-    """A wrapper around database input and output."""
+    """A wrapper around database input and output.
+
+    Writes are grouped into transactions of `checkpoint_interval` writes. A crash loses at most the writes since the
+    last checkpoint, everything before it is on disk. A read only database must already exist and cannot be written.
+    """
 
     def _initialize_db(self) -> None:
-        """Initialize the database."""
-        cursor = self._db.cursor()
-        # Expect to find db.schema in same directory as this module
-        this_module_dir = os.path.dirname(sys.modules[__name__].__file__)
-        schema_path = os.path.join(this_module_dir, 'db.schema')
-        with open(schema_path) as schema:
-            cursor.executescript(schema.read())
+        """Initialize the database, migrating a database created with an earlier schema before creating the indexes."""
+        create_tables, create_indexes = schema_statements()
+        for statement in create_tables:
+            self._db.execute(statement)
+        if self._db.execute('PRAGMA user_version').fetchone()['user_version'] < SCHEMA_VERSION:
+            self._migrate()
+        for statement in create_indexes:
+            self._db.execute(statement)
+
+    def _migrate(self) -> None:
+        """Add the columns which the tables of a database created with an earlier schema lack."""
+        self._db.execute('BEGIN')
+        for table, column in _ADDED_COLUMNS:
+            columns = {row['name'] for row in self._db.execute(f'PRAGMA table_info({table})')}
+            if column.split()[0] not in columns:
+                self._db.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+        # A move could be linked twice before game_dag_parent_id_move was added
+        self._db.execute(
+            'DELETE FROM game_dag WHERE rowid NOT IN (SELECT min(rowid) FROM game_dag GROUP BY parent_id, move)')
+        self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self._db.execute('COMMIT')
 
-    def __init__(self, path: Optional[str] = None) -> None:
+    def __init__(self, path: Optional[str] = None, checkpoint_interval: int = 1, read_only: bool = False) -> None:
         if path is None:
             path = ':memory:'
 
@@ -42,11 +160,28 @@ class Database:
                 named_columns[col[0]] = row[idx]
             return named_columns
 
-        self._db = sqlite3.connect(path)
+        self._checkpoint_interval = checkpoint_interval
+        self._uncommitted_writes = 0
+        if read_only:
+            # Many processes can read an existing database at once, and none of them can change it
+            self._db = sqlite3.connect(
+                f'file:{urllib.request.pathname2url(os.path.abspath(path))}?mode=ro', uri=True, isolation_level=None)
+            self._db.row_factory = _dict_factory
+            return
+
+        # Transactions are managed explicitly, see _write and checkpoint
+        self._db = sqlite3.connect(path, isolation_level=None)
         self._db.row_factory = _dict_factory
+        if path != ':memory:':
+            # Only takes effect on a new database, compact converts older ones
+            if not self._db.execute('PRAGMA page_count').fetchone()['page_count']:
+                self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
         self._initialize_db()
 
     def close(self) -> None:
+        self.checkpoint()
         self._db.close()
 
     def __enter__(self) -> Database:
@@ -55,18 +190,113 @@ class Database:
     def __exit__(self, exc_type: Any, exc_value: Any, exc_traceback: Any) -> None:
         self.close()
 
-    def insert_position(self, position: Position, parent_child_relation: Optional[Tuple[int, str]]) -> Position:
-        """Insert a position into the database."""
-        self._db.execute('BEGIN')
-        child_id = self._db.execute(
-            'INSERT INTO openings VALUES (?, ?, ?, ?, ?)',
-            (None, position.fen, position.score, position.depth, position.pv)).lastrowid
-        if parent_child_relation is not None:
-            (parent_id, move) = parent_child_relation
-            self._db.execute('INSERT INTO game_dag VALUES (?, ?, ?)', (parent_id, child_id, move))
-        self._db.execute('END')
+    @contextlib.contextmanager
+    def _write(self) -> Iterator[None]:
+        """Executes a group of statements atomically as part of the current checkpoint."""
+        if not self._db.in_transaction:
+            self._db.execute('BEGIN')
+        self._db.execute('SAVEPOINT write')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK TO write')
+            raise
+        finally:
+            self._db.execute('RELEASE write')
+        self._uncommitted_writes += 1
+        if self._uncommitted_writes >= self._checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Commit all writes since the last checkpoint."""
+        if self._db.in_transaction:
+            self._db.execute('COMMIT')
+        self._uncommitted_writes = 0
+
+    def _remove_from_frontier(self, parent_id: int, move: str) -> None:
+        self._db.execute('DELETE FROM frontier WHERE parent_id = ? AND move = ?', (parent_id, move))
+
+    def _lower_pending_priority(self, parent_id: int, priority_penalty: float) -> None:
+        self._db.execute(
+            'UPDATE frontier SET priority = priority - ? WHERE parent_id = ? AND status = ?',
+            (priority_penalty, parent_id, FRONTIER_PENDING))
+
+    def _increment_expanded_count(self, parent_id: int) -> None:
+        """Count one more move of a position as expanded."""
+        self._db.execute(
+            'UPDATE openings '
+            'SET expanded_count = expanded_count + 1, fully_expanded = expanded_count + 1 >= legal_move_count '
+            'WHERE id = ?', (parent_id,))
+
+    def _add_edge(self, parent_id: int, child_id: int, move: str) -> None:
+        """Link a child to its parent, updating the parent's bookkeeping and completing the frontier entry."""
+        self._db.execute('INSERT INTO game_dag VALUES (?, ?, ?)', (parent_id, child_id, move))
+        self._increment_expanded_count(parent_id)
+        self._remove_from_frontier(parent_id, move)
+
+    def insert_position(
+        self,
+        position: Position,
+        parent_child_relation: Optional[Tuple[int, str]],
+        engine_analyses: Iterable[EngineAnalysis] = ()) -> Position:
+        """Insert a position and the per-engine analysis it was reconciled from into the database.
+
+        Inserting a child also completes the matching expansion in the frontier. A position which already has an id is
+        stored with that id, otherwise the next id is assigned.
+        """
+        return self._insert_position(position, parent_child_relation, list(engine_analyses))
+
+    def _insert_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[EngineAnalysis]) -> Position:
+        """Inserts a position, the edge from its parent and its engine analysis, which other backends override."""
+        with self._write():
+            child_id = self._db.execute(
+                'INSERT INTO openings (id, fen, score, depth, pv, legal_move_count, fully_expanded, terminal) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                    position.position_id, position.fen, position.score, position.depth, position.pv,
+                    position.legal_move_count, position.is_fully_expanded(), position.terminal)).lastrowid
+            if parent_child_relation is not None:
+                (parent_id, move) = parent_child_relation
+                self._add_edge(parent_id, child_id, move)
+            self._db.executemany(
+                'INSERT INTO engine_analysis VALUES (?, ?, ?, ?, ?)', [
+                    (child_id, analysis.nickname, analysis.score, analysis.depth, analysis.pv)
+                    for analysis in engine_analyses
+                ])
         return position.with_position_id(child_id)
 
+    def deepen_position(
+        self,
+        position: Position,
+        parent_child_relation: Optional[Tuple[int, str]],
+        engine_analyses: Iterable[EngineAnalysis] = ()) -> Position:
+        """Replace the analysis of a stored position with deeper analysis and complete its frontier entry."""
+        return self._deepen_position(position, parent_child_relation, list(engine_analyses))
+
+    def _deepen_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[EngineAnalysis]) -> Position:
+        """Replaces the analysis of a position and adds its engine analysis, which other backends override."""
+        with self._write():
+            self._db.execute(
+                'UPDATE openings SET score = ?, depth = ?, pv = ? WHERE id = ?',
+                (position.score, position.depth, position.pv, position.position_id))
+            if parent_child_relation is not None:
+                self._remove_from_frontier(*parent_child_relation)
+            self._db.executemany(
+                'INSERT INTO engine_analysis VALUES (?, ?, ?, ?, ?)', [
+                    (position.position_id, analysis.nickname, analysis.score, analysis.depth, analysis.pv)
+                    for analysis in engine_analyses
+                ])
+        return position
+
+    def insert_transposition(self, parent_child_relation: Tuple[int, str], child_id: int) -> None:
+        """Link an existing position as the child of another position."""
+        with self._write():
+            (parent_id, move) = parent_child_relation
+            self._add_edge(parent_id, child_id, move)
+
     def get_position(self, fen: str) -> Optional[Position]:
         """Retrieve a position from the database."""
         cursor = self._db.execute('SELECT * FROM openings WHERE fen = ?', (fen,))
@@ -74,28 +304,406 @@ class Database:
 
     def get_child_positions(self, parent_id: int) -> Dict[str, Position]:
         """Retrieve a list of child positions from the database."""
-        cursor = self._db.execute(
-            'SELECT '
-            '  openings.id, '
-            '  openings.fen, '
-            '  openings.score, '
-            '  openings.depth, '
-            '  openings.pv, '
-            '  game_dag.move '
-            'FROM game_dag '
-            'JOIN openings '
-            'ON game_dag.child_id = openings.id '
-            'WHERE game_dag.parent_id = ? ', (parent_id,))
+        cursor = self._db.execute(_CHILD_POSITIONS_QUERY + 'WHERE game_dag.parent_id = ? ', (parent_id,))
 
         positions: Dict[str, Position] = {}
         for row in cursor:
-            positions[row['move']] = Position(row['id'], row['fen'], row['score'], row['depth'], row['pv'])
+            positions[row['move']] = _position_from_row(row)
 
         return positions
 
+    ## Methods for reading many positions with few queries
+
+    def _tuple_cursor(self) -> sqlite3.Cursor:
+        """A cursor which returns rows as tuples, which are much cheaper to create than dictionaries."""
+        cursor = self._db.cursor()
+        cursor.row_factory = None
+        return cursor
+
+    def get_positions(self, fens: Iterable[str]) -> Dict[str, Position]:
+        """Retrieve the positions with the given fens, keyed by fen. Fens which are not stored are left out."""
+        positions: Dict[str, Position] = {}
+        cursor = self._tuple_cursor()
+        for chunk in chunks(fens):
+            cursor.execute(f'SELECT {POSITION_COLUMNS} FROM openings WHERE fen IN ({placeholders(chunk)})', chunk)
+            for row in cursor:
+                positions[row[1]] = Position(*row)
+        return positions
+
+    def get_children_many(self, parent_ids: Iterable[int]) -> Dict[int, Dict[str, Position]]:
+        """Retrieve the child positions of each parent keyed by parent id and then by move."""
+        children: Dict[int, Dict[str, Position]] = {}
+        cursor = self._tuple_cursor()
+        for chunk in chunks(parent_ids):
+            for parent_id in chunk:
+                children[parent_id] = {}
+            cursor.execute(_CHILD_POSITIONS_QUERY + f'WHERE game_dag.parent_id IN ({placeholders(chunk)})', chunk)
+            for row in cursor:
+                # The position is followed by the parent id and the move
+                children[row[9]][row[10]] = Position(*row[:9])
+        return children
+
+    def get_subtree_levels(self, root_id: int, max_depth: Optional[int] = None) -> Iterator[Dict[int, Position]]:
+        """Stream the positions below a root one level at a time, keyed by position id.
+
+        Each level holds the positions first reached at that distance from the root, so a transposition is only
+        returned once. The root itself is not returned.
+        """
+        seen = {root_id}
+        level = [root_id]
+        depth = 0
+        while level and (max_depth is None or depth < max_depth):
+            next_level: Dict[int, Position] = {}
+            for children in self.get_children_many(level).values():
+                for child in children.values():
+                    child_id = typing.cast(int, child.position_id)
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        next_level[child_id] = child
+            if next_level:
+                yield next_level
+            level = list(next_level)
+            depth += 1
+
+    def get_engine_analyses(self, position_id: int) -> List[EngineAnalysis]:
+        """Retrieve the analysis of each engine which analyzed a position."""
+        cursor = self._db.execute(
+            'SELECT engine, score, depth, pv FROM engine_analysis WHERE position_id = ? ORDER BY rowid', (position_id,))
+        return [EngineAnalysis(row['engine'], row['score'], row['depth'], row['pv']) for row in cursor]
+
+    def query(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query, with rows returned as dictionaries."""
+        return self._db.execute(sql, tuple(parameters))
+
+    def query_tuples(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query, with rows returned as tuples to read many rows quickly."""
+        return self._tuple_cursor().execute(sql, tuple(parameters))
+
     def update_position(self, position: Position) -> Optional[Position]:
         """Update a position in the database."""
-        cursor = self._db.execute(
-            'UPDATE openings SET score = ?, depth = ?, pv = ?  WHERE id = ?',
-            (position.score, position.depth, position.pv, position.position_id))
+        with self._write():
+            cursor = self._db.execute(
+                'UPDATE openings SET score = ?, depth = ?, pv = ?  WHERE id = ?',
+                (position.score, position.depth, position.pv, position.position_id))
         return _get_position_or_none(cursor)
+
+    def increment_visits(self, position_id: int, priority_penalty: float = 0.0) -> None:
+        """Record that the search passed through a position, lowering the priority of its pending moves."""
+        with self._write():
+            self._db.execute('UPDATE openings SET visits = visits + 1 WHERE id = ?', (position_id,))
+            if priority_penalty:
+                self._lower_pending_priority(position_id, priority_penalty)
+
+    def set_tree_scores(self, tree_scores: Iterable[Tuple[int, float]]) -> None:
+        """Replace the scores backed up from the tree below each position with a single update.
+
+        Positions without a new tree score are left without one.
+        """
+        with self._write():
+            self._db.execute('CREATE TEMP TABLE new_tree_scores (id INTEGER PRIMARY KEY, score)')
+            self._db.executemany('INSERT INTO new_tree_scores VALUES (?, ?)', tree_scores)
+            self._db.execute(
+                'UPDATE openings '
+                'SET tree_score = (SELECT score FROM new_tree_scores WHERE new_tree_scores.id = openings.id)')
+            self._db.execute('DROP TABLE new_tree_scores')
+
+    ## The frontier of expansions which have not yet been inserted, a priority queue of pending expansions and the
+    ## expansions which are in flight
+
+    def enqueue_expansions(
+            self, expansions: Iterable[Tuple[ParentRelationship, float]], stage: str = STAGE_EXPAND) -> None:
+        """Add moves from their parent positions to the queue of pending expansions with a priority.
+
+        Expansions with a higher priority are claimed first. Moves which are already in the frontier are unchanged.
+        """
+        with self._write():
+            self._db.executemany(
+                'INSERT OR IGNORE INTO frontier (parent_id, move, status, claimed_at, priority, stage) '
+                'VALUES (?, ?, ?, ?, ?, ?)', [
+                    (parent_id, move, FRONTIER_PENDING, time.time(), priority, stage)
+                    for (parent_id, move), priority in expansions
+                ])
+
+    def claim_expansions(self, expansions: Iterable[ParentRelationship]) -> None:
+        """Record that the analysis of moves from their parent positions is in flight."""
+        with self._write():
+            self._db.executemany(
+                'INSERT INTO frontier (parent_id, move, status, claimed_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (parent_id, move) '
+                'DO UPDATE SET status = excluded.status, claimed_at = excluded.claimed_at',
+                [(parent_id, move, FRONTIER_IN_FLIGHT, time.time()) for parent_id, move in expansions])
+
+    def _pending_expansions(self, count: int) -> sqlite3.Cursor:
+        """The count pending expansions with the highest priority and the fen of their parent, without claiming them."""
+        return self._db.execute(
+            'SELECT frontier.parent_id, frontier.move, openings.fen, frontier.stage, frontier.priority, '
+            '  frontier.claimed_at '
+            'FROM frontier '
+            'JOIN openings '
+            'ON frontier.parent_id = openings.id '
+            'WHERE frontier.status = ? '
+            'ORDER BY frontier.priority DESC, frontier.claimed_at, frontier.rowid '
+            'LIMIT ?', (FRONTIER_PENDING, count))
+
+    def claim_pending_expansions(self, count: int) -> List[FrontierEntry]:
+        """Mark the count pending expansions with the highest priority as in flight and return them."""
+        entries = [
+            FrontierEntry(row['parent_id'], row['move'], row['fen'], row['stage'])
+            for row in self._pending_expansions(count)
+        ]
+        if entries:
+            self.claim_expansions(ParentRelationship(entry.parent_id, entry.move) for entry in entries)
+        return entries
+
+    def complete_expansion(self, relationship: ParentRelationship) -> None:
+        """Remove an expansion from the frontier without inserting a position."""
+        with self._write():
+            self._remove_from_frontier(*relationship)
+
+    def requeue_expansions(self, expansions: Iterable[ParentRelationship]) -> int:
+        """Return expansions whose analysis failed to the pending state with a lower priority, so they are retried.
+
+        An expansion which has failed MAX_EXPANSION_ATTEMPTS times is given up instead. A move which is given up is never
+        linked to its parent, so it is counted as expanded, and its parent can still become fully expanded. Returns the
+        number of expansions which were given up.
+        """
+        expansions = list(expansions)
+        with self._write():
+            self._db.executemany(
+                'UPDATE frontier '
+                'SET status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, '
+                '  priority = priority - ?, '
+                '  attempts = attempts + 1 '
+                'WHERE parent_id = ? AND move = ?', [
+                    (
+                        MAX_EXPANSION_ATTEMPTS, FRONTIER_FAILED, FRONTIER_PENDING, FAILED_EXPANSION_PRIORITY_PENALTY,
+                        parent_id, move) for parent_id, move in expansions
+                ])
+            given_up = 0
+            for parent_id, move in expansions:
+                row = self._db.execute(
+                    'SELECT status, stage FROM frontier WHERE parent_id = ? AND move = ?',
+                    (parent_id, move)).fetchone()
+                if row is None or row['status'] != FRONTIER_FAILED:
+                    continue
+                given_up += 1
+                if row['stage'] == STAGE_EXPAND:
+                    self._increment_expanded_count(parent_id)
+        return given_up
+
+    def requeue_in_flight(self) -> int:
+        """Return expansions which were in flight when the explorer stopped to the pending state."""
+        with self._write():
+            cursor = self._db.execute(
+                'UPDATE frontier SET status = ? WHERE status = ?', (FRONTIER_PENDING, FRONTIER_IN_FLIGHT))
+        return cursor.rowcount
+
+    ## Merging the tree of another database into this one
+
+    def _source_batches(self, table: str, column: str, batch_size: int) -> Iterator[Tuple[int, int]]:
+        """Splits the values of an integer column of a table of the source database into inclusive ranges."""
+        row = self._db.execute(f'SELECT min({column}) AS low, max({column}) AS high FROM source.{table}').fetchone()
+        if row['low'] is None:
+            return
+        for low in range(row['low'], row['high'] + 1, batch_size):
+            yield (low, low + batch_size - 1)
+
+    def _merge_batches(self, table: str, column: str, batch_size: int, statements: List[str]) -> None:
+        """Executes statements for each range of values of a column of the source, committing after each range."""
+        for batch in self._source_batches(table, column, batch_size):
+            with self._write():
+                for statement in statements:
+                    self._db.execute(statement, batch)
+            self.checkpoint()
+
+    def merge(self, source_path: str, batch_size: int = MERGE_BATCH_SIZE) -> MergeResult:
+        """Merge the positions, edges, engine analysis and frontier of another database into this one.
+
+        Positions are matched by fen and keep the deeper analysis, and their visits are added. Ids of the source are
+        mapped to ids of this database in a temporary table, so memory does not grow with the size of the source. Each
+        batch of rows is committed on its own, and merging the same source again changes nothing but visits.
+        """
+        if not os.path.isfile(source_path):
+            raise FileNotFoundError(f'No database at \'{source_path}\'')
+        self.checkpoint()
+        before = self._tree_size()
+        self._db.execute('ATTACH DATABASE ? AS source', (source_path,))
+        try:
+            self._db.execute('CREATE TEMP TABLE id_map (source_id INTEGER PRIMARY KEY, target_id)')
+            self._merge_batches(
+                'openings', 'id', batch_size, [
+                    'INSERT INTO openings '
+                    '(fen, score, depth, pv, visits, legal_move_count, expanded_count, fully_expanded, terminal) '
+                    'SELECT fen, score, depth, pv, visits, legal_move_count, 0, legal_move_count = 0, terminal '
+                    'FROM source.openings '
+                    'WHERE id BETWEEN ? AND ? '
+                    'ON CONFLICT (fen) DO UPDATE SET '
+                    '  score = CASE WHEN excluded.depth > depth THEN excluded.score ELSE score END, '
+                    '  pv = CASE WHEN excluded.depth > depth THEN excluded.pv ELSE pv END, '
+                    '  depth = max(excluded.depth, depth), '
+                    '  visits = visits + excluded.visits, '
+                    '  legal_move_count = max(excluded.legal_move_count, legal_move_count)',
+                    'INSERT INTO id_map '
+                    'SELECT source_openings.id, openings.id '
+                    'FROM source.openings AS source_openings '
+                    'JOIN openings '
+                    'ON openings.fen = source_openings.fen '
+                    'WHERE source_openings.id BETWEEN ? AND ?',
+                ])
+            self._merge_batches(
+                'game_dag', 'rowid', batch_size, [
+                    'INSERT OR IGNORE INTO game_dag '
+                    'SELECT parent_map.target_id, child_map.target_id, source_dag.move '
+                    'FROM source.game_dag AS source_dag '
+                    'JOIN id_map AS parent_map '
+                    'ON parent_map.source_id = source_dag.parent_id '
+                    'JOIN id_map AS child_map '
+                    'ON child_map.source_id = source_dag.child_id '
+                    'WHERE source_dag.rowid BETWEEN ? AND ?',
+                ])
+            self._merge_batches(
+                'engine_analysis', 'rowid', batch_size, [
+                    'INSERT INTO engine_analysis '
+                    'SELECT id_map.target_id, source_analysis.engine, source_analysis.score, source_analysis.depth, '
+                    '  source_analysis.pv '
+                    'FROM source.engine_analysis AS source_analysis '
+                    'JOIN id_map '
+                    'ON id_map.source_id = source_analysis.position_id '
+                    'WHERE source_analysis.rowid BETWEEN ? AND ? '
+                    'AND NOT EXISTS ( '
+                    '  SELECT 1 FROM engine_analysis '
+                    '  WHERE position_id = id_map.target_id '
+                    '  AND engine IS source_analysis.engine '
+                    '  AND score IS source_analysis.score '
+                    '  AND depth IS source_analysis.depth '
+                    '  AND pv IS source_analysis.pv)',
+                ])
+            # Expansions which are in flight or were given up in the source are pending here, with no failed attempts
+            self._merge_batches(
+                'frontier', 'rowid', batch_size, [
+                    'INSERT OR IGNORE INTO frontier (parent_id, move, status, claimed_at, priority, stage) '
+                    f'SELECT id_map.target_id, source_frontier.move, \'{FRONTIER_PENDING}\', '
+                    '  source_frontier.claimed_at, source_frontier.priority, source_frontier.stage '
+                    'FROM source.frontier AS source_frontier '
+                    'JOIN id_map '
+                    'ON id_map.source_id = source_frontier.parent_id '
+                    'WHERE source_frontier.rowid BETWEEN ? AND ?',
+                ])
+            self._merge_batches(
+                'openings',
+                'id',
+                batch_size,
+                [
+                    'UPDATE openings '
+                    # Without affinity on the id, the comparison can use the index on parent_id
+                    'SET expanded_count = (SELECT count() FROM game_dag WHERE game_dag.parent_id = +openings.id) '
+                    'WHERE id IN (SELECT target_id FROM id_map WHERE source_id BETWEEN ? AND ?)',
+                    'UPDATE openings '
+                    'SET fully_expanded = expanded_count >= legal_move_count '
+                    'WHERE id IN (SELECT target_id FROM id_map WHERE source_id BETWEEN ? AND ?)',
+                ])
+            with self._write():
+                # Expansions of moves which lead to a position in either database are complete
+                self._db.execute(
+                    'DELETE FROM frontier '
+                    'WHERE stage = ? '
+                    'AND EXISTS (SELECT 1 FROM game_dag WHERE parent_id = frontier.parent_id AND move = frontier.move)',
+                    (STAGE_EXPAND,))
+        finally:
+            self.checkpoint()
+            self._db.execute('DROP TABLE IF EXISTS temp.id_map')
+            self._db.execute('DETACH DATABASE source')
+        after = self._tree_size()
+        return MergeResult(after[0] - before[0], after[1] - before[1])
+
+    def _tree_size(self) -> Tuple[int, int]:
+        """The number of positions and of edges."""
+        positions = self._db.execute('SELECT count() AS count FROM openings').fetchone()['count']
+        edges = self._db.execute('SELECT count() AS count FROM game_dag').fetchone()['count']
+        return (positions, edges)
+
+    ## Pruning hopeless moves and reclaiming their space
+
+    def prune(self, window: float, min_depth: int = 0, keep: Iterable[ParentRelationship] = ()) -> PruneResult:
+        """Delete moves which are hopeless compared to their best sibling, and every position no longer reachable.
+
+        A move is hopeless if every move of its parent has been analyzed, the position it leads to was analyzed to at
+        least min_depth, and its score is more than window centipawns worse than the best sibling. Moves to keep are
+        never hopeless. Positions are reachable from the positions which had no parent before pruning, so a
+        transposition is kept as long as any line still leads to it. The frontier entries of deleted moves are deleted
+        too, and the expanded count of their parents still counts them, so they are not expanded again. Edges are
+        counted from game_dag rather than from expanded counts.
+        """
+        self.checkpoint()
+        with self._write():
+            self._db.execute(
+                'CREATE TEMP TABLE prune_roots AS '
+                'SELECT id FROM openings WHERE id NOT IN (SELECT child_id FROM game_dag)')
+            self._db.execute('CREATE TEMP TABLE kept_moves (parent_id, move, PRIMARY KEY (parent_id, move))')
+            self._db.executemany('INSERT OR IGNORE INTO kept_moves VALUES (?, ?)', [tuple(move) for move in keep])
+            # Scores are relative to the side to move, so the best sibling has the lowest score
+            self._db.execute(
+                'CREATE TEMP TABLE hopeless_moves AS '
+                'SELECT game_dag.parent_id, game_dag.move '
+                'FROM game_dag '
+                'JOIN openings AS parent '
+                'ON parent.id = game_dag.parent_id '
+                'JOIN openings AS child '
+                'ON child.id = game_dag.child_id '
+                'JOIN ( '
+                '  SELECT siblings.parent_id, min(openings.score) AS score '
+                '  FROM game_dag AS siblings '
+                '  JOIN openings '
+                '  ON openings.id = siblings.child_id '
+                '  GROUP BY siblings.parent_id) AS best '
+                'ON best.parent_id = game_dag.parent_id '
+                'WHERE parent.expanded_count >= parent.legal_move_count '
+                'AND child.depth >= ? '
+                'AND child.score - best.score > ? '
+                'AND NOT EXISTS ( '
+                '  SELECT 1 FROM kept_moves '
+                '  WHERE kept_moves.parent_id = game_dag.parent_id AND kept_moves.move = game_dag.move)',
+                (min_depth, window))
+            for table in ['game_dag', 'frontier']:
+                self._db.execute(
+                    f'DELETE FROM {table} '
+                    'WHERE EXISTS ( '
+                    '  SELECT 1 FROM hopeless_moves '
+                    f'  WHERE hopeless_moves.parent_id = {table}.parent_id AND hopeless_moves.move = {table}.move)')
+            self._db.execute('CREATE TEMP TABLE reachable (id INTEGER PRIMARY KEY)')
+            self._db.execute(
+                'WITH RECURSIVE reached (id) AS ( '
+                '  SELECT id FROM prune_roots '
+                '  UNION '
+                '  SELECT game_dag.child_id '
+                '  FROM reached '
+                '  JOIN game_dag '
+                '  ON game_dag.parent_id = reached.id) '
+                'INSERT INTO reachable SELECT id FROM reached')
+            position_count = self._db.execute(
+                'DELETE FROM openings WHERE id NOT IN (SELECT id FROM reachable)').rowcount
+            for table, column in [('game_dag', 'parent_id'), ('engine_analysis', 'position_id'),
+                                  ('frontier', 'parent_id')]:
+                self._db.execute(f'DELETE FROM {table} WHERE {column} NOT IN (SELECT id FROM reachable)')
+            edge_count = self._db.execute('SELECT count() AS count FROM hopeless_moves').fetchone()['count']
+            for table in ['prune_roots', 'kept_moves', 'hopeless_moves', 'reachable']:
+                self._db.execute(f'DROP TABLE temp.{table}')
+        self.checkpoint()
+        return PruneResult(edge_count, position_count)
+
+    def compact(self) -> None:
+        """Return the pages of deleted rows to the file system and update the statistics of the query planner.
+
+        The first compaction of a database created without incremental vacuuming rewrites the whole file.
+        """
+        self.checkpoint()
+        if self._db.execute('PRAGMA auto_vacuum').fetchone()['auto_vacuum'] != _AUTO_VACUUM_INCREMENTAL:
+            self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self._db.execute('VACUUM')
+        else:
+            # Each step of the pragma frees pages, so it is run to completion. Its rows have no columns, which older
+            # versions of sqlite3 do not describe, so they are not made into dictionaries.
+            self._tuple_cursor().execute('PRAGMA incremental_vacuum').fetchall()
+        self._db.execute('PRAGMA optimize')
+        # Move the pages in the write ahead log into the file, so that the file size is accurate
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
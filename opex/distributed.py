@@ -0,0 +1,221 @@
+"""Distributed analysis with a coordinator which hands out analysis jobs to workers over tcp.
+
+The coordinator owns the database and the selection of positions to analyze. Workers request jobs in batches, analyze
+them with their own engine and submit the results. Each job is leased to a worker, and jobs whose lease expires before
+their result is submitted are handed out again.
+
+Messages are single lines of json. A worker sends a request and the coordinator replies on the same connection.
+"""
+
+from __future__ import annotations  # PEP 563
+
+import json
+import os
+import socket
+import socketserver
+import time
+
+import chess
+
+from opex import engines
+from opex import search
+from opex import supervisor
+from opex.analysis import EngineAnalysis
+from opex.settings_loader import Json
+
+import typing
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 19112
+DEFAULT_LEASE_TIMEOUT = 600.0
+# Seconds the coordinator waits for a worker to send its request, so that a stalled worker does not block the others
+DEFAULT_REQUEST_TIMEOUT = 10.0
+
+Address = Tuple[str, int]
+
+
+class Job(NamedTuple):
+    """A position for a worker to analyze."""
+    job_id: str
+    fen: str
+    depth: int
+
+
+class Lease(NamedTuple):
+    """The worker analyzing an expansion and when the coordinator stops waiting for it."""
+    expansion: search.Expansion
+    worker: str
+    expires_at: float
+
+
+def job_id_for(expansion: search.Expansion) -> str:
+    """Identifies an expansion by the move from its parent."""
+    if expansion.relationship is None:
+        return 'root'
+    return f'{expansion.relationship.parent_id} {expansion.relationship.move}'
+
+
+class Coordinator:
+    """Leases the expansions selected by a tree search to workers and stores the results they submit."""
+
+    def __init__(
+            self,
+            tree_search: search.TreeSearch,
+            lease_timeout: float = DEFAULT_LEASE_TIMEOUT,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.tree_search = tree_search
+        self.lease_timeout = lease_timeout
+        self._clock = clock
+        self._leases: Dict[str, Lease] = {}
+
+    def _lease(self, job_id: str, expansion: search.Expansion, worker: str) -> Job:
+        """Leases an expansion to a worker until the lease timeout has passed."""
+        self._leases[job_id] = Lease(expansion, worker, self._clock() + self.lease_timeout)
+        return Job(job_id, search.get_fen(expansion.board), expansion.depth)
+
+    def request_jobs(self, worker: str, count: int) -> List[Job]:
+        """Leases up to count jobs to a worker, starting with jobs whose lease has expired."""
+        now = self._clock()
+        expired = [job_id for job_id, lease in self._leases.items() if lease.expires_at <= now][:count]
+        jobs: List[Job] = []
+        for job_id in expired:
+            print(f'Lease of {job_id} to {self._leases[job_id].worker} expired')
+            jobs.append(self._lease(job_id, self._leases[job_id].expansion, worker))
+        while len(jobs) < count:
+            expansions = [
+                expansion for expansion in self.tree_search.select_expansions(chess.Board(), count - len(jobs))
+                if job_id_for(expansion) not in self._leases
+            ]
+            if not expansions:
+                break
+            jobs.extend(self._lease(job_id_for(expansion), expansion, worker) for expansion in expansions)
+        return jobs
+
+    def submit_results(self, worker: str, results: List[Json]) -> int:
+        """Stores the analysis submitted by a worker and returns how many results were accepted."""
+        accepted = 0
+        for result in results:
+            job_id = typing.cast(str, result['job_id'])
+            lease = self._leases.get(job_id)
+            if lease is None or search.get_fen(lease.expansion.board) != result['fen']:
+                print(f'Ignoring result for {job_id} from {worker} which is not leased')
+                continue
+            del self._leases[job_id]
+            engine_analysis = EngineAnalysis(
+                typing.cast(str, result['engine']), typing.cast(float, result['score']),
+                typing.cast(int, result['depth']), typing.cast(str, result['pv']))
+            self.tree_search.store_analysis(lease.expansion, [engine_analysis])
+            accepted += 1
+        return accepted
+
+    def outstanding_jobs(self) -> int:
+        """The number of jobs leased to workers which have not been submitted."""
+        return len(self._leases)
+
+    def handle_message(self, message: Json) -> Json:
+        """Replies to a message from a worker."""
+        worker = typing.cast(str, message['worker'])
+        if message['type'] == 'request_jobs':
+            jobs = self.request_jobs(worker, typing.cast(int, message['count']))
+            return {'jobs': [typing.cast(Json, job._asdict()) for job in jobs]}
+        if message['type'] == 'submit_results':
+            return {'accepted': self.submit_results(worker, typing.cast(List[Json], message['results']))}
+        return {'error': f'Unknown message type \'{message["type"]}\''}
+
+
+class _CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    """Reads one message from a worker and writes the reply, giving up on a worker which does not send its message."""
+
+    def setup(self) -> None:
+        super().setup()
+        self.connection.settimeout(typing.cast(CoordinatorServer, self.server).request_timeout)
+
+    def handle(self) -> None:
+        server = typing.cast(CoordinatorServer, self.server)
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            print(f'{self.client_address} did not send a request within {server.request_timeout}s')
+            return
+        try:
+            reply = server.coordinator.handle_message(typing.cast(Json, json.loads(line)))
+        except (ValueError, KeyError, TypeError) as error:
+            # A message which is not json with the keys of its type is answered, so the worker does not wait for a reply
+            reply = {'error': f'Malformed message: {error!r}'}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class CoordinatorServer(socketserver.TCPServer):
+    """Serves a coordinator to workers, one request at a time so the database is only used from one thread.
+
+    A worker which connects but stalls is disconnected after request_timeout seconds.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(
+            self, address: Address, coordinator: Coordinator, request_timeout: float = DEFAULT_REQUEST_TIMEOUT) -> None:
+        super().__init__(address, _CoordinatorRequestHandler)
+        self.coordinator = coordinator
+        self.request_timeout = request_timeout
+
+
+def send_message(address: Address, message: Json) -> Json:
+    """Sends a message to the coordinator and waits for the reply."""
+    with socket.create_connection(address) as connection:
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        with connection.makefile('rb') as reply:
+            return typing.cast(Json, json.loads(reply.readline()))
+
+
+def run_worker(
+        address: Address,
+        engine_supervisor: supervisor.EngineSupervisor,
+        batch_size: int = 1,
+        poll_interval: float = 1.0,
+        max_batches: Optional[int] = None,
+        early_stop: Optional[engines.EarlyStop] = None) -> None:
+    """Analyzes jobs from a coordinator until max_batches batches have been submitted, or forever.
+
+    The supervisor restarts an engine which crashes or hangs. A job which fails on every attempt is left for its lease
+    to expire, so that the coordinator hands it out again.
+    """
+    worker = f'{socket.gethostname()}:{os.getpid()}:{engine_supervisor.nickname}'
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        try:
+            reply = send_message(address, {'type': 'request_jobs', 'worker': worker, 'count': batch_size})
+        except OSError as error:
+            print(f'Could not reach coordinator: {error}')
+            time.sleep(poll_interval)
+            continue
+        jobs = [
+            Job(typing.cast(str, job['job_id']), typing.cast(str, job['fen']), typing.cast(int, job['depth']))
+            for job in typing.cast(List[Json], reply['jobs'])
+        ]
+        if not jobs:
+            time.sleep(poll_interval)
+            continue
+        results: List[Json] = []
+        for job in jobs:
+            try:
+                engine_analysis = engine_supervisor.analyze_board(chess.Board(job.fen), job.depth, early_stop)
+            except supervisor.EngineFailure as error:
+                print(f'Could not analyze {job.job_id}: {error}')
+                continue
+            results.append(
+                {
+                    'job_id': job.job_id,
+                    'fen': job.fen,
+                    'engine': engine_analysis.nickname,
+                    'score': engine_analysis.score,
+                    'depth': engine_analysis.depth,
+                    'pv': engine_analysis.pv
+                })
+        try:
+            send_message(address, {'type': 'submit_results', 'worker': worker, 'results': results})
+        except OSError as error:
+            # The coordinator hands the jobs out again when their leases expire
+            print(f'Could not submit {len(results)} results: {error}')
+        batches += 1
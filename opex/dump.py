@@ -0,0 +1,452 @@
+"""A compact streaming dump of a database, and its restore into a new database.
+
+A dump is a header followed by frames, each holding a chunk of rows of one table compressed on its own, so that a dump
+can be written to and read from a pipe with memory bounded by the chunk size. The rows of a chunk are stored column by
+column: ids as the difference from the id before, the child of an edge as the difference from its parent, numbers
+packed as arrays, uci moves packed into two bytes each and texts such as fens joined, which compress well since the
+positions of a chunk are mostly close to each other in the tree.
+
+A restore loads every row into a new database in one transaction without a journal, and creates the indexes which are
+not needed while loading once every row is in.
+"""
+
+import lzma
+import os
+import re
+import sqlite3
+import struct
+import zlib
+
+import chess
+import numpy as np
+
+from opex import db_wrapper
+
+import typing
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+MAGIC = b'OPEXDUMP'
+FORMAT_VERSION = 2
+
+COMPRESSIONS = ['zlib', 'lzma']
+DEFAULT_COMPRESSION = 'lzma'
+_COMPRESSORS: Dict[str, Tuple[int, Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+}
+
+# The number of rows in each frame
+DEFAULT_CHUNK_SIZE = 50000
+
+_HEADER = struct.Struct('<8sBB')
+# The table, number of rows and length of the compressed columns of a frame
+_FRAME = struct.Struct('<BII')
+_LENGTH = struct.Struct('<I')
+# The table of the frame which ends a dump
+_END = 0
+
+# Pages kept in memory while restoring, in KiB when negative
+_RESTORE_CACHE_SIZE = -262144
+
+# The kinds of number in a column
+_INTEGER = 0
+_FLOAT = 1
+_NULL = 2
+
+_UCI_MOVE = re.compile(r'[a-h][1-8][a-h][1-8][nbrq]?')
+_PROMOTIONS = ' nbrq'
+
+
+class DumpResult(NamedTuple):
+    """The number of rows of each table in a dump."""
+    position_count: int
+    edge_count: int
+    engine_analysis_count: int
+    frontier_count: int
+
+
+## Packing of columns
+
+
+def _pack_move(move: str) -> int:
+    """Packs a uci move into 15 bits, the from and to squares and the promotion."""
+    from_square = ord(move[0]) - ord('a') + 8 * (ord(move[1]) - ord('1'))
+    to_square = ord(move[2]) - ord('a') + 8 * (ord(move[3]) - ord('1'))
+    promotion = _PROMOTIONS.index(move[4]) if len(move) == 5 else 0
+    return from_square | to_square << 6 | promotion << 12
+
+
+def _unpack_move(packed: int) -> str:
+    """Unpacks a uci move packed by _pack_move."""
+    from_square = packed & 63
+    to_square = packed >> 6 & 63
+    promotion = _PROMOTIONS[packed >> 12].strip()
+    return chess.SQUARE_NAMES[from_square] + chess.SQUARE_NAMES[to_square] + promotion
+
+
+def _encode_nulls(values: Sequence[Any]) -> bytes:
+    return np.array([value is None for value in values], dtype=np.uint8).tobytes()
+
+
+def _with_nulls(values: List[Any], nulls: bytes) -> List[Any]:
+    return [None if null else value for value, null in zip(values, np.frombuffer(nulls, dtype=np.uint8).tolist())]
+
+
+def _encode_texts(texts: Sequence[Optional[str]]) -> bytes:
+    return _pack_columns([_encode_nulls(texts), '\0'.join(text or '' for text in texts).encode()])
+
+
+def _decode_texts(data: bytes, count: int) -> List[Optional[str]]:
+    """Unpacks count texts packed by _encode_texts."""
+    nulls, texts = _unpack_column_pair(data)
+    return _with_nulls(texts.decode().split('\0') if count else [], nulls)
+
+
+def _number_kind(value: Optional[float]) -> int:
+    """The kind of a number, where booleans are not integers."""
+    if value is None:
+        return _NULL
+    return _INTEGER if isinstance(value, int) and not isinstance(value, bool) else _FLOAT
+
+
+def _encode_numbers(values: Sequence[Optional[float]]) -> bytes:
+    """Packs numbers as 64 bit integers if none of them is a float and as 64 bit floats otherwise.
+
+    The kind of each value is stored apart, so that integers among floats and nulls are restored as they were.
+    """
+    kinds = np.array([_number_kind(value) for value in values], dtype=np.uint8)
+    numbers = [0 if value is None else value for value in values]
+    dtype = np.float64 if _FLOAT in kinds else np.int64
+    return _pack_columns([kinds.tobytes(), np.array(numbers, dtype=dtype).tobytes()])
+
+
+def _decode_numbers(data: bytes, count: int) -> List[Any]:
+    """Unpacks count numbers packed by _encode_numbers."""
+    kinds_data, numbers_data = _unpack_column_pair(data)
+    kinds = np.frombuffer(kinds_data, dtype=np.uint8).tolist()
+    if len(kinds) != count:
+        raise ValueError(f'{len(kinds)} numbers in place of {count}')
+    dtype = np.float64 if _FLOAT in kinds else np.int64
+    numbers = np.frombuffer(numbers_data, dtype=dtype).tolist()
+    return [
+        None if kind == _NULL else int(number) if kind == _INTEGER else number for kind, number in zip(kinds, numbers)
+    ]
+
+
+def _encode_moves(moves: Sequence[str]) -> bytes:
+    """Packs uci moves in two bytes each, or stores them as text if any of them is not a uci move."""
+    if all(_UCI_MOVE.fullmatch(move) for move in moves):
+        return b'p' + np.array([_pack_move(move) for move in moves], dtype=np.uint16).tobytes()
+    return b't' + _encode_texts(moves)
+
+
+def _decode_moves(data: bytes, count: int) -> List[Optional[str]]:
+    """Unpacks count moves packed by _encode_moves."""
+    if data[:1] == b'p':
+        return [_unpack_move(packed) for packed in np.frombuffer(data[1:], dtype=np.uint16).tolist()]
+    return _decode_texts(data[1:], count)
+
+
+def _packable_pv(pv: Optional[str]) -> bool:
+    """Whether a principal variation is up to 255 uci moves separated by single spaces."""
+    if pv is None:
+        return False
+    moves = pv.split()
+    return ' '.join(moves) == pv and len(moves) < 256 and all(_UCI_MOVE.fullmatch(move) for move in moves)
+
+
+def _encode_pvs(pvs: Sequence[Optional[str]]) -> bytes:
+    """Packs principal variations as the number of moves in each followed by the packed moves.
+
+    The principal variations are stored as text if any of them cannot be packed.
+    """
+    if all(_packable_pv(pv) for pv in pvs):
+        lines = [typing.cast(str, pv).split() for pv in pvs]
+        lengths = np.array([len(line) for line in lines], dtype=np.uint8).tobytes()
+        moves = np.array([_pack_move(move) for line in lines for move in line], dtype=np.uint16).tobytes()
+        return b'p' + _pack_columns([lengths, moves])
+    return b't' + _encode_texts(pvs)
+
+
+def _decode_pvs(data: bytes, count: int) -> List[Optional[str]]:
+    """Unpacks count principal variations packed by _encode_pvs."""
+    if data[:1] == b't':
+        return _decode_texts(data[1:], count)
+    lengths_data, moves_data = _unpack_column_pair(data[1:])
+    moves = [_unpack_move(packed) for packed in np.frombuffer(moves_data, dtype=np.uint16).tolist()]
+    pvs: List[Optional[str]] = []
+    start = 0
+    for length in np.frombuffer(lengths_data, dtype=np.uint8).tolist():
+        pvs.append(' '.join(moves[start:start + length]))
+        start += length
+    return pvs
+
+
+def _pack_columns(columns: List[bytes]) -> bytes:
+    return b''.join(_LENGTH.pack(len(column)) + column for column in columns)
+
+
+def _unpack_columns(data: bytes) -> List[bytes]:
+    """Splits data packed by _pack_columns into its columns."""
+    columns: List[bytes] = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        columns.append(data[offset:offset + length])
+        offset += length
+    return columns
+
+
+def _unpack_column_pair(data: bytes) -> Tuple[bytes, bytes]:
+    """Splits data packed by _pack_columns from two columns."""
+    columns = _unpack_columns(data)
+    if len(columns) != 2:
+        raise ValueError(f'{len(columns)} columns in place of 2')
+    return columns[0], columns[1]
+
+
+## Tables
+
+
+class _Column(NamedTuple):
+    """A column of a table, with how its values are packed and unpacked."""
+    name: str
+    encode: Callable[[Sequence[Any]], bytes]
+    decode: Callable[[bytes, int], List[Any]]
+
+
+class _Table(NamedTuple):
+    """A table dumped in order of its first column, an id which is stored as the difference from the one before.
+
+    The second column is stored as the difference from the first if relative is set.
+    """
+    frame: int
+    name: str
+    order: str
+    columns: List[_Column]
+    relative: bool = False
+
+
+_TEXT = (_encode_texts, _decode_texts)
+_NUMBER = (_encode_numbers, _decode_numbers)
+_MOVE = (_encode_moves, _decode_moves)
+_PV = (_encode_pvs, _decode_pvs)
+
+_TABLES = [
+    _Table(
+        1, 'openings', 'id', [
+            _Column('id', *_NUMBER),
+            _Column('fen', *_TEXT),
+            _Column('score', *_NUMBER),
+            _Column('depth', *_NUMBER),
+            _Column('pv', *_PV),
+            _Column('visits', *_NUMBER),
+            _Column('legal_move_count', *_NUMBER),
+            _Column('expanded_count', *_NUMBER),
+            _Column('fully_expanded', *_NUMBER),
+            _Column('terminal', *_NUMBER),
+            _Column('tree_score', *_NUMBER),
+        ]),
+    _Table(
+        2,
+        'game_dag',
+        'parent_id, move', [
+            _Column('parent_id', *_NUMBER),
+            _Column('child_id', *_NUMBER),
+            _Column('move', *_MOVE),
+        ],
+        relative=True),
+    _Table(
+        3, 'engine_analysis', 'position_id, rowid', [
+            _Column('position_id', *_NUMBER),
+            _Column('engine', *_TEXT),
+            _Column('score', *_NUMBER),
+            _Column('depth', *_NUMBER),
+            _Column('pv', *_PV),
+        ]),
+    _Table(
+        4, 'frontier', 'parent_id, move', [
+            _Column('parent_id', *_NUMBER),
+            _Column('move', *_MOVE),
+            _Column('status', *_TEXT),
+            _Column('claimed_at', *_NUMBER),
+            _Column('priority', *_NUMBER),
+            _Column('stage', *_TEXT),
+            _Column('attempts', *_NUMBER),
+        ]),
+]
+
+
+def _encode_chunk(table: _Table, rows: List[Tuple[Any, ...]], previous_id: int) -> List[bytes]:
+    """Packs the columns of rows which follow the row with previous_id."""
+    columns = [list(column) for column in zip(*rows)]
+    if table.relative:
+        columns[1] = [second - first for first, second in zip(columns[0], columns[1])]
+    columns[0] = np.diff(np.array(columns[0], dtype=np.int64), prepend=previous_id).tolist()
+    return [column.encode(values) for column, values in zip(table.columns, columns)]
+
+
+def _decode_chunk(table: _Table, data: List[bytes], count: int, previous_id: int) -> List[List[Any]]:
+    """Unpacks the columns of count rows which follow the row with previous_id."""
+    if len(data) != len(table.columns):
+        raise ValueError(f'{len(data)} columns of {table.name} in place of {len(table.columns)}')
+    columns = [column.decode(values, count) for column, values in zip(table.columns, data)]
+    columns[0] = (np.cumsum(np.array(columns[0], dtype=np.int64)) + previous_id).tolist()
+    if table.relative:
+        columns[1] = [first + second for first, second in zip(columns[0], columns[1])]
+    return columns
+
+
+## Dumping
+
+
+def _chunked_rows(cursor: sqlite3.Cursor, chunk_size: int) -> Iterator[List[Tuple[Any, ...]]]:
+    """The rows of a cursor, chunk_size at a time."""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+class _DumpWriter:
+    """Writes frames of a dump to a binary stream."""
+
+    def __init__(self, output: BinaryIO, compression: str) -> None:
+        if compression not in _COMPRESSORS:
+            raise ValueError(f'Unknown compression \'{compression}\' not in {COMPRESSIONS}')
+        compression_id, self._compress, _ = _COMPRESSORS[compression]
+        self._output = output
+        self._output.write(_HEADER.pack(MAGIC, FORMAT_VERSION, compression_id))
+
+    def write_frame(self, frame: int, row_count: int, columns: List[bytes]) -> None:
+        """Compresses the packed columns of a chunk of rows and writes them as a frame."""
+        payload = self._compress(_pack_columns(columns))
+        self._output.write(_FRAME.pack(frame, row_count, len(payload)))
+        self._output.write(payload)
+
+    def close(self) -> None:
+        self._output.write(_FRAME.pack(_END, 0, 0))
+        self._output.flush()
+
+
+def dump_database(
+        database_path: str,
+        output: BinaryIO,
+        compression: str = DEFAULT_COMPRESSION,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> DumpResult:
+    """Streams every table of a database to a binary output.
+
+    The database is read in a single transaction through a read only connection, so a running explorer may go on
+    writing, and the dump is the database as it was at its last checkpoint before the dump started.
+    """
+    writer = _DumpWriter(output, compression)
+    counts: List[int] = []
+    with db_wrapper.Database(database_path, read_only=True) as database:
+        database.query('BEGIN')
+        try:
+            for table in _TABLES:
+                names = ', '.join(column.name for column in table.columns)
+                cursor = database.query_tuples(f'SELECT {names} FROM {table.name} ORDER BY {table.order}')
+                previous_id = 0
+                count = 0
+                for rows in _chunked_rows(cursor, chunk_size):
+                    writer.write_frame(table.frame, len(rows), _encode_chunk(table, rows, previous_id))
+                    previous_id = rows[-1][0]
+                    count += len(rows)
+                counts.append(count)
+        finally:
+            database.query('ROLLBACK')
+    writer.close()
+    return DumpResult(*counts)
+
+
+## Restoring
+
+
+def _read_exactly(dump_input: BinaryIO, size: int) -> bytes:
+    """Reads size bytes, which a dump which is cut short does not have."""
+    data = dump_input.read(size)
+    if len(data) != size:
+        raise ValueError(f'Dump ended {size - len(data)} bytes early')
+    return data
+
+
+def restore_database(dump_input: BinaryIO, database_path: str) -> DumpResult:
+    """Loads a dump into a new database, which is deleted again if the dump cannot be loaded."""
+    if os.path.exists(database_path):
+        raise FileExistsError(f'A database already exists at \'{database_path}\'')
+    try:
+        return _restore(dump_input, database_path)
+    except BaseException:
+        for suffix in ['', '-journal', '-wal', '-shm']:
+            if os.path.exists(database_path + suffix):
+                os.remove(database_path + suffix)
+        raise
+
+
+def _read_header(dump_input: BinaryIO) -> Callable[[bytes], bytes]:
+    """Checks the header of a dump and returns the decompression of its frames."""
+    magic, version, compression_id = _HEADER.unpack(_read_exactly(dump_input, _HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('Not an opex dump')
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unknown dump format version {version}')
+    decompressors = {compressor_id: decompress for compressor_id, _, decompress in _COMPRESSORS.values()}
+    if compression_id not in decompressors:
+        raise ValueError(f'Unknown compression {compression_id}')
+    return decompressors[compression_id]
+
+
+def _load_frames(
+        dump_input: BinaryIO, connection: sqlite3.Connection, decompress: Callable[[bytes], bytes]) -> DumpResult:
+    """Inserts the rows of every frame of a dump up to the frame which ends it."""
+    tables = {table.frame: table for table in _TABLES}
+    counts = dict.fromkeys(tables, 0)
+    previous_ids = dict.fromkeys(tables, 0)
+    while True:
+        frame, count, length = _FRAME.unpack(_read_exactly(dump_input, _FRAME.size))
+        if frame == _END:
+            return DumpResult(*counts.values())
+        if frame not in tables:
+            raise ValueError(f'Unknown frame {frame}')
+        table = tables[frame]
+        columns = _decode_chunk(
+            table, _unpack_columns(decompress(_read_exactly(dump_input, length))), count, previous_ids[frame])
+        names = ', '.join(column.name for column in table.columns)
+        connection.executemany(
+            f'INSERT INTO {table.name} ({names}) VALUES ({db_wrapper.placeholders(table.columns)})', zip(*columns))
+        previous_ids[frame] = columns[0][-1]
+        counts[frame] += count
+
+
+def _restore(dump_input: BinaryIO, database_path: str) -> DumpResult:
+    """Loads a dump into a new database in one transaction and creates its indexes once every row is in."""
+    decompress = _read_header(dump_input)
+    create_tables, create_indexes = db_wrapper.schema_statements()
+    connection = sqlite3.connect(database_path, isolation_level=None)
+    try:
+        # The database is new, so a restore which fails is deleted rather than rolled back
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute(f'PRAGMA cache_size = {_RESTORE_CACHE_SIZE}')
+        for statement in create_tables:
+            connection.execute(statement)
+        connection.execute('BEGIN')
+        result = _load_frames(dump_input, connection, decompress)
+        for statement in create_indexes:
+            connection.execute(statement)
+        connection.execute(f'PRAGMA user_version = {db_wrapper.SCHEMA_VERSION}')
+        connection.execute('COMMIT')
+        connection.execute('PRAGMA journal_mode = WAL')
+    finally:
+        connection.close()
+    return result
+
+
+def format_dump_result(result: DumpResult) -> str:
+    return (
+        f'{result.position_count} positions, {result.edge_count} moves, {result.engine_analysis_count} engine '
+        f'analyses and {result.frontier_count} frontier entries')
@@ -0,0 +1,98 @@
+"""Analysis of positions with uci engines."""
+
+import chess
+from chess import engine
+
+from opex import analysis
+from opex.analysis import EngineAnalysis
+
+from typing import List, NamedTuple, Optional
+
+# The depth to which every position is analyzed
+ANALYSIS_DEPTH = 20
+
+
+class EarlyStop(NamedTuple):
+    """When to stop analysis before the depth limit."""
+    # Analysis always continues to at least this depth
+    min_depth: int
+    # Stop once the best move has not changed and the score has moved by at most tolerance for this many depths
+    stable_depths: int
+    tolerance: float
+    # Stop once a forced mate or a score at least this large for either side has been found
+    decisive_score: float
+
+
+class DepthInfo(NamedTuple):
+    """The score and best move reported by an engine at a depth."""
+    depth: int
+    score: float
+    best_move: str
+    mate: bool
+
+
+def should_stop_early(early_stop: EarlyStop, infos: List[DepthInfo]) -> bool:
+    """Decides from the info reported so far whether more depth would change the analysis."""
+    latest = infos[-1]
+    if latest.depth < early_stop.min_depth:
+        return False
+    if latest.mate or abs(latest.score) >= early_stop.decisive_score:
+        return True
+    # The shallowest depth since which the best move and score have not changed
+    stable_since = latest.depth
+    for info in reversed(infos):
+        if info.best_move != latest.best_move or abs(info.score - latest.score) > early_stop.tolerance:
+            break
+        stable_since = info.depth
+    return latest.depth - stable_since >= early_stop.stable_depths
+
+
+def analyze_board(
+        uci_engine: engine.SimpleEngine,
+        nickname: str,
+        board: chess.Board,
+        depth: int,
+        early_stop: Optional[EarlyStop] = None) -> EngineAnalysis:
+    """Analyzes the board with a single uci engine, stopping early if the analysis has settled.
+
+    The depth of the analysis is the depth which was reached.
+    """
+    print(f'Analyzing with {nickname}')
+    if early_stop is None:
+        info = uci_engine.analyse(board, engine.Limit(depth=depth))
+    else:
+        info = analyze_until_settled(uci_engine, board, depth, early_stop)
+    # An analysis which is stopped before the engine reports a scored line, or an engine which misbehaves, has no pv
+    if 'score' not in info or 'pv' not in info:
+        raise engine.EngineError(f'{nickname} reported no score and pv for {board.fen()}')  # type: ignore
+    pv = ' '.join([str(move) for move in info['pv']])
+    score = info['score'].relative.score(mate_score=analysis.MATE_SCORE)
+    reached_depth = info.get('depth', depth)
+    print(f'{nickname}: score={score}, depth={reached_depth}, pv={pv}')
+    return EngineAnalysis(nickname, score, reached_depth, pv)
+
+
+def analyze_until_settled(
+        uci_engine: engine.SimpleEngine, board: chess.Board, depth: int, early_stop: EarlyStop) -> engine.InfoDict:
+    """Streams the info of an analysis to the depth limit and stops the engine once the analysis has settled."""
+    infos: List[DepthInfo] = []
+    latest: engine.InfoDict = {}
+    with uci_engine.analysis(board, engine.Limit(depth=depth)) as analysis_result:
+        for info in analysis_result:
+            if 'score' not in info or not info.get('pv') or 'depth' not in info:
+                continue
+            latest = info
+            score = info['score'].relative
+            infos.append(
+                DepthInfo(
+                    info['depth'], score.score(mate_score=analysis.MATE_SCORE), info['pv'][0].uci(), score.is_mate()))
+            if should_stop_early(early_stop, infos):
+                break
+    return latest
+
+
+def open_engine_with_options(path: str, options: engine.ConfigMapping) -> engine.SimpleEngine:
+    """Opens UCI engine with the specified dictionary of opening options."""
+    uci_engine = engine.SimpleEngine.popen_uci(path)
+    uci_engine.configure(options)
+    return uci_engine
@@ -0,0 +1,33 @@
+"""Watches files for changes by polling their modification times, so that settings can be reloaded while running."""
+
+import os
+
+from typing import Dict, Iterable, Optional, Tuple
+
+# The modification time in nanoseconds and size of a file, or None if it does not exist
+FileStamp = Optional[Tuple[int, int]]
+
+
+def file_stamp(path: str) -> FileStamp:
+    """The stamp of a file as it is now."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class FileWatcher:
+    """Remembers the state of some files and tells whether any of them has changed since."""
+
+    def __init__(self, paths: Iterable[str]) -> None:
+        self._stamps: Dict[str, FileStamp] = {}
+        self.watch(paths)
+
+    def watch(self, paths: Iterable[str]) -> None:
+        """Watches the files as they are now in place of any files watched before."""
+        self._stamps = {path: file_stamp(path) for path in paths}
+
+    def changed(self) -> bool:
+        """Whether a file has been modified, created or deleted since it was watched."""
+        return any(file_stamp(path) != stamp for path, stamp in self._stamps.items())
@@ -0,0 +1,490 @@
+"""An in-memory tree of positions which is flushed to a sqlite database at checkpoints.
+
+Positions are stored as a struct of arrays indexed by position id, with packed scores, depths and bookkeeping. The
+children of each position are stored in a block of slots of two edge arrays, as in a compressed sparse row matrix. The
+block of a position is allocated when its first child is added, with a slot for each legal move. A hash table of
+64 bit keys of fens maps positions to their ids.
+
+Fens are not stored. The fen of a position is recomputed by making the move from its first parent, and only the fens
+of roots, and of positions whose fen cannot be recomputed, are kept. A bounded cache holds the fens which were used
+most recently. Pvs are kept as strings.
+
+The frontier is left in the sqlite database, where it is already a priority queue.
+"""
+
+from __future__ import annotations  # PEP 563
+
+from array import array
+import contextlib
+import functools
+import hashlib
+import sqlite3
+
+import chess
+
+from opex import analysis
+from opex import db_wrapper
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import Any, Callable, Dict, Iterable, List, MutableSequence, NamedTuple, Optional, Set, Tuple
+
+# The number of recomputed fens which are cached
+FEN_CACHE_SIZE = 1 << 16
+
+_INITIAL_INDEX_SIZE = 1 << 10
+
+# Values of the parent of a position which is not the child of another position
+_NO_PARENT = -1
+# and of an id which is not a position
+_NO_POSITION = -2
+
+
+def fen_key(fen: str) -> int:
+    """A 64 bit key of a fen."""
+    return int.from_bytes(hashlib.blake2b(fen.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+def encode_move(uci: str) -> int:
+    """Packs a move in uci notation into 16 bits."""
+    move = chess.Move.from_uci(uci)
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> str:
+    """Unpacks a move packed by encode_move into uci notation."""
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None).uci()
+
+
+class _Positions(NamedTuple):
+    """The arrays of position data indexed by position id, id 0 is never used by sqlite."""
+    scores: MutableSequence[float]
+    depths: MutableSequence[int]
+    visits: MutableSequence[int]
+    legal_move_counts: MutableSequence[int]
+    expanded_counts: MutableSequence[int]
+    terminals: MutableSequence[int]
+    parents: MutableSequence[int]
+    parent_moves: MutableSequence[int]
+    pvs: List[str]
+    # The block of edge slots of each position
+    child_starts: MutableSequence[int]
+    child_capacities: MutableSequence[int]
+    child_counts: MutableSequence[int]
+
+    @staticmethod
+    def create() -> _Positions:
+        """The arrays of a tree without positions."""
+        return _Positions(
+            array('f', [0.0]), array('H', [0]), array('I', [0]), array('B', [0]), array('H', [0]), array('B', [0]),
+            array('i', [_NO_POSITION]), array('H', [0]), [''], array('I', [0]), array('H', [0]), array('H', [0]))
+
+
+class _Edges(NamedTuple):
+    """The slots of the children of every position, each child with the packed move which leads to it."""
+    children: MutableSequence[int]
+    moves: MutableSequence[int]
+
+
+class _Changes(NamedTuple):
+    """Changes to positions which were already written, and edges and analyses which were not written."""
+    changed_ids: Set[int]
+    new_edges: List[Tuple[int, int, str]]
+    new_engine_analyses: List[Tuple[int, analysis.EngineAnalysis]]
+
+
+class _FenIndex:
+    """An open addressing hash table from the keys of fens to position ids."""
+
+    def __init__(self, size: int = _INITIAL_INDEX_SIZE) -> None:
+        self.keys = array('q', [0] * size)
+        self.ids = array('i', [_NO_POSITION] * size)
+        self.count = 0
+
+    def add(self, fen: str, position_id: int) -> None:
+        """Adds the id of a position, growing the table when it is two thirds full."""
+        if 3 * (self.count + 1) > 2 * len(self.ids):
+            self._grow()
+        self._insert_key(fen_key(fen), position_id)
+        self.count += 1
+
+    def _insert_key(self, key: int, position_id: int) -> None:
+        """Stores a key in the first free slot from its hash."""
+        mask = len(self.ids) - 1
+        slot = key & mask
+        while self.ids[slot] != _NO_POSITION:
+            slot = (slot + 1) & mask
+        self.keys[slot] = key
+        self.ids[slot] = position_id
+
+    def _grow(self) -> None:
+        """Doubles the size of the table and reinserts every key."""
+        entries = [(key, position_id) for key, position_id in zip(self.keys, self.ids) if position_id != _NO_POSITION]
+        size = 2 * len(self.ids)
+        self.keys = array('q', [0] * size)
+        self.ids = array('i', [_NO_POSITION] * size)
+        for key, position_id in entries:
+            self._insert_key(key, position_id)
+
+    def find(self, fen: str, fen_of: Callable[[int], str]) -> Optional[int]:
+        """The id of the position with a fen. Keys may collide, so the fen of a matching key is compared."""
+        key = fen_key(fen)
+        mask = len(self.ids) - 1
+        slot = key & mask
+        while self.ids[slot] != _NO_POSITION:
+            if self.keys[slot] == key and fen_of(self.ids[slot]) == fen:
+                return self.ids[slot]
+            slot = (slot + 1) & mask
+        return None
+
+
+class MemoryTree(db_wrapper.Database):
+    """A database which keeps the positions of the tree in memory and writes them to sqlite at each checkpoint.
+
+    The whole tree is read when the database is opened. Writes to the tree only change memory, and the positions which
+    were changed since the last checkpoint are written in bulk when the next checkpoint is reached, so a crash loses
+    the same writes as it would with the sqlite database. Writes which also change the frontier in sqlite change memory
+    once the frontier has been written, so a write which fails leaves memory as it was.
+    """
+
+    def __init__(self, path: Optional[str] = None, checkpoint_interval: int = 1) -> None:
+        super().__init__(path, checkpoint_interval)
+        self._positions = _Positions.create()
+        self._edges = _Edges(array('I'), array('H'))
+        self._index = _FenIndex()
+        # Fens which cannot be recomputed from a parent
+        self._fens: Dict[int, str] = {}
+        self._fen = functools.lru_cache(maxsize=FEN_CACHE_SIZE)(self._compute_fen)
+        # Positions from first_unflushed_id on have not been written at all
+        self._first_unflushed_id = 1
+        self._changes = _Changes(set(), [], [])
+        self._load()
+
+    def _load(self) -> None:
+        """Reads every position and edge from sqlite."""
+        positions = self._positions
+        cursor = self._tuple_cursor()
+        fens: Dict[int, str] = {}
+        for row in cursor.execute(f'SELECT {db_wrapper.POSITION_COLUMNS} FROM openings ORDER BY openings.id'):
+            position = Position(*row)
+            position_id = typing.cast(int, position.position_id)
+            self._allocate(position_id)
+            self._set_position(position_id, position)
+            positions.parents[position_id] = _NO_PARENT
+            positions.visits[position_id] = position.visits
+            positions.expanded_counts[position_id] = position.expanded_count
+            self._index.add(position.fen, position_id)
+            fens[position_id] = position.fen
+        edges = cursor.execute('SELECT parent_id, child_id, move FROM game_dag ORDER BY rowid').fetchall()
+        child_counts: Dict[int, int] = {}
+        for parent_id, _, _ in edges:
+            child_counts[parent_id] = child_counts.get(parent_id, 0) + 1
+        for parent_id, child_count in child_counts.items():
+            self._allocate_children(parent_id, max(child_count, positions.legal_move_counts[parent_id]))
+        for parent_id, child_id, move in edges:
+            self._append_child(parent_id, child_id, encode_move(move))
+            if positions.parents[child_id] == _NO_PARENT and self._fen_after(fens[parent_id], move) == fens[child_id]:
+                positions.parents[child_id] = parent_id
+                positions.parent_moves[child_id] = encode_move(move)
+        self._fens = {
+            position_id: fen for position_id, fen in fens.items() if positions.parents[position_id] == _NO_PARENT
+        }
+        self._first_unflushed_id = len(positions.parents)
+
+    ## The arrays of positions and edges
+
+    def _allocate(self, position_id: int) -> None:
+        """Extends the position arrays up to an id, the ids of positions which have been deleted are left empty."""
+        positions = self._positions
+        while len(positions.parents) <= position_id:
+            positions.scores.append(0.0)
+            for values in (positions.depths, positions.visits, positions.legal_move_counts, positions.expanded_counts,
+                           positions.terminals, positions.parent_moves, positions.child_starts,
+                           positions.child_capacities, positions.child_counts):
+                values.append(0)
+            positions.parents.append(_NO_POSITION)
+            positions.pvs.append('')
+
+    def _set_position(self, position_id: int, position: Position) -> None:
+        """Sets the analysis of a position and the bookkeeping which is written once when it is created."""
+        positions = self._positions
+        positions.scores[position_id] = position.score
+        positions.depths[position_id] = position.depth
+        positions.pvs[position_id] = position.pv
+        positions.legal_move_counts[position_id] = position.legal_move_count
+        positions.terminals[position_id] = position.terminal
+
+    def _allocate_children(self, parent_id: int, capacity: int) -> None:
+        """Moves the children of a position to a new block of slots at the end of the edge arrays.
+
+        Old blocks are not reused. They are only left behind by positions with more children than legal moves.
+        """
+        positions = self._positions
+        start = positions.child_starts[parent_id]
+        count = positions.child_counts[parent_id]
+        positions.child_starts[parent_id] = len(self._edges.children)
+        positions.child_capacities[parent_id] = capacity
+        for values in self._edges:
+            values.extend(values[start:start + count])
+            values.extend([0] * (capacity - count))
+
+    def _append_child(self, parent_id: int, child_id: int, move_code: int) -> None:
+        """Adds a child to the block of a position, moving the block when it is full."""
+        positions = self._positions
+        count = positions.child_counts[parent_id]
+        capacity = positions.child_capacities[parent_id]
+        if count == capacity:
+            self._allocate_children(parent_id, max(positions.legal_move_counts[parent_id], 2 * capacity, 1))
+        slot = positions.child_starts[parent_id] + count
+        self._edges.children[slot] = child_id
+        self._edges.moves[slot] = move_code
+        positions.child_counts[parent_id] = count + 1
+
+    def _has_position(self, position_id: int) -> bool:
+        """Whether an id is the id of a position in the tree."""
+        return 0 <= position_id < len(self._positions.parents) and self._positions.parents[position_id] != _NO_POSITION
+
+    def _position(self, position_id: int, fen: Optional[str] = None) -> Position:
+        """The position with an id, recomputing its fen unless it is given."""
+        positions = self._positions
+        return Position(
+            position_id, fen if fen is not None else self._fen(position_id), positions.scores[position_id],
+            positions.depths[position_id], positions.pvs[position_id], positions.visits[position_id],
+            positions.legal_move_counts[position_id], positions.expanded_counts[position_id],
+            positions.terminals[position_id])
+
+    def memory_usage(self) -> int:
+        """The number of bytes used by the arrays of positions, edges and the index, which excludes fens and pvs."""
+        arrays: List[Any] = [values for values in self._positions if isinstance(values, array)]
+        arrays.extend(self._edges)
+        arrays.extend([self._index.keys, self._index.ids])
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    def __enter__(self) -> MemoryTree:
+        return self
+
+    def __len__(self) -> int:
+        return self._index.count
+
+    ## Fens and the index
+
+    @staticmethod
+    def _fen_after(fen: str, move: str) -> str:
+        """The fen of the position after a move in uci notation."""
+        board = chess.Board(fen)
+        board.push(chess.Move.from_uci(move))
+        return board.fen()  # type: ignore
+
+    def _compute_fen(self, position_id: int) -> str:
+        """The fen of a position, made from the fen of its first parent unless it is kept."""
+        if position_id in self._fens:
+            return self._fens[position_id]
+        return self._fen_after(
+            self._fen(self._positions.parents[position_id]), decode_move(self._positions.parent_moves[position_id]))
+
+    def _find(self, fen: str) -> Optional[int]:
+        """The id of the position with a fen."""
+        return self._index.find(fen, self._fen)
+
+    ## Writes, which change the frontier in sqlite and then memory
+
+    def _check_parent(self, parent_id: int) -> None:
+        """Rejects an edge from a position which is not in the tree before anything has been written."""
+        if not self._has_position(parent_id):
+            raise ValueError(f'Unknown parent position {parent_id}')
+
+    def _increment_expanded_count(self, parent_id: int) -> None:
+        """Count one more move of a position as expanded in memory."""
+        self._positions.expanded_counts[parent_id] += 1
+        self._changes.changed_ids.add(parent_id)
+
+    def _add_edge(self, parent_id: int, child_id: int, move: str) -> None:
+        """Link a child to its parent in memory, the frontier entry of the move is removed by the caller."""
+        self._append_child(parent_id, child_id, encode_move(move))
+        self._increment_expanded_count(parent_id)
+        self._changes.new_edges.append((parent_id, child_id, move))
+
+    def _insert_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[analysis.EngineAnalysis]) -> Position:
+        """Inserts a position into the tree, the fen of a child is only kept when it cannot be recomputed."""
+        if self._find(position.fen) is not None:
+            raise sqlite3.IntegrityError(f'Position \'{position.fen}\' already exists')
+        # The fen of a child is recomputed from its parent unless the move does not lead to it
+        fen_from_parent = False
+        if parent_child_relation is not None:
+            (parent_id, move) = parent_child_relation
+            self._check_parent(parent_id)
+            with contextlib.suppress(ValueError):
+                fen_from_parent = self._fen_after(self._fen(parent_id), move) == position.fen
+        positions = self._positions
+        with self._write():
+            if parent_child_relation is not None:
+                self._remove_from_frontier(*parent_child_relation)
+            child_id = len(positions.parents)
+            self._allocate(child_id)
+            self._set_position(child_id, position)
+            positions.parents[child_id] = _NO_PARENT
+            if parent_child_relation is not None:
+                (parent_id, move) = parent_child_relation
+                if fen_from_parent:
+                    positions.parents[child_id] = parent_id
+                    positions.parent_moves[child_id] = encode_move(move)
+                self._add_edge(parent_id, child_id, move)
+            if not fen_from_parent:
+                self._fens[child_id] = position.fen
+            self._index.add(position.fen, child_id)
+            self._changes.new_engine_analyses.extend((child_id, engine_analysis) for engine_analysis in engine_analyses)
+        return position.with_position_id(child_id)
+
+    def _deepen_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[analysis.EngineAnalysis]) -> Position:
+        """Replaces the analysis of a position in memory once its frontier entry has been removed."""
+        position_id = typing.cast(int, position.position_id)
+        with self._write():
+            if parent_child_relation is not None:
+                self._remove_from_frontier(*parent_child_relation)
+            self._update_analysis(position_id, position)
+            self._changes.new_engine_analyses.extend(
+                (position_id, engine_analysis) for engine_analysis in engine_analyses)
+        return position
+
+    def insert_transposition(self, parent_child_relation: Tuple[int, str], child_id: int) -> None:
+        """Link an existing position as the child of another position."""
+        (parent_id, move) = parent_child_relation
+        self._check_parent(parent_id)
+        with self._write():
+            self._remove_from_frontier(parent_id, move)
+            self._add_edge(parent_id, child_id, move)
+
+    def _update_analysis(self, position_id: int, position: Position) -> None:
+        """Sets the score, depth and pv of a position in memory."""
+        positions = self._positions
+        positions.scores[position_id] = position.score
+        positions.depths[position_id] = position.depth
+        positions.pvs[position_id] = position.pv
+        self._changes.changed_ids.add(position_id)
+
+    def update_position(self, position: Position) -> Optional[Position]:
+        """Update the analysis of a position in the tree."""
+        position_id = typing.cast(int, position.position_id)
+        if not self._has_position(position_id):
+            return None
+        with self._write():
+            self._update_analysis(position_id, position)
+        return self._position(position_id)
+
+    def increment_visits(self, position_id: int, priority_penalty: float = 0.0) -> None:
+        """Record that the search passed through a position, lowering the priority of its pending moves."""
+        with self._write():
+            if priority_penalty:
+                self._lower_pending_priority(position_id, priority_penalty)
+            self._positions.visits[position_id] += 1
+            self._changes.changed_ids.add(position_id)
+
+    ## Reads from memory
+
+    def get_position(self, fen: str) -> Optional[Position]:
+        """Retrieve a position from the tree."""
+        position_id = self._find(fen)
+        return self._position(position_id, fen) if position_id is not None else None
+
+    def get_child_positions(self, parent_id: int) -> Dict[str, Position]:
+        """Retrieve the child positions of a position keyed by move."""
+        positions: Dict[str, Position] = {}
+        start = self._positions.child_starts[parent_id]
+        for slot in range(start, start + self._positions.child_counts[parent_id]):
+            positions[decode_move(self._edges.moves[slot])] = self._position(self._edges.children[slot])
+        return positions
+
+    def get_positions(self, fens: Iterable[str]) -> Dict[str, Position]:
+        """Retrieve the positions with the given fens, keyed by fen. Fens which are not stored are left out."""
+        positions: Dict[str, Position] = {}
+        for fen in fens:
+            position = self.get_position(fen)
+            if position is not None:
+                positions[fen] = position
+        return positions
+
+    def get_children_many(self, parent_ids: Iterable[int]) -> Dict[int, Dict[str, Position]]:
+        """Retrieve the child positions of each parent keyed by parent id and then by move."""
+        return {parent_id: self.get_child_positions(parent_id) for parent_id in parent_ids}
+
+    def get_engine_analyses(self, position_id: int) -> List[analysis.EngineAnalysis]:
+        """Retrieve the analysis of each engine which analyzed a position."""
+        self._flush()
+        return super().get_engine_analyses(position_id)
+
+    def query(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query against sqlite once the changes in memory have been written to it."""
+        self._flush()
+        return super().query(sql, parameters)
+
+    def query_tuples(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query against sqlite once the changes in memory have been written to it."""
+        self._flush()
+        return super().query_tuples(sql, parameters)
+
+    def claim_pending_expansions(self, count: int) -> List[analysis.FrontierEntry]:
+        """Mark the count pending expansions with the highest priority as in flight and return them."""
+        cursor = self._db.execute(
+            'SELECT parent_id, move, stage '
+            'FROM frontier '
+            'WHERE status = ? '
+            'ORDER BY priority DESC, claimed_at, rowid '
+            'LIMIT ?', (db_wrapper.FRONTIER_PENDING, count))
+        entries = [
+            analysis.FrontierEntry(row['parent_id'], row['move'], self._fen(row['parent_id']), row['stage'])
+            for row in cursor
+        ]
+        if entries:
+            self.claim_expansions(ParentRelationship(entry.parent_id, entry.move) for entry in entries)
+        return entries
+
+    ## Writing changes to sqlite
+
+    def _flush(self) -> None:
+        """Writes the positions, edges and analyses which changed since the last flush to sqlite in bulk."""
+        if not self._db.in_transaction:
+            self._db.execute('BEGIN')
+        first_new_id = self._first_unflushed_id
+        self._db.executemany(
+            'INSERT INTO openings '
+            '(id, fen, score, depth, pv, visits, legal_move_count, expanded_count, fully_expanded, terminal) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                (
+                    position.position_id, position.fen, position.score, position.depth, position.pv, position.visits,
+                    position.legal_move_count, position.expanded_count, position.is_fully_expanded(), position.terminal)
+                for position in (
+                    self._position(position_id)
+                    for position_id in range(first_new_id, len(self._positions.parents))
+                    if self._has_position(position_id))
+            ])
+        # The fens of positions which were already written do not need to be recomputed
+        self._db.executemany(
+            'UPDATE openings SET score = ?, depth = ?, pv = ?, visits = ?, expanded_count = ?, fully_expanded = ? '
+            'WHERE id = ?', [
+                (
+                    position.score, position.depth, position.pv, position.visits, position.expanded_count,
+                    position.is_fully_expanded(), position.position_id) for position in (
+                        self._position(position_id, '')
+                        for position_id in sorted(self._changes.changed_ids)
+                        if position_id < first_new_id)
+            ])
+        self._db.executemany('INSERT INTO game_dag VALUES (?, ?, ?)', self._changes.new_edges)
+        self._db.executemany(
+            'INSERT INTO engine_analysis VALUES (?, ?, ?, ?, ?)', [
+                (
+                    position_id, engine_analysis.nickname, engine_analysis.score, engine_analysis.depth,
+                    engine_analysis.pv) for position_id, engine_analysis in self._changes.new_engine_analyses
+            ])
+        self._first_unflushed_id = len(self._positions.parents)
+        for changes in self._changes:
+            changes.clear()
+
+    def checkpoint(self) -> None:
+        """Write the changes in memory to sqlite and commit them."""
+        self._flush()
+        super().checkpoint()
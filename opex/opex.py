@@ -2,102 +2,203 @@
 
 #!/usr/bin/env python3
 
+from __future__ import annotations  # PEP 563
+
+import argparse
+import asyncio
+from concurrent import futures
+import contextlib
+import functools
 import json
 import os
+import sys
+import time
 
 import chess
 from chess import engine
-from chess import Move
 
+from opex import annotate
+from opex import autotune
 from opex import db_wrapper
+from opex import distributed
+from opex import dump
+from opex import engines
+from opex import file_watcher
+from opex import memory_tree
+from opex import prune
+from opex import query
+from opex import query_server
+from opex import recompute
+from opex import search
 from opex import settings_loader
+from opex import sharded_database
+from opex import supervisor
+from opex.analysis import EngineAnalysis
 from opex.analysis import ParentRelationship
-from opex.analysis import Position
+from opex.settings_loader import EngineSettings
 from opex.settings_loader import Json
+from opex.settings_loader import Settings
 
 import typing
-from typing import Dict, List
-
-
-def get_fen(board: chess.Board) -> str:
-    return board.fen()  # type: ignore
-
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-# def back_propagate(position):
-#     # TODO
-#     pass
+SETTINGS_FILE_NAME = 'opex-settings.json'
 
+# The commands which analyze positions with the configured engines, None being explore
+ENGINE_COMMANDS = [None, 'explore', 'worker', 'autotune']
 
-def select_child_move(children: Dict[str, Position]) -> str:
-    # TODO make this smarter
-    return next(iter(children.keys()))
+# Settings whose changes are applied to a running exploration
+LIVE_SETTINGS = ['engine_options_directory', 'engines']
 
 
 class OpeningExplorer:
-    """Uses a uci engine to create analysis which is then stored in a databse."""
-
-    def __init__(self, database: db_wrapper.Database, uci_engine: engine.SimpleEngine) -> None:
+    """Uses uci engines to create analysis which is then stored in a databse.
+
+    In ensemble mode every engine analyzes the same position and the results are reconciled into a single score.
+    Otherwise the positions selected by a search are split between the engines and analyzed concurrently.
+
+    Engines are supervised, and engines with a reopener are restarted when they crash or hang. A position which an
+    engine fails to analyze is returned to the frontier to be analyzed again later.
+
+    Engines may be added, removed and configured between searches.
+    """
+
+    def __init__(
+        self,
+        database: db_wrapper.Database,
+        uci_engines: Dict[str, engine.SimpleEngine],
+        ensemble: bool = False,
+        reconciliation_policy: str = 'deepest',
+        analysis_depth: int = engines.ANALYSIS_DEPTH,
+        screen: Optional[search.Screen] = None,
+        early_stop: Optional[engines.EarlyStop] = None,
+        engine_reopeners: Optional[Dict[str, Callable[[], engine.SimpleEngine]]] = None,
+        supervisor_policy: supervisor.SupervisorPolicy = supervisor.SupervisorPolicy()
+    ) -> None:
         self.database = database
-        self.uci_engine = uci_engine
-
-    def analyze_board(self, board: chess.Board):
-        """Analyzes the board with the uci_engine and creates a Position."""
-        print('Analyzing')
-        info = self.uci_engine.analyse(board, engine.Limit(depth=20))
-        assert 'score' in info and 'pv' in info
-        pv = ' '.join([str(move) for move in info['pv']])
-        score = info['score'].relative.score(mate_score=10000)
-        print(f'score={score}, pv={pv}')
-        return Position(None, get_fen(board), score, 20, pv)
+        self.ensemble = ensemble
+        self.early_stop = early_stop
+        self.tree_search = search.TreeSearch(database, reconciliation_policy, analysis_depth, screen)
+        self._supervisor_policy = supervisor_policy
+        engine_reopeners = engine_reopeners or {}
+        self.supervisors = {
+            nickname:
+            supervisor.EngineSupervisor(nickname, uci_engine, engine_reopeners.get(nickname), supervisor_policy)
+            for nickname, uci_engine in uci_engines.items()
+        }
+        self._executor = futures.ThreadPoolExecutor(max_workers=len(uci_engines))
+
+    def close(self) -> None:
+        """Stops analyzing and closes the engines which the explorer opened."""
+        self._executor.shutdown()
+        for engine_supervisor in self.supervisors.values():
+            engine_supervisor.close()
+
+    def __enter__(self) -> OpeningExplorer:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, exc_traceback: Any) -> None:
+        self.close()
+
+    @property
+    def uci_engines(self) -> Dict[str, engine.SimpleEngine]:
+        """The engine of each nickname, which is replaced when its supervisor restarts it."""
+        return {nickname: engine_supervisor.uci_engine for nickname, engine_supervisor in self.supervisors.items()}
+
+    ## Methods for changing the engines between searches
+
+    def _resize_executor(self) -> None:
+        """Replaces the executor with one which has a thread for each engine."""
+        self._executor.shutdown()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max(len(self.uci_engines), 1))
+
+    def add_engine(self, nickname: str, open_engine: Callable[[], engine.SimpleEngine]) -> None:
+        """Opens an engine and adds it to the engines, which close it when it is removed or they are closed."""
+        if nickname in self.supervisors:
+            raise ValueError(f'Engine \'{nickname}\' already added')
+        self.supervisors[nickname] = supervisor.EngineSupervisor(
+            nickname, open_engine(), open_engine, self._supervisor_policy, owns_engine=True)
+        self._resize_executor()
+
+    def remove_engine(self, nickname: str) -> None:
+        """Stops analyzing with an engine and closes it."""
+        if nickname not in self.supervisors:
+            raise ValueError(f'Unknown engine \'{nickname}\'')
+        self.supervisors.pop(nickname).uci_engine.close()
+        self._resize_executor()
+
+    def configure_engine(
+            self,
+            nickname: str,
+            options: engine.ConfigMapping,
+            reopen: Optional[Callable[[], engine.SimpleEngine]] = None) -> None:
+        """Changes options of an engine, and how it is reopened if it is restarted."""
+        if nickname not in self.supervisors:
+            raise ValueError(f'Unknown engine \'{nickname}\'')
+        self.supervisors[nickname].configure(options, reopen)
+
+    ## Methods for analyzing positions
+
+    def analyze_boards(self, boards: List[Tuple[str, chess.Board, int]]) -> List[Optional[EngineAnalysis]]:
+        """Analyzes each board to its depth with its paired engine concurrently, with None where the engine failed."""
+        analysis_futures = [
+            self._executor.submit(self.supervisors[nickname].analyze_board, board.copy(), depth, self.early_stop)
+            for nickname, board, depth in boards
+        ]
+        analyses: List[Optional[EngineAnalysis]] = []
+        for future in analysis_futures:
+            try:
+                analyses.append(future.result())
+            except supervisor.EngineFailure as error:
+                print(error)
+                analyses.append(None)
+        return analyses
+
+    def health(self) -> Dict[str, supervisor.EngineHealth]:
+        """The health of each engine."""
+        return {nickname: engine_supervisor.health() for nickname, engine_supervisor in self.supervisors.items()}
+
+    def requeue(self, expansion: search.Expansion) -> None:
+        """Returns an expansion which could not be analyzed to the frontier, or gives it up after too many failures."""
+        if self.tree_search.requeue(expansion):
+            (parent_id, move) = typing.cast(ParentRelationship, expansion.relationship)
+            print(f'Gave up {move} from position {parent_id}')
+
+    def expansions_per_search(self) -> int:
+        """The number of positions analyzed concurrently by one search."""
+        return 1 if self.ensemble else len(self.uci_engines)
 
     def search(self, board: chess.Board) -> None:
-        """Recursive tree search."""
-        print('Searching root')
-        position = self.database.get_position(get_fen(board))
-
-        if position is None:
-            # This position has no known parent/child (may be root).
-            # Analyze and insert the root position for this subtree.
-            self.database.insert_position(self.analyze_board(board), None)
-            return
-
-        self.search_position(board, position)
-
-    def search_position(self, board: chess.Board, position: Position) -> None:
-        """Recursive tree search with an already loaded position."""
-        print('Searching position')
-        position_id = typing.cast(int, position.position_id)
-
-        children = self.database.get_child_positions(position_id)
-        legal_moves = list(board.legal_moves)
-
-        if len(children) == len(legal_moves):
-            # This position is full, recurse on one of the children
-            move = select_child_move(children)
-            print(f'Making move {move}')
-            board.push(Move.from_uci(move))
-            self.search_position(board, children[move])
-            board.pop()
-            print('pop move')
+        """Selects positions from the tree, analyzes them and stores the analysis."""
+        expansions = self.tree_search.select_expansions(board, self.expansions_per_search())
+        for expansion in expansions:
+            if expansion.relationship is not None:
+                print(f'Making move {expansion.relationship.move}')
+        self.expand(expansions)
+
+    def expand(self, expansions: List[search.Expansion]) -> None:
+        """Analyzes and stores expansions.
+
+        In ensemble mode each position is analyzed by every engine, otherwise each by a different engine.
+        """
+        if self.ensemble:
+            for expansion in expansions:
+                analyses = self.analyze_boards(
+                    [(nickname, expansion.board, expansion.depth) for nickname in self.uci_engines])
+                if None in analyses:
+                    self.requeue(expansion)
+                else:
+                    self.tree_search.store_analysis(expansion, typing.cast(List[EngineAnalysis], analyses))
             return
 
-        unanalyzed_moves = [move for move in legal_moves if move.uci() not in children]
-        move = unanalyzed_moves[0]
-        print(f'Making move {move}')
-        board.push(move)
-        self.database.insert_position(self.analyze_board(board), ParentRelationship(position_id, move.uci()))
-        print('pop move')
-        board.pop()
-        if len(unanalyzed_moves) == 1:
-            print('Back progogate')
-            # TODO back propogate (unmake move ?)
-
-
-def open_engine_with_options(path: str, options: engine.ConfigMapping):
-    """Opens UCI engine with the specified dictionary of opening options."""
-    uci_engine = engine.SimpleEngine.popen_uci(path)
-    uci_engine.configure(options)
-    return uci_engine
+        boards = [
+            (nickname, expansion.board, expansion.depth) for nickname, expansion in zip(self.uci_engines, expansions)
+        ]
+        for expansion, engine_analysis in zip(expansions, self.analyze_boards(boards)):
+            if engine_analysis is None:
+                self.requeue(expansion)
+            else:
+                self.tree_search.store_analysis(expansion, [engine_analysis])
 
 
 def ensure_file_exists(file_path: str) -> None:
@@ -110,65 +211,560 @@ def ensure_file_exists(file_path: str) -> None:
             file.write('')
 
 
-def load_settings() -> Json:
-    """Loads json settings."""
-    ensure_file_exists('opex-settings.json')
-    with open('opex-settings.json', 'r+') as settings_file:
+def load_settings(settings_path: str = SETTINGS_FILE_NAME, command: Optional[str] = None) -> Settings:
+    """Loads json settings, writing any missing keys to the file, and checks the settings which a command uses."""
+    ensure_file_exists(settings_path)
+    with open(settings_path, 'r+') as settings_file:
         settings_simple = settings_loader.load_settings_simple(settings_file)
-        settings_file.seek(0)
-        settings_no_defaults = settings_loader.load_settings(settings_file, False)
-        settings_file.seek(0)
+        settings_no_defaults = settings_loader.merge_default_settings(settings_simple, False)
         if settings_simple != settings_no_defaults:
-            json.dump(settings_no_defaults, settings_file, indent=4, sort_keys=True)
             settings_file.seek(0)
-        return settings_loader.load_settings(settings_file)
+            settings_file.truncate()
+            json.dump(settings_no_defaults, settings_file, indent=4, sort_keys=True)
+    settings = settings_loader.merge_default_settings(settings_simple)
+    check_settings(settings, command)
+    return settings_loader.parse_settings(settings)
+
+
+def engine_options_path_of(settings: Settings, nickname: str) -> str:
+    """The path of the options file of an engine."""
+    engine_options_directory = settings.engine_options_directory
+    return f'{engine_options_directory}\\{nickname}.uci'
+
+
+def default_engine_options(path: str) -> List[engine.Option]:
+    """Starts an engine to read its options and their defaults."""
+    with engine.SimpleEngine.popen_uci(path) as uci_engine:
+        return list(uci_engine.options.values())
+
+
+def load_engine_options_of(
+        settings: Settings, nickname: str, default_options: List[engine.Option]) -> engine.ConfigMapping:
+    """Loads the options of an engine which differ from their defaults, writing every option to its options file."""
+    options_file_path = engine_options_path_of(settings, nickname)
+    ensure_file_exists(options_file_path)
+    with open(options_file_path, 'r+') as options_file:
+        simple_options = settings_loader.load_engine_options_simple(options_file)
+        settings_loader.check_engine_options(default_options, simple_options)
+        options_file.seek(0)
+        options_with_defaults = settings_loader.load_engine_options(default_options, options_file, False)
+        options_file.seek(0)
+        if simple_options != options_with_defaults:
+            options_file.writelines(settings_loader.engine_options_file_lines(default_options, options_with_defaults))
+            options_file.seek(0)
+        return settings_loader.load_engine_options(default_options, options_file)
 
 
-def load_all_engine_options(settings: Json) -> Dict[str, engine.ConfigMapping]:
+def load_all_engine_options(settings: Settings) -> Dict[str, engine.ConfigMapping]:
     """Loads engine options."""
-    engine_options: Dict[str, engine.ConfigMapping] = {}
-    for engine_setting in typing.cast(List[Json], settings['engines']):
+    return {nickname: engine_settings.options for nickname, engine_settings in load_engine_settings(settings).items()}
+
+
+def load_engine_settings(
+        settings: Settings,
+        default_options_of: Callable[[str], List[engine.Option]] = default_engine_options) -> Dict[str, EngineSettings]:
+    """Checks the engines of the settings and loads each with its options.
+
+    The defaults of the options of an engine are read from the engine at its path by default_options_of.
+    """
+    engine_settings_list = settings.engines
+    settings_loader.check_engine_settings(engine_settings_list)
+    engine_settings: Dict[str, EngineSettings] = {}
+    for engine_setting in engine_settings_list:
         nickname = typing.cast(str, engine_setting['nickname'])
         path = typing.cast(str, engine_setting['path'])
-        with engine.SimpleEngine.popen_uci(path) as uci_engine:
-            default_options = [option for _, option in uci_engine.options.items()]
-        engine_options_directory = settings['engine_options_directory']
-        options_file_path = f'{engine_options_directory}\\{nickname}.uci'
-        ensure_file_exists(options_file_path)
-        with open(options_file_path, 'r+') as options_file:
-            simple_options = settings_loader.load_engine_options_simple(options_file)
-            settings_loader.check_engine_options(default_options, simple_options)
-            options_file.seek(0)
-            options_with_defaults = settings_loader.load_engine_options(default_options, options_file, False)
-            options_file.seek(0)
-            if simple_options != options_with_defaults:
-                options_file.writelines(
-                    settings_loader.engine_options_file_lines(default_options, options_with_defaults))
-                options_file.seek(0)
-            engine_options[nickname] = settings_loader.load_engine_options(default_options, options_file)
-    return engine_options
+        options = load_engine_options_of(settings, nickname, default_options_of(path))
+        engine_settings[nickname] = EngineSettings(nickname, path, options)
+    return engine_settings
+
+
+def load_screen(settings: Settings) -> search.Screen:
+    """Loads the settings of the shallow analysis which decides which moves are analyzed to the full depth."""
+    return search.Screen(settings.screen_depth, settings.screen_window, settings.screen_top_k)
+
+
+def load_early_stop(settings: Settings) -> Optional[engines.EarlyStop]:
+    """Loads when analysis stops before the analysis depth, which is never in fixed depth mode."""
+    if settings.analysis_mode == 'fixed_depth':
+        return None
+    return engines.EarlyStop(
+        settings.early_stop_min_depth, settings.early_stop_stable_depths, settings.early_stop_tolerance,
+        settings.early_stop_decisive_score)
+
+
+def database_path_of(settings: Settings) -> str:
+    """The path of the database in the data directory."""
+    return os.path.join(settings.data_directory, settings.database_file_name)
+
+
+def open_database(settings: Settings, tree_backend: str = 'sqlite') -> db_wrapper.Database:
+    """Opens the database in the data directory, creating it if it does not exist.
+
+    With the memory backend the tree is read into memory and written to the database at each checkpoint. With more
+    than one shard the positions are spread across that many database files, whichever backend is asked for.
+    """
+    os.makedirs(settings.data_directory, exist_ok=True)
+    checkpoint_interval = settings.checkpoint_interval
+    shard_count = settings.shard_count
+    if shard_count > 1:
+        return sharded_database.ShardedDatabase(database_path_of(settings), shard_count, checkpoint_interval)
+    if tree_backend == 'memory':
+        return memory_tree.MemoryTree(database_path_of(settings), checkpoint_interval)
+    return db_wrapper.Database(database_path_of(settings), checkpoint_interval)
+
+
+def engine_opener(engine_settings: EngineSettings) -> Callable[[], engine.SimpleEngine]:
+    """How to open an engine with its options, which also restarts it."""
+    return functools.partial(engines.open_engine_with_options, engine_settings.path, engine_settings.options)
+
+
+def load_engine_openers(settings: Settings, nicknames: List[str]) -> Dict[str, Callable[[], engine.SimpleEngine]]:
+    """Loads how to open each engine with the given nicknames with its options, which also restarts it."""
+    return {
+        nickname: engine_opener(engine_settings)
+        for nickname, engine_settings in load_engine_settings(settings).items()
+        if nickname in nicknames
+    }
+
+
+def open_engines(stack: contextlib.ExitStack,
+                 openers: Dict[str, Callable[[], engine.SimpleEngine]]) -> Dict[str, engine.SimpleEngine]:
+    """Opens engines, which are closed with the stack."""
+    return {nickname: stack.enter_context(open_engine()) for nickname, open_engine in openers.items()}
+
+
+def load_supervisor_policy(settings: Settings) -> supervisor.SupervisorPolicy:
+    """Loads how long an analysis may take and how engines which fail are restarted."""
+    # A timeout of 0 waits for every analysis for as long as it takes
+    timeout = settings.engine_timeout or None
+    return supervisor.SupervisorPolicy(timeout, settings.engine_max_attempts, settings.engine_restart_backoff)
+
+
+def open_database_and_requeue(stack: contextlib.ExitStack, settings: Settings) -> db_wrapper.Database:
+    """Opens the database and requeues the expansions which were in flight when it was last closed."""
+    database = stack.enter_context(open_database(settings, settings.tree_backend))
+    requeued = database.requeue_in_flight()
+    if requeued:
+        print(f'Requeued {requeued} expansions which were in flight')
+    return database
+
+
+def watched_paths(settings: Settings, settings_path: str = SETTINGS_FILE_NAME) -> List[str]:
+    """The files whose changes are applied to a running exploration."""
+    return [settings_path, settings_loader.DEFAULT_SETTINGS_FILE_NAME] + [
+        engine_options_path_of(settings, typing.cast(str, engine_setting['nickname']))
+        for engine_setting in settings.engines
+    ]
+
+
+def apply_engine_settings(
+        explorer: OpeningExplorer, old_engine_settings: Dict[str, EngineSettings],
+        new_engine_settings: Dict[str, EngineSettings]) -> Dict[str, EngineSettings]:
+    """Adds, removes and configures the engines of an explorer, returning the settings of the engines now running.
+
+    An engine whose path changed is replaced, and an engine whose options changed is configured with only the changed
+    options. An engine which cannot be opened is left out.
+    """
+    running: Dict[str, EngineSettings] = {}
+    for nickname, old_settings in old_engine_settings.items():
+        new_settings = new_engine_settings.get(nickname)
+        if new_settings is None or new_settings.path != old_settings.path:
+            explorer.remove_engine(nickname)
+            print(f'Removed {nickname}')
+    for nickname, new_settings in new_engine_settings.items():
+        old_settings = old_engine_settings.get(nickname)
+        if old_settings is None or new_settings.path != old_settings.path:
+            try:
+                explorer.add_engine(nickname, engine_opener(new_settings))
+            except (engine.EngineError, OSError) as error:
+                print(f'Could not add {nickname}: {error!r}')
+                continue
+            print(f'Added {nickname}')
+        elif new_settings.options != old_settings.options:
+            default_options = list(explorer.supervisors[nickname].uci_engine.options.values())
+            changed_options = settings_loader.changed_engine_options(
+                default_options, old_settings.options, new_settings.options)
+            explorer.configure_engine(nickname, changed_options, engine_opener(new_settings))
+            print(f'Configured {nickname} with {changed_options}')
+        running[nickname] = new_settings
+    return running
+
+
+def reload_settings(
+        explorer: OpeningExplorer,
+        settings: Settings,
+        engine_settings: Dict[str, EngineSettings],
+        settings_path: str = SETTINGS_FILE_NAME) -> Tuple[Settings, Dict[str, EngineSettings]]:
+    """Loads the settings again and applies changes of the engines to a running explorer.
+
+    Changes to other settings are only applied by a restart. If the new settings are not valid the old ones are kept.
+    """
+
+    def default_options_of(path: str) -> List[engine.Option]:
+        for nickname, running_settings in engine_settings.items():
+            if running_settings.path == path and nickname in explorer.supervisors:
+                return list(explorer.supervisors[nickname].uci_engine.options.values())
+        return default_engine_options(path)
+
+    try:
+        new_settings = load_settings(settings_path, 'explore')
+        new_engine_settings = load_engine_settings(new_settings, default_options_of)
+    except (ValueError, engine.EngineError, OSError) as error:
+        print(f'Keeping the previous settings: {error}')
+        return settings, engine_settings
+    restart_keys = [
+        key for key, value, new_value in zip(Settings._fields, settings, new_settings)
+        if key not in LIVE_SETTINGS and value != new_value
+    ]
+    if restart_keys:
+        print(f'Changes to {restart_keys} take effect after a restart')
+    return new_settings, apply_engine_settings(explorer, engine_settings, new_engine_settings)
+
+
+def explore(settings: Settings) -> None:
+    """Explores openings with all configured engines, applying changes of the engines to the settings as it runs."""
+    with contextlib.ExitStack() as stack:
+        engine_settings = load_engine_settings(settings)
+        openers = {nickname: engine_opener(running_settings) for nickname, running_settings in engine_settings.items()}
+        uci_engines = open_engines(stack, openers)
+        database = open_database_and_requeue(stack, settings)
+        ensemble = settings.engine_mode == 'ensemble'
+        reconciliation_policy = settings.reconciliation_policy
+        opex = stack.enter_context(
+            OpeningExplorer(
+                database, uci_engines, ensemble, reconciliation_policy, settings.analysis_depth, load_screen(settings),
+                load_early_stop(settings), openers, load_supervisor_policy(settings)))
+        watcher = file_watcher.FileWatcher(watched_paths(settings))
+        board = chess.Board()
+        while True:
+            opex.search(board)
+            if watcher.changed():
+                settings, engine_settings = reload_settings(opex, settings, engine_settings)
+                watcher.watch(watched_paths(settings))
+
+
+def coordinate(settings: Settings, args: argparse.Namespace) -> None:
+    """Hands out analysis jobs to workers and stores their results."""
+    with contextlib.ExitStack() as stack:
+        database = open_database_and_requeue(stack, settings)
+        tree_search = search.TreeSearch(
+            database, settings.reconciliation_policy, settings.analysis_depth, load_screen(settings))
+        coordinator = distributed.Coordinator(tree_search, args.lease_timeout)
+        with distributed.CoordinatorServer((args.host, args.port), coordinator) as server:
+            print(f'Coordinating workers on {args.host}:{args.port}')
+            server.serve_forever()
+
+
+def work(settings: Settings, args: argparse.Namespace) -> None:
+    """Analyzes jobs from a coordinator with one of the configured engines."""
+    nickname = args.engine or typing.cast(str, settings.engines[0]['nickname'])
+    with contextlib.ExitStack() as stack:
+        openers = load_engine_openers(settings, [nickname])
+        uci_engines = open_engines(stack, openers)
+        if nickname not in uci_engines:
+            raise ValueError(f'Unknown engine \'{nickname}\'')
+        engine_supervisor = supervisor.EngineSupervisor(
+            nickname, uci_engines[nickname], openers[nickname], load_supervisor_policy(settings))
+        stack.callback(engine_supervisor.close)
+        distributed.run_worker(
+            (args.host, args.port), engine_supervisor, args.batch_size, early_stop=load_early_stop(settings))
+
+
+def stats(settings: Settings, args: argparse.Namespace) -> None:
+    """Prints statistics of the tree below a position."""
+    with open_database(settings) as database:
+        root = database.get_position(args.fen)
+        if root is None:
+            print(f'{args.fen} has not been analyzed')
+            return
+        root_id = typing.cast(int, root.position_id)
+        tree_stats = query.get_tree_stats(database, root_id)
+        lines = query.get_principal_lines(database, root_id, args.lines)
+        for line in query.format_tree_stats(tree_stats, lines):
+            print(line)
+
+
+def recompute_scores(settings: Settings, args: argparse.Namespace) -> None:
+    """Recomputes the tree score of every position from the positions below it."""
+    with open_database(settings) as database:
+        start = time.perf_counter()
+        position_count = recompute.recompute_tree_scores(database, args.policy)
+        print(f'Recomputed the tree scores of {position_count} positions in {time.perf_counter() - start:.1f}s')
+
+
+def merge_databases(settings: Settings, args: argparse.Namespace) -> None:
+    """Merges the trees of databases analyzed elsewhere into the database in the data directory."""
+    if settings.shard_count > 1:
+        raise ValueError('Databases cannot be merged into a sharded database')
+    with open_database(settings) as database:
+        for source_path in args.sources:
+            result = database.merge(source_path, args.batch_size)
+            print(f'Merged {source_path}: {result.position_count} new positions, {result.edge_count} new moves')
+
+
+def prune_tree(settings: Settings, args: argparse.Namespace) -> None:
+    """Deletes hopeless moves and the positions which are only reached through them, then compacts the database."""
+    if settings.shard_count > 1:
+        raise ValueError('A sharded database cannot be pruned')
+    with open_database(settings) as database:
+        report = prune.prune_tree(
+            database, database_path_of(settings), args.fen, args.window, args.min_depth,
+            [line.split() for line in args.keep])
+        for line in prune.format_prune_report(report):
+            print(line)
+
+
+def autotune_engines(settings: Settings, args: argparse.Namespace) -> None:
+    """Benchmarks copies, threads and hash of an engine and writes the fastest configuration to the settings."""
+    engine_settings = settings.engines
+    nickname = args.engine or typing.cast(str, engine_settings[0]['nickname'])
+    paths = {
+        typing.cast(str, engine_setting['nickname']): typing.cast(str, engine_setting['path'])
+        for engine_setting in engine_settings
+    }
+    if nickname not in paths:
+        raise ValueError(f'Unknown engine \'{nickname}\'')
+    max_total_hash = args.max_total_hash or autotune.default_max_total_hash()
+    with engine.SimpleEngine.popen_uci(paths[nickname]) as uci_engine:
+        default_options = list(uci_engine.options.values())
+    options = load_all_engine_options(settings)[nickname]
+    configurations = autotune.candidate_configurations(
+        args.cores or os.cpu_count() or 1, args.hash or autotune.DEFAULT_HASH_SIZES, max_total_hash)
+    results = autotune.autotune(
+        functools.partial(engines.open_engine_with_options, paths[nickname]), default_options, options, configurations,
+        autotune.sample_boards(args.positions), settings.analysis_depth, load_early_stop(settings))
+    for line in autotune.format_results(results):
+        print(line)
+    if results and not args.dry_run:
+        best = results[0].configuration
+        write_tuned_engines(
+            settings, nickname, best, autotune.configured_options(default_options, options, best), default_options)
+
+
+def write_tuned_engines(
+        settings: Settings, nickname: str, best: autotune.EngineConfiguration, tuned_options: engine.ConfigMapping,
+        default_options: List[engine.Option]) -> None:
+    """Writes the options of every copy of a tuned engine and adds the copies to the engines of the settings file."""
+    for copy_number in range(1, best.engine_count + 1):
+        with open(engine_options_path_of(settings, autotune.copy_nickname(nickname, copy_number)), 'w') as options_file:
+            options_file.writelines(settings_loader.engine_options_file_lines(default_options, tuned_options))
+    with open(SETTINGS_FILE_NAME, 'r+') as settings_file:
+        user_settings = settings_loader.load_settings_simple(settings_file)
+        user_settings['engines'] = autotune.tuned_engine_settings(settings.engines, nickname, best.engine_count)
+        settings_file.seek(0)
+        settings_file.truncate()
+        json.dump(user_settings, settings_file, indent=4, sort_keys=True)
+    print(f'Configured {best.engine_count} copies of {nickname} with Threads={best.threads} and Hash={best.hash_size}')
+
+
+def serve_queries(settings: Settings, args: argparse.Namespace) -> None:
+    """Answers json queries of the tree over http, alongside a running explorer."""
+    if settings.shard_count > 1:
+        raise ValueError('A sharded database cannot be served')
+    database_path = args.database or database_path_of(settings)
+
+    def started(server: asyncio.Server) -> None:
+        port = server.sockets[0].getsockname()[1]
+        print(f'Serving queries of {database_path} on http://{args.host}:{port}')
+
+    asyncio.run(
+        query_server.serve(
+            database_path, args.host, args.port, args.connections, args.cache_size, args.cache_seconds, started))
+
+
+def dump_tree(settings: Settings, args: argparse.Namespace) -> None:
+    """Streams the database to a compressed dump, alongside a running explorer."""
+    if settings.shard_count > 1 and not args.database:
+        raise ValueError('A sharded database cannot be dumped')
+    database_path = args.database or database_path_of(settings)
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(args.output, 'wb')) if args.output != '-' else sys.stdout.buffer
+        result = dump.dump_database(database_path, output, args.compression, args.chunk_size)
+    print(f'Dumped {dump.format_dump_result(result)}', file=sys.stderr)
+
+
+def restore_tree(settings: Settings, args: argparse.Namespace) -> None:
+    """Loads a dump into a new database."""
+    if settings.shard_count > 1 and not args.database:
+        raise ValueError('A dump cannot be restored into a sharded database')
+    database_path = args.database or database_path_of(settings)
+    os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        dump_input = stack.enter_context(open(args.input, 'rb')) if args.input != '-' else sys.stdin.buffer
+        result = dump.restore_database(dump_input, database_path)
+    print(f'Restored {dump.format_dump_result(result)} into {database_path}', file=sys.stderr)
+
+
+def annotate_games(settings: Settings, args: argparse.Namespace) -> None:
+    """Annotates the games of pgn files with where they left the book and the cost of each book move."""
+    if settings.shard_count > 1 and not args.database:
+        raise ValueError('A sharded database cannot be annotated')
+    database_path = args.database or database_path_of(settings)
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(args.output, 'w', newline='')) if args.output else sys.stdout
+        game_count = annotate.annotate_files(
+            database_path, args.pgn, output, args.format, args.processes, args.batch_size)
+    print(f'Annotated {game_count} games', file=sys.stderr)
+
+
+def add_autotune_arguments(autotune_parser: argparse.ArgumentParser) -> None:
+    """Adds the arguments of the autotune command."""
+    autotune_parser.add_argument('--engine', help='nickname of the engine to tune (default: the first engine)')
+    autotune_parser.add_argument('--cores', type=int, help='cores to use between all copies (default: every core)')
+    autotune_parser.add_argument(
+        '--hash', type=int, action='append', help=f'hash size in MB to try (default: {autotune.DEFAULT_HASH_SIZES})')
+    autotune_parser.add_argument(
+        '--max-total-hash',
+        type=int,
+        help=(
+            'MB of hash which all copies may use between them '
+            f'(default: {autotune.DEFAULT_HASH_MEMORY_FRACTION:.0%} of physical memory)'))
+    autotune_parser.add_argument(
+        '--positions',
+        type=int,
+        choices=range(1,
+                      len(autotune.SAMPLE_LINES) + 1),
+        metavar=f'[1-{len(autotune.SAMPLE_LINES)}]',
+        help='number of sample positions to analyze (default: all)')
+    autotune_parser.add_argument(
+        '--dry-run', action='store_true', help='print the benchmarks without changing the settings')
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line."""
+    parser = argparse.ArgumentParser(prog='opex', description='Chess opening explorer.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('explore', help='explore openings with all configured engines (default)')
+
+    def add_address_arguments(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument('--host', default=distributed.DEFAULT_HOST, help='address of the coordinator')
+        subparser.add_argument('--port', type=int, default=distributed.DEFAULT_PORT, help='port of the coordinator')
+
+    coordinator_parser = subparsers.add_parser('coordinator', help='hand out analysis jobs to workers')
+    add_address_arguments(coordinator_parser)
+    coordinator_parser.add_argument(
+        '--lease-timeout',
+        type=float,
+        default=distributed.DEFAULT_LEASE_TIMEOUT,
+        help='seconds before a job which has not been returned is handed out again')
+
+    worker_parser = subparsers.add_parser('worker', help='analyze jobs from a coordinator')
+    add_address_arguments(worker_parser)
+    worker_parser.add_argument('--engine', help='nickname of the engine to use (default: the first engine)')
+    worker_parser.add_argument('--batch-size', type=int, default=1, help='number of jobs to request at once')
+
+    stats_parser = subparsers.add_parser('stats', help='print statistics of the analyzed tree')
+    stats_parser.add_argument('--fen', default=chess.STARTING_FEN, help='root of the tree (default: starting position)')
+    stats_parser.add_argument('--lines', type=int, default=5, help='number of principal lines to print')
+
+    recompute_parser = subparsers.add_parser('recompute', help='recompute the tree score of every position')
+    recompute_parser.add_argument(
+        '--policy', choices=list(recompute.BACKUP_POLICIES), default='minimax', help='how the scores of moves combine')
+
+    merge_parser = subparsers.add_parser('merge', help='merge databases analyzed elsewhere into this one')
+    merge_parser.add_argument('sources', nargs='+', help='databases to merge')
+    merge_parser.add_argument(
+        '--batch-size', type=int, default=db_wrapper.MERGE_BATCH_SIZE, help='number of rows in each transaction')
+
+    prune_parser = subparsers.add_parser('prune', help='delete hopeless moves and reclaim their space')
+    prune_parser.add_argument(
+        '--window',
+        type=float,
+        default=prune.DEFAULT_WINDOW,
+        help='centipawns behind the best sibling at which a move is hopeless')
+    prune_parser.add_argument('--min-depth', type=int, default=0, help='analysis depth needed to judge a move hopeless')
+    prune_parser.add_argument(
+        '--keep', action='append', default=[], help='line of uci moves from the root which is never pruned')
+    prune_parser.add_argument(
+        '--fen', default=chess.STARTING_FEN, help='root of the kept lines (default: starting position)')
+
+    serve_parser = subparsers.add_parser('serve', help='answer json queries of the analyzed tree over http')
+    serve_parser.add_argument('--host', default=query_server.DEFAULT_HOST, help='address to listen on')
+    serve_parser.add_argument('--port', type=int, default=query_server.DEFAULT_PORT, help='port to listen on')
+    serve_parser.add_argument(
+        '--database', help='database or snapshot of it to read (default: the database in the data directory)')
+    serve_parser.add_argument(
+        '--connections',
+        type=int,
+        default=query_server.DEFAULT_CONNECTIONS,
+        help='number of read only connections looking up positions at once')
+    serve_parser.add_argument(
+        '--cache-size', type=int, default=query_server.DEFAULT_CACHE_SIZE, help='number of positions to cache')
+    serve_parser.add_argument(
+        '--cache-seconds',
+        type=float,
+        default=query_server.DEFAULT_CACHE_SECONDS,
+        help='seconds before a cached position is looked up again')
+
+    annotate_parser = subparsers.add_parser('annotate', help='annotate games with where they left the book')
+    annotate_parser.add_argument('pgn', nargs='+', help='pgn files of the games to annotate')
+    annotate_parser.add_argument('--format', choices=annotate.OUTPUT_FORMATS, default='csv', help='output format')
+    annotate_parser.add_argument('--output', help='file to write the annotated games to (default: standard output)')
+    annotate_parser.add_argument(
+        '--database', help='database or snapshot of it to read (default: the database in the data directory)')
+    annotate_parser.add_argument(
+        '--processes', type=int, help='number of processes annotating games (default: the number of cores)')
+    annotate_parser.add_argument(
+        '--batch-size', type=int, default=annotate.DEFAULT_BATCH_SIZE, help='number of games in each task')
+
+    dump_parser = subparsers.add_parser('dump', help='stream the database to a compressed dump')
+    dump_parser.add_argument('--output', default='-', help='file to write the dump to (default: standard output)')
+    dump_parser.add_argument(
+        '--compression',
+        choices=dump.COMPRESSIONS,
+        default=dump.DEFAULT_COMPRESSION,
+        help='zlib is faster, lzma is smaller')
+    dump_parser.add_argument(
+        '--chunk-size', type=int, default=dump.DEFAULT_CHUNK_SIZE, help='number of rows in each compressed frame')
+    dump_parser.add_argument(
+        '--database', help='database or snapshot of it to dump (default: the database in the data directory)')
+
+    restore_parser = subparsers.add_parser('restore', help='load a dump into a new database')
+    restore_parser.add_argument('input', help='dump to load, or - for standard input')
+    restore_parser.add_argument('--database', help='database to create (default: the database in the data directory)')
+
+    add_autotune_arguments(
+        subparsers.add_parser(
+            'autotune',
+            help='find the number of copies, threads and hash of an engine which analyze the most positions'))
+
+    return parser.parse_args()
+
+
+def check_settings(settings: Json, command: Optional[str]) -> None:
+    """Checks the settings which a command uses, so that commands which do not analyze work without engine settings."""
+    if command in ENGINE_COMMANDS:
+        settings_loader.check_engine_settings(typing.cast(List[Json], settings['engines']))
+        settings_loader.check_ensemble_settings(settings)
+        settings_loader.check_supervisor_settings(settings)
+    settings_loader.check_analysis_settings(settings)
+    settings_loader.check_database_settings(settings)
+
+
+# The function which runs each command other than explore
+COMMANDS: Dict[str, Callable[[Settings, argparse.Namespace], None]] = {
+    'coordinator': coordinate,
+    'worker': work,
+    'stats': stats,
+    'recompute': recompute_scores,
+    'merge': merge_databases,
+    'prune': prune_tree,
+    'serve': serve_queries,
+    'annotate': annotate_games,
+    'dump': dump_tree,
+    'restore': restore_tree,
+    'autotune': autotune_engines,
+}
 
 
 def main():
     """Chess opening explorer."""
-    settings = load_settings()
-
-    # TODO create a type for settings
-    engine_settings = typing.cast(List[Json], settings['engines'])
-
-    settings_loader.check_engine_settings(engine_settings)
-
-    engine_options = load_all_engine_options(settings)
-    first_engine_settings = engine_settings[0]
-
-    engine_path = typing.cast(str, first_engine_settings['path'])
-    nickname = typing.cast(str, first_engine_settings['nickname'])
-    with open_engine_with_options(engine_path, engine_options[nickname]) as uci_engine:
-        with db_wrapper.Database() as database:
-            opex = OpeningExplorer(database, uci_engine)
-            board = chess.Board()
-            while True:
-                opex.search(board)
+    args = parse_args()
+    settings = load_settings(command=args.command)
+    if args.command in COMMANDS:
+        COMMANDS[args.command](settings, args)
+    else:
+        explore(settings)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+"""Pruning of hopeless moves from the tree, with a report of the space and traversal time which it saved."""
+
+import os
+import time
+
+import chess
+
+from opex import db_wrapper
+from opex import query
+from opex.analysis import ParentRelationship
+
+import typing
+from typing import Iterable, List, NamedTuple, Optional
+
+# Moves more than this many centipawns worse than the best sibling are hopeless
+DEFAULT_WINDOW = 300
+
+
+class PruneReport(NamedTuple):
+    """What pruning deleted and what it saved."""
+    result: db_wrapper.PruneResult
+    size_before: int
+    size_after: int
+    # Seconds to traverse the tree below the root, or None if the root is not stored
+    traversal_before: Optional[float]
+    traversal_after: Optional[float]
+
+
+def database_size(path: str) -> int:
+    """The number of bytes of a database and its write ahead log."""
+    return sum(os.path.getsize(file_path) for file_path in [path, f'{path}-wal'] if os.path.isfile(file_path))
+
+
+def line_moves(database: db_wrapper.Database, fen: str, moves: Iterable[str]) -> List[ParentRelationship]:
+    """The moves of a line from a position, up to the first position of the line which is not stored."""
+    board = chess.Board(fen)
+    relationships: List[ParentRelationship] = []
+    for move in moves:
+        parent = database.get_position(board.fen())  # type: ignore
+        if parent is None:
+            break
+        relationships.append(ParentRelationship(typing.cast(int, parent.position_id), move))
+        board.push_uci(move)
+    return relationships
+
+
+def time_traversal(database: db_wrapper.Database, root_fen: str) -> Optional[float]:
+    """The number of seconds to compute the statistics of the tree below a root, which visits every position."""
+    root = database.get_position(root_fen)
+    if root is None:
+        return None
+    start = time.perf_counter()
+    query.get_tree_stats(database, typing.cast(int, root.position_id))
+    return time.perf_counter() - start
+
+
+def prune_tree(
+    database: db_wrapper.Database,
+    path: str,
+    root_fen: str = chess.STARTING_FEN,
+    window: float = DEFAULT_WINDOW,
+    min_depth: int = 0,
+    keep_lines: Iterable[List[str]] = ()) -> PruneReport:
+    """Prunes hopeless moves except those of lines from the root, then compacts the database."""
+    keep = [move for line in keep_lines for move in line_moves(database, root_fen, line)]
+    database.checkpoint()
+    size_before = database_size(path)
+    traversal_before = time_traversal(database, root_fen)
+    result = database.prune(window, min_depth, keep)
+    database.compact()
+    return PruneReport(result, size_before, database_size(path), traversal_before, time_traversal(database, root_fen))
+
+
+def format_prune_report(report: PruneReport) -> List[str]:
+    """Formats a prune report for printing."""
+    output = [
+        f'Hopeless moves: {report.result.edge_count}',
+        f'Positions deleted: {report.result.position_count}',
+        f'Size: {report.size_before / 2**20:.1f} MiB -> {report.size_after / 2**20:.1f} MiB',
+    ]
+    if report.traversal_before is not None and report.traversal_after is not None:
+        output.append(f'Traversal: {report.traversal_before:.3f}s -> {report.traversal_after:.3f}s')
+    return output
@@ -0,0 +1,146 @@
+"""Statistics and queries over the tree of analyzed positions.
+
+Traversals are done in sqlite with recursive common table expressions, so the cost of a query does not include a round
+trip through python for every position.
+"""
+
+from opex import db_wrapper
+
+from typing import Dict, List, NamedTuple
+
+# Principal lines are cut off at this many moves
+MAX_LINE_LENGTH = 60
+
+# Positions reachable from a root, paired with their distance from it. The same fen is always the same number of moves
+# from a root, because the fen includes the move number, so union visits each transposition only once.
+_SUBTREE_CTE = (
+    'WITH RECURSIVE subtree (id, ply) AS ( '
+    '  SELECT ?, 0 '
+    '  UNION '
+    '  SELECT game_dag.child_id, subtree.ply + 1 '
+    '  FROM subtree '
+    '  JOIN game_dag '
+    '  ON game_dag.parent_id = subtree.id) ')
+
+
+class TreeStats(NamedTuple):
+    """A summary of the shape of the tree below a root position."""
+    node_count: int
+    edge_count: int
+    # The number of positions at each distance from the root
+    depth_histogram: Dict[int, int]
+    # The mean number of children of positions which have children
+    branching_factor: float
+    # The fraction of edges which lead to a position that is also reached by another edge
+    transposition_rate: float
+    # The fraction of positions which are not game over and have every legal move analyzed
+    fully_expanded_ratio: float
+
+
+class PrincipalLine(NamedTuple):
+    """A line of best moves from a root position."""
+    moves: List[str]
+    # The score after the first move, from the point of view of the side to move at the root
+    score: float
+
+
+def get_tree_stats(database: db_wrapper.Database, root_id: int) -> TreeStats:
+    """Computes statistics of the positions reachable from a root in a single query."""
+    # Edges are counted in game_dag, since the expanded count of a position still counts the moves which were pruned
+    cursor = database.query(
+        _SUBTREE_CTE + 'SELECT '
+        '  ply, '
+        '  count() AS nodes, '
+        '  sum(child_count) AS edges, '
+        '  sum(child_count > 0) AS parents, '
+        '  sum(terminal = 0) AS not_terminal, '
+        '  sum(terminal = 0 AND fully_expanded) AS fully_expanded '
+        'FROM ( '
+        '  SELECT '
+        '    subtree.ply, '
+        '    openings.terminal, '
+        '    openings.fully_expanded, '
+        '    (SELECT count() FROM game_dag WHERE game_dag.parent_id = subtree.id) AS child_count '
+        '  FROM subtree '
+        '  JOIN openings '
+        '  ON openings.id = subtree.id) '
+        'GROUP BY ply '
+        'ORDER BY ply', (root_id,))
+    depth_histogram: Dict[int, int] = {}
+    edge_count = parent_count = not_terminal_count = fully_expanded_count = 0
+    for row in cursor:
+        depth_histogram[row['ply']] = row['nodes']
+        edge_count += row['edges']
+        parent_count += row['parents']
+        not_terminal_count += row['not_terminal']
+        fully_expanded_count += row['fully_expanded']
+    node_count = sum(depth_histogram.values())
+    # Every position except the root is reached by one edge, the others are transpositions
+    transposition_count = edge_count - max(node_count - 1, 0)
+    return TreeStats(
+        node_count, edge_count, depth_histogram, edge_count / parent_count if parent_count else 0.0,
+        transposition_count / edge_count if edge_count else 0.0,
+        fully_expanded_count / not_terminal_count if not_terminal_count else 0.0)
+
+
+def get_principal_lines(database: db_wrapper.Database,
+                        root_id: int,
+                        count: int,
+                        max_length: int = MAX_LINE_LENGTH) -> List[PrincipalLine]:
+    """Finds the best count moves from a root and follows the best reply to each until the end of the tree.
+
+    Scores are relative to the side to move, so the best move leads to the child with the lowest score. Ties are broken
+    by the move so that lines are stable.
+    """
+    cursor = database.query(
+        'WITH RECURSIVE line (line_number, id, move, score, ply) AS ( '
+        '  SELECT * FROM ( '
+        '    SELECT '
+        '      row_number() OVER (ORDER BY openings.score, game_dag.move), '
+        '      game_dag.child_id, '
+        '      game_dag.move, '
+        '      openings.score, '
+        '      1 '
+        '    FROM game_dag '
+        '    JOIN openings '
+        '    ON openings.id = game_dag.child_id '
+        '    WHERE game_dag.parent_id = ? '
+        '    ORDER BY openings.score, game_dag.move '
+        '    LIMIT ?) '
+        '  UNION ALL '
+        '  SELECT line.line_number, game_dag.child_id, game_dag.move, line.score, line.ply + 1 '
+        '  FROM line '
+        '  JOIN game_dag '
+        '  ON game_dag.rowid = ( '
+        '    SELECT best.rowid '
+        '    FROM game_dag AS best '
+        '    JOIN openings '
+        '    ON openings.id = best.child_id '
+        '    WHERE best.parent_id = line.id '
+        '    ORDER BY openings.score, best.move '
+        '    LIMIT 1) '
+        '  WHERE line.ply < ?) '
+        'SELECT line_number, move, score FROM line ORDER BY line_number, ply', (root_id, count, max_length))
+    lines: Dict[int, PrincipalLine] = {}
+    for row in cursor:
+        if row['line_number'] not in lines:
+            lines[row['line_number']] = PrincipalLine([], -row['score'])
+        lines[row['line_number']].moves.append(row['move'])
+    return list(lines.values())
+
+
+def format_tree_stats(stats: TreeStats, lines: List[PrincipalLine]) -> List[str]:
+    """Formats statistics and principal lines for printing."""
+    output = [
+        f'Positions: {stats.node_count}',
+        f'Edges: {stats.edge_count}',
+        f'Branching factor: {stats.branching_factor:.2f}',
+        f'Transposition rate: {stats.transposition_rate:.2%}',
+        f'Fully expanded: {stats.fully_expanded_ratio:.2%}',
+        'Positions by depth:',
+    ]
+    output.extend(f'  {ply:3d}: {count}' for ply, count in stats.depth_histogram.items())
+    if lines:
+        output.append('Principal lines:')
+        output.extend(f'  {line.score:+7.0f} {" ".join(line.moves)}' for line in lines)
+    return output
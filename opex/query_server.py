@@ -0,0 +1,328 @@
+"""A local read only http server which answers json queries of the analyzed tree, for other services to look up moves.
+
+Requests are read and answered by asyncio on a single thread. Lookups run in a pool of threads, each with its own read
+only connection to the database which memory maps the file, so the server reads what a running explorer has committed
+at its last checkpoint without blocking it. Answers are kept in a least recently used cache, whose entries expire after
+a few seconds so that new analysis is seen.
+
+GET /position?fen=<fen> answers a single position and POST /positions with {"fens": [...]} answers many positions with
+one lookup. GET /stats answers the number of requests and cache hits so far.
+"""
+
+from __future__ import annotations  # PEP 563
+
+import asyncio
+import collections
+from concurrent import futures
+import json
+import threading
+import time
+import urllib.parse
+
+from opex import db_wrapper
+from opex.analysis import Position
+from opex.settings_loader import Json
+from opex.settings_loader import JsonValue
+
+import typing
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, OrderedDict, Tuple
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 19113
+DEFAULT_CONNECTIONS = 4
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_CACHE_SECONDS = 5.0
+# Bytes of the database file which each connection memory maps
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+# The most positions which one request may look up
+MAX_BATCH_SIZE = 1000
+_MAX_BODY_SIZE = 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+# The answer for a position, which is None if it has not been analyzed
+Answer = Optional[Json]
+
+
+def position_json(position: Position, children: Dict[str, Position]) -> Json:
+    """A position and its analyzed moves, best first.
+
+    The score of a move is from the point of view of the side to move in the position, like the score of the position.
+    """
+    moves: List[JsonValue] = [
+        {
+            'move': move,
+            'fen': child.fen,
+            'score': -child.score,
+            'depth': child.depth
+        } for move, child in sorted(children.items(), key=lambda item: item[1].score)
+    ]
+    return {
+        'fen': position.fen,
+        'score': position.score,
+        'depth': position.depth,
+        'pv': position.pv,
+        'visits': position.visits,
+        'terminal': position.terminal,
+        'moves': moves
+    }
+
+
+def lookup_positions(database: db_wrapper.Database, fens: Iterable[str]) -> Dict[str, Answer]:
+    """Looks up positions and their moves with one query for the positions and one for their children."""
+    fens = list(dict.fromkeys(fens))
+    positions = database.get_positions(fens)
+    children = database.get_children_many(typing.cast(int, position.position_id) for position in positions.values())
+    return {
+        fen: position_json(positions[fen], children[typing.cast(int, positions[fen].position_id)])
+        if fen in positions else None for fen in fens
+    }
+
+
+class LruCache:
+    """The most recently used answers, which expire max_age seconds after they were looked up."""
+
+    def __init__(self, capacity: int, max_age: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self._capacity = capacity
+        self._max_age = max_age
+        self._clock = clock
+        self._entries: OrderedDict[str, Tuple[float, Answer]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Answer]:
+        """The answers which are cached and have not expired, leaving out the keys which must be looked up."""
+        now = self._clock()
+        found: Dict[str, Answer] = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self._max_age:
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def put_many(self, answers: Dict[str, Answer]) -> None:
+        """Caches answers, evicting the least recently used answers beyond the capacity."""
+        now = self._clock()
+        for key, answer in answers.items():
+            self._entries[key] = (now, answer)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+
+class ConnectionPool:
+    """Threads which each look up positions with their own read only connection to a database.
+
+    Sqlite connections can only be used by the thread which opened them, so each thread opens one when it starts.
+    """
+
+    def __init__(self, path: str, size: int = DEFAULT_CONNECTIONS, mmap_size: int = DEFAULT_MMAP_SIZE) -> None:
+        # Fail at once if the database does not exist
+        db_wrapper.Database(path, read_only=True).close()
+        self._path = path
+        self._mmap_size = mmap_size
+        self._local = threading.local()
+        self._executor = futures.ThreadPoolExecutor(max_workers=size, initializer=self._open)
+
+    def _open(self) -> None:
+        """Opens the connection of the thread which runs it."""
+        database = db_wrapper.Database(self._path, read_only=True)
+        database.query(f'PRAGMA mmap_size = {int(self._mmap_size)}')
+        self._local.database = database
+
+    def _lookup(self, fens: List[str]) -> Dict[str, Answer]:
+        """Looks up positions with the connection of the thread which runs it."""
+        return lookup_positions(self._local.database, fens)
+
+    def lookup(self, fens: List[str]) -> futures.Future[Dict[str, Answer]]:
+        """Looks up positions on the next free connection."""
+        return self._executor.submit(self._lookup, fens)
+
+    def close(self) -> None:
+        """Waits for the lookups in progress, the connections are closed with their threads."""
+        self._executor.shutdown()
+
+
+class Request(NamedTuple):
+    """The parts of an http request which the server uses."""
+    method: str
+    path: str
+    query: Dict[str, List[str]]
+    body: bytes
+    keep_alive: bool
+
+
+class HttpError(Exception):
+    """A request which cannot be answered, with the status to reply with."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+async def read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+    """Reads the headers of an http request or response up to the blank line which ends them, by lower case name."""
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """Reads an http request, or None if the connection was closed before one started."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HttpError(400, f'Malformed request line \'{request_line!r}\'')
+    method, target, version = parts
+    headers = await read_headers(reader)
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError as error:
+        raise HttpError(400, f'Malformed content length \'{headers["content-length"]}\'') from error
+    if length < 0:
+        raise HttpError(400, f'Negative content length {length}')
+    if length > _MAX_BODY_SIZE:
+        raise HttpError(413, f'Body of {length} bytes is larger than {_MAX_BODY_SIZE}')
+    body = await reader.readexactly(length) if length else b''
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+    url = urllib.parse.urlsplit(target)
+    return Request(method, url.path, urllib.parse.parse_qs(url.query), body, keep_alive)
+
+
+def format_response(status: int, body: JsonValue, keep_alive: bool = True) -> bytes:
+    """Formats an http response with a json body."""
+    content = json.dumps(body).encode()
+    connection = 'keep-alive' if keep_alive else 'close'
+    head = (
+        f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+        'Content-Type: application/json\r\n'
+        f'Content-Length: {len(content)}\r\n'
+        f'Connection: {connection}\r\n\r\n')
+    return head.encode('latin-1') + content
+
+
+class QueryServer:
+    """Answers requests for positions from the cache, looking up the rest in a pool of connections."""
+
+    def __init__(self, lookup: Callable[[List[str]], futures.Future[Dict[str, Answer]]], cache: LruCache) -> None:
+        self._lookup = lookup
+        self.cache = cache
+        self.requests = 0
+
+    async def lookup(self, fens: List[str]) -> Dict[str, Answer]:
+        """Answers positions from the cache, and looks up and caches the positions which are not cached."""
+        answers = self.cache.get_many(fens)
+        missing = [fen for fen in dict.fromkeys(fens) if fen not in answers]
+        if missing:
+            looked_up = await asyncio.wrap_future(self._lookup(missing))
+            self.cache.put_many(looked_up)
+            answers.update(looked_up)
+        return answers
+
+    async def answer(self, request: Request) -> Tuple[int, JsonValue]:
+        """The status and json body of the response to a request."""
+        self.requests += 1
+        if request.path == '/position':
+            if request.method != 'GET':
+                raise HttpError(405, f'Use GET for {request.path}')
+            fens = request.query.get('fen')
+            if not fens:
+                raise HttpError(400, 'Missing \'fen\'')
+            answer = (await self.lookup(fens[:1]))[fens[0]]
+            if answer is None:
+                raise HttpError(404, f'{fens[0]} has not been analyzed')
+            return 200, answer
+        if request.path == '/positions':
+            if request.method != 'POST':
+                raise HttpError(405, f'Use POST for {request.path}')
+            fens = _fens_of_body(request.body)
+            answers = await self.lookup(fens)
+            return 200, {'positions': typing.cast(Json, {fen: answers[fen] for fen in fens})}
+        if request.path == '/stats':
+            return 200, {
+                'requests': self.requests,
+                'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses,
+                'cached_positions': len(self.cache)
+            }
+        raise HttpError(404, f'Unknown path \'{request.path}\'')
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answers the requests of a connection until the client closes it or asks for it to be closed."""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HttpError as error:
+                    # The rest of a request which could not be read cannot be told apart from the next request
+                    writer.write(format_response(error.status, _error_body(error), False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                try:
+                    status, body = await self.answer(request)
+                except HttpError as error:
+                    status, body = error.status, _error_body(error)
+                writer.write(format_response(status, body, request.keep_alive))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _error_body(error: HttpError) -> JsonValue:
+    """The json body of the response to a request which cannot be answered."""
+    return {'error': str(error)}
+
+
+def _fens_of_body(body: bytes) -> List[str]:
+    """The fens of the json body of a batch request."""
+    try:
+        fens: Any = json.loads(body)['fens']
+    except (ValueError, KeyError, TypeError) as error:
+        raise HttpError(400, f'Body must be {{"fens": [...]}}: {error!r}') from error
+    if not isinstance(fens, list) or not all(isinstance(fen, str) for fen in typing.cast(List[Any], fens)):
+        raise HttpError(400, '\'fens\' must be a list of strings')
+    if len(typing.cast(List[str], fens)) > MAX_BATCH_SIZE:
+        raise HttpError(413, f'At most {MAX_BATCH_SIZE} fens may be looked up at once')
+    return typing.cast(List[str], fens)
+
+
+async def serve(
+        database_path: str,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        connections: int = DEFAULT_CONNECTIONS,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        cache_seconds: float = DEFAULT_CACHE_SECONDS,
+        started: Optional[Callable[[asyncio.Server], None]] = None) -> None:
+    """Serves queries of a database until cancelled, calling started with the server once it is listening."""
+    pool = ConnectionPool(database_path, connections)
+    try:
+        query_server = QueryServer(pool.lookup, LruCache(cache_size, cache_seconds))
+        server = await asyncio.start_server(query_server.handle_connection, host, port)
+        async with server:
+            if started is not None:
+                started(server)
+            await server.serve_forever()
+    finally:
+        pool.close()
@@ -0,0 +1,148 @@
+"""Recomputation of the scores of the whole tree from the analysis of its positions.
+
+The tree is read into numpy arrays once. Positions are grouped into levels so that the children of every position are
+in earlier levels, and the tree scores of a whole level are reduced from the tree scores of their children at once, so
+the cost of a recomputation does not include a round trip through python for every position.
+"""
+
+import numpy as np
+import numpy.typing as npt
+
+from opex import db_wrapper
+
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+
+class Dag(NamedTuple):
+    """The positions and edges of the tree as arrays. Edges refer to positions by their index in the arrays."""
+    position_ids: npt.NDArray[np.int64]
+    scores: npt.NDArray[np.float64]
+    fully_expanded: npt.NDArray[np.bool_]
+    parents: npt.NDArray[np.int64]
+    children: npt.NDArray[np.int64]
+
+
+def read_dag(database: db_wrapper.Database) -> Dag:
+    """Reads every position and edge. Edges to positions which are not stored are left out."""
+    positions = np.fromiter(
+        database.query_tuples('SELECT id, score, fully_expanded FROM openings ORDER BY id'),
+        dtype=[('id', np.int64), ('score', np.float64), ('fully_expanded', np.bool_)])
+    edges = np.fromiter(
+        database.query_tuples('SELECT parent_id, child_id FROM game_dag'),
+        dtype=[('parent_id', np.int64), ('child_id', np.int64)])
+    position_ids = positions['id']
+    (parents, parent_stored) = _indices_of(position_ids, edges['parent_id'])
+    (children, child_stored) = _indices_of(position_ids, edges['child_id'])
+    stored = parent_stored & child_stored
+    return Dag(position_ids, positions['score'], positions['fully_expanded'], parents[stored], children[stored])
+
+
+def _indices_of(position_ids: npt.NDArray[np.int64],
+                ids: npt.NDArray[np.int64]) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.bool_]]:
+    """The indices of ids in the sorted ids of positions, and whether each id is found."""
+    if not position_ids.size:
+        return (np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=np.bool_))
+    indices = np.minimum(np.searchsorted(position_ids, ids), len(position_ids) - 1)
+    return (indices, position_ids[indices] == ids)
+
+
+def _ranges(starts: npt.NDArray[np.int64], counts: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    """The indices from each start up to start + count, concatenated."""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if ends.size else 0) + np.repeat(starts - (ends - counts), counts)
+
+
+class _Groups(NamedTuple):
+    """Indices of edges sorted by a position, with where the edges of each position start and how many there are."""
+    order: npt.NDArray[np.int64]
+    starts: npt.NDArray[np.int64]
+    counts: npt.NDArray[np.int64]
+
+    def edges_of(self, positions: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+        """The indices of the edges of positions, grouped by position."""
+        return self.order[_ranges(self.starts[positions], self.counts[positions])]
+
+
+def _group_edges(positions: npt.NDArray[np.int64], position_count: int) -> _Groups:
+    """Groups edges by one of their positions."""
+    counts = np.bincount(positions, minlength=position_count)
+    return _Groups(np.argsort(positions, kind='stable'), np.cumsum(counts) - counts, counts)
+
+
+def topological_levels(dag: Dag) -> List[npt.NDArray[np.int64]]:
+    """Groups the indices of positions into levels, leaves first, with the children of a position in earlier levels."""
+    position_count = len(dag.position_ids)
+    by_child = _group_edges(dag.children, position_count)
+    pending_children = np.bincount(dag.parents, minlength=position_count)
+    level = np.flatnonzero(np.logical_not(pending_children))
+    levels: List[npt.NDArray[np.int64]] = []
+    while level.size:
+        levels.append(level)
+        edges = by_child.edges_of(level)
+        np.subtract.at(pending_children, dag.parents[edges], 1)
+        parents = np.unique(dag.parents[edges])
+        level = parents[np.logical_not(pending_children[parents])]
+    if sum(len(level) for level in levels) != position_count:
+        raise ValueError('The tree has a cycle')
+    return levels
+
+
+## Policies which reduce the scores of the moves of each position of a level to tree scores. Moves are grouped by
+## position, each group from its start up to the start of the next. The analysis of a position which is not fully
+## expanded stands in for the moves which have not been analyzed.
+
+
+def _minimax(
+        move_scores: npt.NDArray[np.float64], starts: npt.NDArray[np.int64], scores: npt.NDArray[np.float64],
+        partial: npt.NDArray[np.bool_]) -> npt.NDArray[np.float64]:
+    """The score of the best move."""
+    best = np.maximum.reduceat(move_scores, starts)
+    return np.where(partial, np.maximum(best, scores), best)
+
+
+def _expectation(
+        move_scores: npt.NDArray[np.float64], starts: npt.NDArray[np.int64], scores: npt.NDArray[np.float64],
+        partial: npt.NDArray[np.bool_]) -> npt.NDArray[np.float64]:
+    """The mean score of the moves, as if each move were equally likely to be played."""
+    total = np.add.reduceat(move_scores, starts)
+    counts = np.diff(starts, append=len(move_scores))
+    return np.where(partial, (total + scores) / (counts + 1), total / counts)
+
+
+BackupPolicy = Callable[
+    [npt.NDArray[np.float64], npt.NDArray[np.int64], npt.NDArray[np.float64], npt.NDArray[np.bool_]],
+    npt.NDArray[np.float64]]
+
+BACKUP_POLICIES: Dict[str, BackupPolicy] = {
+    'minimax': _minimax,
+    'expectation': _expectation,
+}
+
+
+def backup_scores(dag: Dag, policy: str = 'minimax') -> npt.NDArray[np.float64]:
+    """Computes the tree score of every position from its children, relative to the side to move.
+
+    Leaves keep the score of their analysis.
+    """
+    if policy not in BACKUP_POLICIES:
+        raise ValueError(f'Unknown backup policy \'{policy}\'')
+    reduce_moves = BACKUP_POLICIES[policy]
+    by_parent = _group_edges(dag.parents, len(dag.position_ids))
+    tree_scores = dag.scores.copy()
+    for level in topological_levels(dag)[1:]:
+        counts = by_parent.counts[level]
+        edges = by_parent.edges_of(level)
+        # Scores are relative to the side to move, so the score of a move is the negated score of its child
+        move_scores = -tree_scores[dag.children[edges]]
+        tree_scores[level] = reduce_moves(
+            move_scores,
+            np.cumsum(counts) - counts, dag.scores[level], ~dag.fully_expanded[level])
+    return tree_scores
+
+
+def recompute_tree_scores(database: db_wrapper.Database, policy: str = 'minimax') -> int:
+    """Recomputes the tree score of every position, writes them back and returns the number of positions."""
+    dag = read_dag(database)
+    tree_scores = backup_scores(dag, policy)
+    database.set_tree_scores(zip(dag.position_ids.tolist(), tree_scores.tolist()))
+    return len(dag.position_ids)
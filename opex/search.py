@@ -0,0 +1,274 @@
+"""Selection of the positions to analyze next and storage of their analysis."""
+
+from __future__ import annotations  # PEP 563
+
+import chess
+from chess import Move
+
+from opex import analysis
+from opex import db_wrapper
+from opex import engines
+from opex.analysis import EngineAnalysis
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class Expansion(NamedTuple):
+    """A board to analyze, the move from its parent which is None for a root position, and the depth to analyze to.
+
+    Expansions in the deepen stage replace the shallow analysis of a stored position.
+    """
+    board: chess.Board
+    relationship: Optional[ParentRelationship]
+    depth: int
+    stage: str = analysis.STAGE_EXPAND
+
+
+class Screen(NamedTuple):
+    """How the moves of a position are screened with a shallow analysis before the best are analyzed deeply."""
+    depth: int
+    # Moves whose shallow score is within window centipawns of the best move are analyzed deeply
+    window: float
+    # As are the top_k best moves, whatever their score
+    top_k: int
+
+
+def get_fen(board: chess.Board) -> str:
+    return board.fen()  # type: ignore
+
+
+# def back_propagate(position):
+#     # TODO
+#     pass
+
+
+def board_status(board: chess.Board) -> Tuple[int, int]:
+    """Counts the legal moves of a board and determines whether the game is over."""
+    if board.is_checkmate():
+        return (0, analysis.CHECKMATE)
+    if board.is_stalemate():
+        return (0, analysis.STALEMATE)
+    if board.is_insufficient_material():
+        return (0, analysis.INSUFFICIENT_MATERIAL)
+    return (board.legal_moves.count(), analysis.NOT_TERMINAL)
+
+
+def terminal_position(board: chess.Board, terminal: int) -> Position:
+    """Creates the position of a finished game, which does not need to be analyzed."""
+    score = -analysis.MATE_SCORE if terminal == analysis.CHECKMATE else 0
+    return Position(None, get_fen(board), score, 0, '').with_status(0, terminal)
+
+
+def parent_board_of(board: chess.Board) -> chess.Board:
+    """The board before the last move of an expansion."""
+    parent_board = board.copy()
+    parent_board.pop()
+    return parent_board
+
+
+# Weights of the priority of an expansion, in centipawns
+PLY_PRIORITY_WEIGHT = 50
+PV_PRIORITY_BONUS = 50
+VISIT_PRIORITY_WEIGHT = 10
+# Moves which fail the screen are only analyzed deeply once everything more promising has been
+SCREENED_OUT_PRIORITY_PENALTY = 1000
+
+
+def expansion_priority(ply: int, score_gap: float, is_pv_move: bool) -> float:
+    """The priority of analyzing a move, higher priorities are analyzed first.
+
+    Moves from positions near the root and close to the score of the best sibling position are preferred, as is the
+    move which the engine expects to be played.
+    """
+    return PV_PRIORITY_BONUS * is_pv_move - PLY_PRIORITY_WEIGHT * ply - score_gap
+
+
+class TreeSearch:
+    """Chooses which positions to analyze next and stores their analysis.
+
+    The moves of every deeply analyzed position are queued in the frontier. Expansions are claimed in the frontier when
+    they are selected, so they are not selected again until they are stored, and so they can be resumed if the process
+    stops before then.
+
+    With a screen, new positions are first analyzed to the shallow screen depth. Once every move of a position has been
+    screened, the moves which pass the screen are queued to be analyzed to the full depth, and only positions analyzed
+    to the full depth have their own moves queued.
+    """
+
+    def __init__(
+            self,
+            database: db_wrapper.Database,
+            reconciliation_policy: str = 'deepest',
+            analysis_depth: int = engines.ANALYSIS_DEPTH,
+            screen: Optional[Screen] = None) -> None:
+        self.database = database
+        self.reconciliation_policy = reconciliation_policy
+        self.analysis_depth = analysis_depth
+        # A screen which is not shallower than the full analysis would only repeat it
+        self.screen = screen if screen is not None and screen.depth < analysis_depth else None
+
+    def is_deep(self, position: Position) -> bool:
+        """Whether a position has been analyzed beyond the screen.
+
+        Analysis may stop early once it has settled, so a deep position may not have reached the analysis depth.
+        """
+        return self.screen is None or position.depth > self.screen.depth
+
+    def select_expansions(self, board: chess.Board, count: int) -> List[Expansion]:
+        """Claims up to count positions which need analysis.
+
+        If the board has not been analyzed it is the root of the tree and is analyzed first. Otherwise the expansions
+        with the highest priority are taken from the frontier, so the cost of selection does not depend on the depth of
+        the tree.
+        """
+        if self.database.get_position(get_fen(board)) is None:
+            # Analyze and insert the root position for this subtree.
+            (_, terminal) = board_status(board)
+            if terminal != analysis.NOT_TERMINAL:
+                self.database.insert_position(terminal_position(board, terminal), None)
+                return []
+            return [Expansion(board.copy(), None, self.analysis_depth)]
+
+        expansions: List[Expansion] = []
+        while len(expansions) < count:
+            entries = self.database.claim_pending_expansions(count - len(expansions))
+            if not entries:
+                break
+            # Each time moves are taken from a position its other moves become less urgent
+            for parent_id in dict.fromkeys(entry.parent_id for entry in entries):
+                self.database.increment_visits(parent_id, VISIT_PRIORITY_WEIGHT)
+            for entry in entries:
+                parent_board = chess.Board(entry.parent_fen)
+                relationship = ParentRelationship(entry.parent_id, entry.move)
+                if entry.stage == analysis.STAGE_DEEPEN:
+                    expansions.extend(self.prepare_deepening(parent_board, relationship))
+                else:
+                    expansions.extend(self.prepare_expansions([(parent_board, relationship)]))
+        return expansions
+
+    def prepare_expansions(self, moves: List[Tuple[chess.Board, ParentRelationship]]) -> List[Expansion]:
+        """Makes moves on their parent boards and returns the resulting positions which need analysis.
+
+        Positions which are already stored are linked as transpositions and finished games are inserted without
+        analysis.
+        """
+        depth = self.screen.depth if self.screen is not None else self.analysis_depth
+        expansions: List[Expansion] = []
+        for parent_board, relationship in moves:
+            child_board = parent_board.copy()
+            child_board.push(Move.from_uci(relationship.move))
+            transposition = self.database.get_position(get_fen(child_board))
+            if transposition is not None:
+                self.database.insert_transposition(relationship, typing.cast(int, transposition.position_id))
+                self.promote_if_screened(parent_board, relationship.parent_id)
+                continue
+            (_, terminal) = board_status(child_board)
+            if terminal != analysis.NOT_TERMINAL:
+                self.database.insert_position(terminal_position(child_board, terminal), relationship)
+                self.promote_if_screened(parent_board, relationship.parent_id)
+                continue
+            expansions.append(Expansion(child_board, relationship, depth))
+        return expansions
+
+    def prepare_deepening(self, parent_board: chess.Board, relationship: ParentRelationship) -> List[Expansion]:
+        """Makes a move to a screened position and returns it for deep analysis, unless that has already been done."""
+        child_board = parent_board.copy()
+        child_board.push(Move.from_uci(relationship.move))
+        position = typing.cast(Position, self.database.get_position(get_fen(child_board)))
+        if self.is_deep(position):
+            # The position was also reached by another move and deepened from there
+            self.database.complete_expansion(relationship)
+            return []
+        return [Expansion(child_board, relationship, self.analysis_depth, analysis.STAGE_DEEPEN)]
+
+    def store_analysis(self, expansion: Expansion, analyses: List[EngineAnalysis]) -> Position:
+        """Reconciles the analysis of an expansion, stores the resulting position and queues what follows from it."""
+        (board, relationship, depth, stage) = expansion
+        stored = self.database.get_position(get_fen(board))
+        if stage == analysis.STAGE_DEEPEN:
+            stored = typing.cast(Position, stored)
+            deep = analysis.reconcile_analyses(stored.fen, analyses, self.reconciliation_policy)
+            position = self.database.deepen_position(
+                Position(
+                    stored.position_id, stored.fen, deep.score, deep.depth, deep.pv, stored.visits,
+                    stored.legal_move_count, stored.expanded_count, stored.terminal), relationship, analyses)
+            self.enqueue_moves(board, position, relationship)
+            return position
+
+        if stored is not None:
+            # Another expansion reached the same position while this one was being analyzed
+            if relationship is not None:
+                self.database.insert_transposition(relationship, typing.cast(int, stored.position_id))
+                self.promote_if_screened(parent_board_of(board), relationship.parent_id)
+            return stored
+        (legal_move_count, terminal) = board_status(board)
+        if terminal != analysis.NOT_TERMINAL:
+            position = self.database.insert_position(terminal_position(board, terminal), relationship)
+        else:
+            position = analysis.reconcile_analyses(get_fen(board), analyses, self.reconciliation_policy)
+            position = self.database.insert_position(
+                position.with_status(legal_move_count, terminal), relationship, analyses)
+            if depth >= self.analysis_depth:
+                self.enqueue_moves(board, position, relationship)
+        if relationship is not None:
+            self.promote_if_screened(parent_board_of(board), relationship.parent_id)
+        return position
+
+    def requeue(self, expansion: Expansion) -> bool:
+        """Returns an expansion which could not be analyzed to the frontier, and whether it was given up instead.
+
+        A move which is given up counts as expanded, so the moves of its parent which pass the screen are still deepened.
+        """
+        relationship = expansion.relationship
+        if relationship is None or not self.database.requeue_expansions([relationship]):
+            return False
+        if expansion.stage == analysis.STAGE_EXPAND:
+            self.promote_if_screened(parent_board_of(expansion.board), relationship.parent_id)
+        return True
+
+    def enqueue_moves(self, board: chess.Board, position: Position, relationship: Optional[ParentRelationship]) -> None:
+        """Adds the legal moves of a deeply analyzed position to the frontier."""
+        score_gap = 0.0
+        if relationship is not None:
+            # Scores are relative to the side to move, so the best sibling has the lowest score
+            siblings = self.database.get_child_positions(relationship.parent_id)
+            score_gap = position.score - min(sibling.score for sibling in siblings.values())
+        pv_move = position.pv.split()[0] if position.pv else None
+        position_id = typing.cast(int, position.position_id)
+        self.database.enqueue_expansions(
+            (
+                ParentRelationship(position_id, move.uci()),
+                expansion_priority(board.ply(), score_gap,
+                                   move.uci() == pv_move)) for move in board.legal_moves)
+
+    def promote_if_screened(self, parent_board: chess.Board, parent_id: int) -> None:
+        """Once every move of a position has been screened, queues the moves which pass the screen for deep analysis.
+
+        Moves which fail the screen are queued behind everything else, so their shallow analysis can be revisited.
+        """
+        if self.screen is None:
+            return
+        parent = self.database.get_position(get_fen(parent_board))
+        if parent is None or not parent.is_fully_expanded():
+            return
+        children = self.database.get_child_positions(parent_id)
+        if not children:
+            # Every move was given up
+            return
+        best_score = min(child.score for child in children.values())
+        screened = sorted(
+            (
+                move for move, child in children.items()
+                if child.terminal == analysis.NOT_TERMINAL and not self.is_deep(child)),
+            key=lambda move: (children[move].score, move))
+        priorities: List[Tuple[ParentRelationship, float]] = []
+        for rank, move in enumerate(screened):
+            score_gap = children[move].score - best_score
+            priority = expansion_priority(parent_board.ply(), score_gap, False)
+            if rank >= self.screen.top_k and score_gap > self.screen.window:
+                priority -= SCREENED_OUT_PRIORITY_PENALTY
+            priorities.append((ParentRelationship(parent_id, move), priority))
+        self.database.enqueue_expansions(priorities, analysis.STAGE_DEEPEN)
@@ -1,18 +1,31 @@
 """Methods for loading opex settings and engine options.."""
 
+import copy
 import json
 import os.path
 
 from chess import engine
 
+from opex import analysis
+
 import typing
-from typing import AnyStr, Dict, IO, List, Tuple, Union
+from typing import Any, AnyStr, Dict, IO, List, NamedTuple, Sequence, Set, Tuple, Union
 
 Json = Dict[str, 'JsonValue']
-JsonValue = Union[str, int, bool, Json, List['JsonValue']]
+# A sequence so that a list of a narrower type, such as a list of Json, is a JsonValue too
+JsonValue = Union[str, int, float, bool, None, Json, Sequence['JsonValue']]
 
 DEFAULT_SETTINGS_FILE_NAME = 'opex-default-settings.json'
 
+# 'split' analyzes different positions with each engine, 'ensemble' analyzes each position with every engine
+ENGINE_MODES = ['split', 'ensemble']
+
+# 'early_stop' stops analysis once it has settled, 'fixed_depth' always analyzes to the full depth
+ANALYSIS_MODES = ['early_stop', 'fixed_depth']
+
+# 'sqlite' reads and writes the tree in the database, 'memory' keeps it in memory and writes it at checkpoints
+TREE_BACKENDS = ['sqlite', 'memory']
+
 ## Methods for loading json settings
 
 
@@ -23,15 +36,30 @@ def _json_from_file(file: IO[AnyStr]) -> Json:
     return {}
 
 
+# The modification time in nanoseconds of each default settings file when it was parsed, and its parsed settings
+_parsed_default_settings: Dict[str, Tuple[int, Json]] = {}
+
+
 def load_default_settings() -> Json:
-    with open(DEFAULT_SETTINGS_FILE_NAME) as settings_file:
-        return _json_from_file(settings_file)
+    """Loads the default settings, which are only parsed again when the file changes."""
+    modified = os.stat(DEFAULT_SETTINGS_FILE_NAME).st_mtime_ns
+    parsed = _parsed_default_settings.get(DEFAULT_SETTINGS_FILE_NAME)
+    if parsed is None or parsed[0] != modified:
+        with open(DEFAULT_SETTINGS_FILE_NAME) as settings_file:
+            parsed = (modified, _json_from_file(settings_file))
+        _parsed_default_settings[DEFAULT_SETTINGS_FILE_NAME] = parsed
+    return copy.deepcopy(parsed[1])
 
 
 def load_settings_simple(settings_file: IO[AnyStr]):
     return _json_from_file(settings_file)
 
 
+def _is_unset(value: JsonValue) -> bool:
+    """Whether a user setting has no value, which is also how settings saved without default values are left."""
+    return value in (None, '')
+
+
 def _merge_settings(default_settings: JsonValue, user_settings: JsonValue, use_default_values: bool) -> JsonValue:
     """Merges missing default settings into user settings."""
     if isinstance(default_settings, dict):
@@ -41,7 +69,7 @@ def _merge_settings(default_settings: JsonValue, user_settings: JsonValue, use_d
                 user_settings[key] = _merge_settings(default_value, {}, use_default_values)
             elif isinstance(default_value, (dict, list)):
                 user_settings[key] = _merge_settings(default_value, user_settings[key], use_default_values)
-            elif not user_settings[key] and use_default_values:
+            elif _is_unset(user_settings[key]) and use_default_values:
                 user_settings[key] = default_value
         return user_settings
     if isinstance(default_settings, list):
@@ -56,16 +84,57 @@ def _merge_settings(default_settings: JsonValue, user_settings: JsonValue, use_d
     return default_settings if use_default_values else ''
 
 
+def merge_default_settings(user_settings: Json, use_default_values: bool = True) -> Json:
+    """Merges missing defaults into a copy of parsed settings."""
+    return typing.cast(Json, _merge_settings(load_default_settings(), copy.deepcopy(user_settings), use_default_values))
+
+
 def load_settings(user_settings_file: IO[AnyStr], use_default_values: bool = True) -> Json:
     """Parses a json settings file and merges in missing defaults."""
-    default_settings = load_default_settings()
-    user_settings = load_settings_simple(user_settings_file)
-    return typing.cast(Json, _merge_settings(default_settings, user_settings, use_default_values))
+    return merge_default_settings(load_settings_simple(user_settings_file), use_default_values)
+
+
+class Settings(NamedTuple):
+    """The settings of opex, parsed once from json settings with their defaults merged in."""
+    analysis_depth: int
+    analysis_mode: str
+    checkpoint_interval: int
+    data_directory: str
+    database_file_name: str
+    early_stop_decisive_score: float
+    early_stop_min_depth: int
+    early_stop_stable_depths: int
+    early_stop_tolerance: float
+    engine_max_attempts: int
+    engine_mode: str
+    engine_options_directory: str
+    engine_restart_backoff: float
+    engine_timeout: float
+    # The nickname and path of each engine
+    engines: List[Json]
+    reconciliation_policy: str
+    screen_depth: int
+    screen_top_k: int
+    screen_window: float
+    shard_count: int
+    tree_backend: str
+
+
+def parse_settings(settings: Json) -> Settings:
+    """The typed settings of json settings which have their defaults merged in and have been checked."""
+    return Settings(**typing.cast(Dict[str, Any], {field: settings[field] for field in Settings._fields}))
 
 
 ## Methods for loading engine settings and options
 
 
+class EngineSettings(NamedTuple):
+    """An engine and the options it is configured with which differ from its defaults."""
+    nickname: str
+    path: str
+    options: engine.ConfigMapping
+
+
 def _raise_if_duplicates(counts: Dict[str, int]) -> None:
     """Raises a value error if duplicates have been counted."""
     duplicates: List[str] = []
@@ -96,6 +165,63 @@ def check_engine_settings(engine_settings_list: List[Json]) -> None:
     _raise_if_duplicates(nickname_counts)
 
 
+def check_ensemble_settings(settings: Json) -> None:
+    """Checks how the results of multiple engines are to be combined."""
+    engine_mode = settings['engine_mode']
+    if engine_mode not in ENGINE_MODES:
+        raise ValueError(f'Unknown engine mode \'{engine_mode}\' not in {ENGINE_MODES}')
+    reconciliation_policy = settings['reconciliation_policy']
+    if reconciliation_policy not in analysis.RECONCILIATION_POLICIES:
+        policies = list(analysis.RECONCILIATION_POLICIES)
+        raise ValueError(f'Unknown reconciliation policy \'{reconciliation_policy}\' not in {policies}')
+
+
+def check_analysis_settings(settings: Json) -> None:
+    """Checks how deeply positions are to be analyzed."""
+    analysis_mode = settings['analysis_mode']
+    if analysis_mode not in ANALYSIS_MODES:
+        raise ValueError(f'Unknown analysis mode \'{analysis_mode}\' not in {ANALYSIS_MODES}')
+    for key in ['analysis_depth', 'early_stop_min_depth', 'early_stop_stable_depths', 'screen_depth']:
+        if not isinstance(settings[key], int) or typing.cast(int, settings[key]) < 1:
+            raise ValueError(f'\'{key}\' must be a positive integer')
+    for key in ['early_stop_tolerance', 'early_stop_decisive_score']:
+        value = settings[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f'\'{key}\' must be a number of centipawns which is not negative')
+    for key in ['screen_top_k', 'screen_window']:
+        value = settings[key]
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise ValueError(f'\'{key}\' must be an integer which is not negative')
+    min_depth, screen_depth, analysis_depth = (
+        typing.cast(int, settings[key]) for key in ['early_stop_min_depth', 'screen_depth', 'analysis_depth'])
+    # With a screen, positions analyzed to the screen depth or less are taken to be screened and are analyzed again
+    if analysis_mode == 'early_stop' and min_depth <= screen_depth < analysis_depth:
+        raise ValueError('\'early_stop_min_depth\' must be above \'screen_depth\'')
+
+
+def check_database_settings(settings: Json) -> None:
+    """Checks how the tree is stored."""
+    tree_backend = settings['tree_backend']
+    if tree_backend not in TREE_BACKENDS:
+        raise ValueError(f'Unknown tree backend \'{tree_backend}\' not in {TREE_BACKENDS}')
+    for key in ['checkpoint_interval', 'shard_count']:
+        if not isinstance(settings[key], int) or typing.cast(int, settings[key]) < 1:
+            raise ValueError(f'\'{key}\' must be a positive integer')
+    if typing.cast(int, settings['shard_count']) > 1 and tree_backend == 'memory':
+        raise ValueError('The memory tree backend cannot be used with more than one shard')
+
+
+def check_supervisor_settings(settings: Json) -> None:
+    """Checks how long an analysis may take and how engines which fail are restarted."""
+    for key in ['engine_timeout', 'engine_restart_backoff']:
+        value = settings[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f'\'{key}\' must be a number of seconds which is not negative')
+    engine_max_attempts = settings['engine_max_attempts']
+    if not isinstance(engine_max_attempts, int) or engine_max_attempts < 1:
+        raise ValueError('\'engine_max_attempts\' must be a positive integer')
+
+
 def load_engine_options_simple(engine_options_file: IO[AnyStr]) -> engine.ConfigMapping:
     """Parses an engine options file into a dictionary."""
     options: engine.ConfigMapping = {}
@@ -169,12 +295,12 @@ def check_engine_options(default_options: List[engine.Option], engine_options: e
             raise ValueError(f'Value \'{value}\' for \'{name}\' not in range [{option.min}, {option.max}]')
 
     def check_combo(option: engine.Option, value: engine.ConfigValue):
-        if value not in option.var:
+        if value not in (option.var or []):
             raise ValueError(f'Value \'{value}\' for \'{name}\' not in {option.var}')
 
     managed_options: List[str] = []
     button_options: List[str] = []
-    found_names = set()
+    found_names: Set[str] = set()
 
     for option in default_options:
         name = option.name
@@ -205,6 +331,20 @@ def check_engine_options(default_options: List[engine.Option], engine_options: e
         raise ValueError(f'Unknown options {unknown_names}')
 
 
+def changed_engine_options(
+        default_options: List[engine.Option], old_options: engine.ConfigMapping,
+        new_options: engine.ConfigMapping) -> engine.ConfigMapping:
+    """The options to configure to change an engine from old to new options, where missing options are defaults."""
+    changed: engine.ConfigMapping = {}
+    for option in default_options:
+        if option.is_managed() or option.type == 'button':
+            continue
+        new_value = new_options.get(option.name, option.default)
+        if new_value != old_options.get(option.name, option.default):
+            changed[option.name] = new_value
+    return changed
+
+
 def _engine_option_string_and_comment(option: engine.Option, value: engine.ConfigValue) -> Tuple[str, str]:
     """Creates a string representation of an engine option to write to a file."""
     if value is None:
@@ -0,0 +1,378 @@
+"""A database whose positions are partitioned across several sqlite files, which are written in parallel.
+
+Each position is stored on the shard chosen by a hash of its fen. Ids are unique across shards: the id of a position
+modulo the number of shards is the index of its shard, so the shard of a position is known from its id alone. Edges and
+frontier entries are stored on the shard of their parent, next to the bookkeeping of the parent, and may lead to
+children on other shards.
+
+Every shard is only used from its own thread, which runs the operations queued on the shard in order. Writes are queued
+without waiting for them, so the shards write at the same time, and a read waits for the writes queued before it on the
+same shard. A write which fails raises its error from the next read or checkpoint of its shard.
+"""
+
+from __future__ import annotations  # PEP 563
+
+from concurrent import futures
+import os
+import sqlite3
+
+from opex import analysis
+from opex import db_wrapper
+from opex import memory_tree
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+# Queries over the whole tree attach every shard to one connection, and sqlite attaches at most 10 databases by default
+MAX_SHARD_COUNT = 10
+
+# The number of writes which are handed to the thread of a shard at once
+WRITE_BATCH_SIZE = 64
+
+_TABLES = ['openings', 'game_dag', 'engine_analysis', 'frontier']
+
+Value = TypeVar('Value')
+
+
+def shard_paths(path: str, shard_count: int) -> List[str]:
+    """The paths of the shards of a database, next to where the single file database would be."""
+    (root, extension) = os.path.splitext(path)
+    return [f'{root}-{index + 1}-of-{shard_count}{extension}' for index in range(shard_count)]
+
+
+def _group_by_shard(items: Iterable[Value], shard_of: Callable[[Value], int]) -> Dict[int, List[Value]]:
+    """Splits items by the index of their shard, leaving out shards without items."""
+    groups: Dict[int, List[Value]] = {}
+    for item in items:
+        groups.setdefault(shard_of(item), []).append(item)
+    return groups
+
+
+class _PendingExpansion(NamedTuple):
+    """A pending expansion of a shard with what orders it among the expansions of every shard."""
+    priority: float
+    claimed_at: float
+    entry: analysis.FrontierEntry
+
+
+class _Shard(db_wrapper.Database):
+    """One of the sqlite files of a sharded database, with reads by id of the rows which it holds."""
+
+    def last_position_id(self) -> Optional[int]:
+        """The largest id which was ever given to a position of the shard."""
+        row = self._db.execute('SELECT seq FROM sqlite_sequence WHERE name = \'openings\'').fetchone()
+        return typing.cast(int, row['seq']) if row is not None else None
+
+    def get_edges(self, parent_ids: List[int]) -> List[Tuple[int, int, str]]:
+        """The parent id, child id and move of every edge from the parents."""
+        edges: List[Tuple[int, int, str]] = []
+        cursor = self._tuple_cursor()
+        for chunk in db_wrapper.chunks(parent_ids):
+            cursor.execute(
+                f'SELECT parent_id, child_id, move FROM game_dag WHERE parent_id IN ({db_wrapper.placeholders(chunk)})',
+                chunk)
+            edges.extend(cursor)
+        return edges
+
+    def get_positions_by_id(self, position_ids: List[int]) -> Dict[int, Position]:
+        """The positions with the given ids, keyed by id. Ids which are not stored are left out."""
+        positions: Dict[int, Position] = {}
+        cursor = self._tuple_cursor()
+        for chunk in db_wrapper.chunks(position_ids):
+            cursor.execute(
+                f'SELECT {db_wrapper.POSITION_COLUMNS} FROM openings WHERE id IN ({db_wrapper.placeholders(chunk)})',
+                chunk)
+            for row in cursor:
+                positions[row[0]] = Position(*row)
+        return positions
+
+    def get_pending_expansions(self, count: int) -> List[_PendingExpansion]:
+        """The count pending expansions with the highest priority, without claiming them."""
+        return [
+            _PendingExpansion(
+                row['priority'], row['claimed_at'],
+                analysis.FrontierEntry(row['parent_id'], row['move'], row['fen'], row['stage']))
+            for row in self._pending_expansions(count)
+        ]
+
+
+class _ShardWorker:
+    """A shard and the thread which runs every operation on it, in the order in which they were queued.
+
+    Writes are collected into batches, and a batch is handed to the thread when it is full or before the next read.
+    """
+
+    def __init__(self, path: str, checkpoint_interval: int) -> None:
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard')
+        self._batch: List[Tuple[Callable[..., Any], Tuple[Any, ...]]] = []
+        self._error: Optional[BaseException] = None
+        self._shard = self._executor.submit(_Shard, path, checkpoint_interval).result()
+
+    def _raise_error(self) -> None:
+        """Raises the error of the first write which failed since the last time an error was raised."""
+        (error, self._error) = (self._error, None)
+        if error is not None:
+            raise error
+
+    def _run_writes(self, batch: List[Tuple[Callable[..., Any], Tuple[Any, ...]]]) -> None:
+        """Runs a batch of writes on the thread of the shard, keeping the first error."""
+        for method, args in batch:
+            try:
+                method(self._shard, *args)
+            except Exception as error:  # pylint: disable=broad-except
+                if self._error is None:
+                    self._error = error
+
+    def _submit_batch(self) -> None:
+        """Hands the writes which were queued to the thread of the shard."""
+        if self._batch:
+            self._executor.submit(self._run_writes, self._batch)
+            self._batch = []
+
+    def write(self, method: Callable[..., Any], *args: Any) -> None:
+        """Queues a method of the shard without waiting for it."""
+        self._raise_error()
+        self._batch.append((method, args))
+        if len(self._batch) >= WRITE_BATCH_SIZE:
+            self._submit_batch()
+
+    def read(self, method: Callable[..., Value], *args: Any) -> futures.Future[Value]:
+        """Queues a method of the shard after the writes which were queued before it."""
+        self._submit_batch()
+        return self._executor.submit(method, self._shard, *args)
+
+    def wait(self, future: futures.Future[Value]) -> Value:
+        """Waits for a read, raising the error of a write which failed before it."""
+        result = future.result()
+        self._raise_error()
+        return result
+
+    def close(self) -> None:
+        """Commits and closes the shard once its queued operations have run, then stops its thread."""
+        try:
+            self.wait(self.read(_Shard.close))
+        finally:
+            self._executor.shutdown()
+
+
+class ShardedDatabase(db_wrapper.Database):
+    """A database with the same methods as a single sqlite file, whose positions are spread across several files.
+
+    Each shard groups its writes into checkpoints on its own, and a checkpoint of the database commits every shard at
+    once. Since shards commit separately, a crash can keep a position without the edge which leads to it. Queries over
+    the whole tree commit every shard and read from views which join the tables of all shards. Merging and pruning are
+    refused.
+    """
+
+    def __init__(self, path: str, shard_count: int, checkpoint_interval: int = 1) -> None:
+        if not 1 <= shard_count <= MAX_SHARD_COUNT:
+            raise ValueError(f'The number of shards must be between 1 and {MAX_SHARD_COUNT}')
+        self._shard_count = shard_count
+        self._shard_paths = shard_paths(path, shard_count)
+        self._workers = [_ShardWorker(shard_path, checkpoint_interval) for shard_path in self._shard_paths]
+        # The next id of each shard, the first position of the first shard is not given id 0
+        self._next_ids: List[int] = []
+        for index, last_id in enumerate(self._read_all(_Shard.last_position_id)):
+            self._next_ids.append(last_id + shard_count if last_id is not None else index or shard_count)
+        # The connection of the database itself only runs queries over the attached shards
+        super().__init__(None, checkpoint_interval)
+
+    def _initialize_db(self) -> None:
+        """Attaches every shard and creates views of the union of the tables of all shards."""
+        for index, shard_path in enumerate(self._shard_paths):
+            self._db.execute(f'ATTACH DATABASE ? AS shard{index}', (shard_path,))
+        for table in _TABLES:
+            union = ' UNION ALL '.join(f'SELECT * FROM shard{index}.{table}' for index in range(self._shard_count))
+            self._db.execute(f'CREATE TEMP VIEW {table} AS {union}')
+
+    def close(self) -> None:
+        try:
+            for worker in self._workers:
+                worker.close()
+        finally:
+            self._db.close()
+
+    ## Routing operations to shards
+
+    def _shard_of_fen(self, fen: str) -> int:
+        return memory_tree.fen_key(fen) % self._shard_count
+
+    def _shard_of_id(self, position_id: int) -> int:
+        return position_id % self._shard_count
+
+    def _worker_of(self, position_id: int) -> _ShardWorker:
+        return self._workers[self._shard_of_id(position_id)]
+
+    def _read_all(self, method: Callable[..., Value], *args: Any) -> List[Value]:
+        """Runs a read on every shard at once, with the results in the order of the shards."""
+        pending = [worker.read(method, *args) for worker in self._workers]
+        return [worker.wait(future) for worker, future in zip(self._workers, pending)]
+
+    def _read_groups(self, method: Callable[[_Shard, List[Value]], Any], groups: Dict[int, List[Value]]) -> List[Any]:
+        """Runs a read of a group of items on the shard of each group at once."""
+        pending = {index: self._workers[index].read(method, group) for index, group in groups.items()}
+        return [self._workers[index].wait(future) for index, future in pending.items()]
+
+    ## Writes, which are queued on the shard of the position or of the parent which they change
+
+    def _insert_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[analysis.EngineAnalysis]) -> Position:
+        """Inserts a position on its shard and the edge from its parent on the shard of the parent.
+
+        The position is always given the next id of its shard.
+        """
+        index = self._shard_of_fen(position.fen)
+        position = position.with_position_id(self._next_ids[index])
+        self._next_ids[index] += self._shard_count
+        self._workers[index].write(_Shard.insert_position, position, None, engine_analyses)
+        if parent_child_relation is not None:
+            self.insert_transposition(parent_child_relation, typing.cast(int, position.position_id))
+        return position
+
+    def _deepen_position(
+            self, position: Position, parent_child_relation: Optional[Tuple[int, str]],
+            engine_analyses: List[analysis.EngineAnalysis]) -> Position:
+        """Replaces the analysis of a position on its shard and completes its frontier entry on its parent's shard."""
+        self._worker_of(typing.cast(int, position.position_id)).write(
+            _Shard.deepen_position, position, None, engine_analyses)
+        if parent_child_relation is not None:
+            self.complete_expansion(ParentRelationship(*parent_child_relation))
+        return position
+
+    def insert_transposition(self, parent_child_relation: Tuple[int, str], child_id: int) -> None:
+        """Link an existing position as the child of another position."""
+        self._worker_of(parent_child_relation[0]).write(_Shard.insert_transposition, parent_child_relation, child_id)
+
+    def update_position(self, position: Position) -> Optional[Position]:
+        """Update a position on its shard. The write is only queued, so the updated position is not returned."""
+        self._worker_of(typing.cast(int, position.position_id)).write(_Shard.update_position, position)
+
+    def increment_visits(self, position_id: int, priority_penalty: float = 0.0) -> None:
+        """Record that the search passed through a position, lowering the priority of its pending moves."""
+        self._worker_of(position_id).write(_Shard.increment_visits, position_id, priority_penalty)
+
+    def set_tree_scores(self, tree_scores: Iterable[Tuple[int, float]]) -> None:
+        """Replace the scores backed up from the tree below each position with a single update of each shard.
+
+        Positions without a new tree score are left without one.
+        """
+        groups = _group_by_shard(tree_scores, lambda tree_score: self._shard_of_id(tree_score[0]))
+        for index, worker in enumerate(self._workers):
+            worker.write(_Shard.set_tree_scores, groups.get(index, []))
+
+    ## Reads, which are run on the shards of the positions they read at once
+
+    def get_position(self, fen: str) -> Optional[Position]:
+        """Retrieve a position from its shard."""
+        worker = self._workers[self._shard_of_fen(fen)]
+        return worker.wait(worker.read(_Shard.get_position, fen))
+
+    def get_child_positions(self, parent_id: int) -> Dict[str, Position]:
+        """Retrieve the child positions of a position keyed by move."""
+        return self.get_children_many([parent_id])[parent_id]
+
+    def get_positions(self, fens: Iterable[str]) -> Dict[str, Position]:
+        """Retrieve the positions with the given fens, keyed by fen. Fens which are not stored are left out."""
+        positions: Dict[str, Position] = {}
+        for shard_positions in self._read_groups(_Shard.get_positions, _group_by_shard(fens, self._shard_of_fen)):
+            positions.update(shard_positions)
+        return positions
+
+    def get_children_many(self, parent_ids: Iterable[int]) -> Dict[int, Dict[str, Position]]:
+        """Retrieve the child positions of each parent keyed by parent id and then by move.
+
+        The edges are read from the shards of the parents, and then the children from their own shards.
+        """
+        children: Dict[int, Dict[str, Position]] = {parent_id: {} for parent_id in parent_ids}
+        edges = [
+            edge for shard_edges in self._read_groups(_Shard.get_edges, _group_by_shard(children, self._shard_of_id))
+            for edge in shard_edges
+        ]
+        child_ids = _group_by_shard(dict.fromkeys(child_id for _, child_id, _ in edges), self._shard_of_id)
+        positions: Dict[int, Position] = {}
+        for shard_positions in self._read_groups(_Shard.get_positions_by_id, child_ids):
+            positions.update(shard_positions)
+        for parent_id, child_id, move in edges:
+            if child_id in positions:
+                children[parent_id][move] = positions[child_id]
+        return children
+
+    def get_engine_analyses(self, position_id: int) -> List[analysis.EngineAnalysis]:
+        """Retrieve the analysis of each engine which analyzed a position."""
+        worker = self._worker_of(position_id)
+        return worker.wait(worker.read(_Shard.get_engine_analyses, position_id))
+
+    def query(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query over the tables of every shard once every shard has been committed."""
+        self.checkpoint()
+        return super().query(sql, parameters)
+
+    def query_tuples(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        """Run a read only query over the tables of every shard once every shard has been committed."""
+        self.checkpoint()
+        return super().query_tuples(sql, parameters)
+
+    ## The frontier, whose entries are stored on the shard of their parent
+
+    def enqueue_expansions(
+            self, expansions: Iterable[Tuple[ParentRelationship, float]], stage: str = analysis.STAGE_EXPAND) -> None:
+        """Add moves from their parent positions to the queue of pending expansions with a priority.
+
+        Expansions with a higher priority are claimed first. Moves which are already in the frontier are unchanged.
+        """
+        groups = _group_by_shard(expansions, lambda expansion: self._shard_of_id(expansion[0].parent_id))
+        for index, group in groups.items():
+            self._workers[index].write(_Shard.enqueue_expansions, group, stage)
+
+    def claim_expansions(self, expansions: Iterable[ParentRelationship]) -> None:
+        """Record that the analysis of moves from their parent positions is in flight."""
+        groups = _group_by_shard(expansions, lambda expansion: self._shard_of_id(expansion.parent_id))
+        for index, group in groups.items():
+            self._workers[index].write(_Shard.claim_expansions, group)
+
+    def claim_pending_expansions(self, count: int) -> List[analysis.FrontierEntry]:
+        """Mark the count pending expansions with the highest priority on any shard as in flight and return them."""
+        candidates = sorted(
+            (
+                candidate for candidates in self._read_all(_Shard.get_pending_expansions, count)
+                for candidate in candidates),
+            key=lambda candidate: (-candidate.priority, candidate.claimed_at))
+        entries = [candidate.entry for candidate in candidates[:count]]
+        if entries:
+            self.claim_expansions(ParentRelationship(entry.parent_id, entry.move) for entry in entries)
+        return entries
+
+    def complete_expansion(self, relationship: ParentRelationship) -> None:
+        """Remove an expansion from the frontier without inserting a position."""
+        self._worker_of(relationship.parent_id).write(_Shard.complete_expansion, relationship)
+
+    def requeue_expansions(self, expansions: Iterable[ParentRelationship]) -> int:
+        """Return expansions whose analysis failed to the pending state, or give them up after too many failures."""
+        groups = _group_by_shard(expansions, lambda expansion: self._shard_of_id(expansion.parent_id))
+        return sum(self._read_groups(_Shard.requeue_expansions, groups))
+
+    def requeue_in_flight(self) -> int:
+        """Return expansions which were in flight when the explorer stopped to the pending state."""
+        return sum(self._read_all(_Shard.requeue_in_flight))
+
+    ## Maintenance of every shard
+
+    def checkpoint(self) -> None:
+        """Commit the writes of every shard since the last checkpoint, with the shards committing at once."""
+        self._read_all(_Shard.checkpoint)
+
+    def compact(self) -> None:
+        """Reclaim the free pages of every shard."""
+        self._read_all(_Shard.compact)
+
+    def merge(self, source_path: str, batch_size: int = db_wrapper.MERGE_BATCH_SIZE) -> db_wrapper.MergeResult:
+        """Databases are merged by their ids, which are assigned differently on shards, so merging is refused."""
+        raise ValueError('Databases cannot be merged into a sharded database')
+
+    def prune(
+        self, window: float, min_depth: int = 0, keep: Iterable[ParentRelationship] = ()) -> db_wrapper.PruneResult:
+        """Reachability is computed over edges which cross shards, so pruning is refused."""
+        raise ValueError('A sharded database cannot be pruned')
@@ -0,0 +1,153 @@
+"""Supervision of uci engines, so that an engine which crashes or hangs does not stop a long exploration.
+
+An analysis which takes longer than the timeout is abandoned by closing its engine. An engine which was closed or which
+crashed is restarted before the next attempt, after a backoff which doubles with each consecutive failure.
+"""
+
+import threading
+import time
+
+import chess
+from chess import engine
+
+from opex import engines
+from opex.analysis import EngineAnalysis
+
+from typing import Callable, NamedTuple, Optional
+
+
+class SupervisorPolicy(NamedTuple):
+    """How long an analysis may take and how failed engines are restarted."""
+    # Seconds before an analysis is abandoned, or None to wait for as long as it takes
+    timeout: Optional[float] = None
+    # The number of times an analysis is tried before it fails
+    max_attempts: int = 3
+    # Seconds to wait before restarting an engine, doubled after each consecutive failure up to max_backoff
+    backoff: float = 1.0
+    max_backoff: float = 60.0
+    # Waits for the backoff, replaced in tests
+    sleep: Callable[[float], None] = time.sleep
+
+
+class EngineHealth(NamedTuple):
+    """What has happened to a supervised engine so far."""
+    analyses: int = 0
+    timeouts: int = 0
+    crashes: int = 0
+    restarts: int = 0
+    # Seconds spent in analyses which finished
+    analysis_seconds: float = 0.0
+    # Failures since the last analysis which finished, which double the backoff
+    consecutive_failures: int = 0
+
+
+class EngineFailure(Exception):
+    """An engine failed to analyze a position on every attempt."""
+
+
+class EngineSupervisor:
+    """Analyzes positions with an engine, restarting it with reopen when it crashes or hangs.
+
+    Without reopen a failed engine cannot be restarted, and the analysis fails after the first crash or timeout.
+    """
+
+    def __init__(
+            self,
+            nickname: str,
+            uci_engine: engine.SimpleEngine,
+            reopen: Optional[Callable[[], engine.SimpleEngine]] = None,
+            policy: SupervisorPolicy = SupervisorPolicy(),
+            owns_engine: bool = False) -> None:
+        self.nickname = nickname
+        self.uci_engine = uci_engine
+        self._reopen = reopen
+        self._policy = policy
+        # Engines which were opened by a restart are closed by the supervisor
+        self._owns_engine = owns_engine
+        self._needs_restart = False
+        self._health = EngineHealth()
+
+    def close(self) -> None:
+        """Closes the engine if it was opened by the supervisor or handed over to it."""
+        if self._owns_engine:
+            self.uci_engine.close()
+
+    def health(self) -> EngineHealth:
+        """What has happened to the engine so far."""
+        return self._health
+
+    def configure(self, options: engine.ConfigMapping, reopen: Optional[Callable[[], engine.SimpleEngine]]) -> None:
+        """Changes options of the engine between analyses, and reopens it with reopen when it is next restarted."""
+        self._reopen = reopen
+        if self._needs_restart or not options:
+            return
+        try:
+            self.uci_engine.configure(options)
+        except (engine.EngineError, OSError) as error:
+            print(f'{self.nickname} could not be configured: {error!r}')
+            self._needs_restart = True
+
+    def _restart(self) -> None:
+        """Replaces the engine with a new one once the backoff has passed."""
+        if self._reopen is None:
+            raise EngineFailure(f'{self.nickname} failed and cannot be restarted')
+        failures = self._health.consecutive_failures
+        self._policy.sleep(min(self._policy.backoff * 2**max(failures - 1, 0), self._policy.max_backoff))
+        self.uci_engine.close()
+        self.uci_engine = self._reopen()
+        self._owns_engine = True
+        self._needs_restart = False
+        self._health = self._health._replace(restarts=self._health.restarts + 1)
+        print(f'Restarted {self.nickname} after {failures} consecutive failures')
+
+    def _record_failure(self, error: Exception, timed_out: bool) -> None:
+        """Counts a timeout or crash, after which the engine is restarted."""
+        if timed_out:
+            self._health = self._health._replace(timeouts=self._health.timeouts + 1)
+            print(f'{self.nickname} did not finish within {self._policy.timeout}s')
+        else:
+            self._health = self._health._replace(crashes=self._health.crashes + 1)
+            print(f'{self.nickname} failed: {error!r}')
+        self._needs_restart = True
+        self._health = self._health._replace(consecutive_failures=self._health.consecutive_failures + 1)
+
+    def analyze_board(
+            self, board: chess.Board, depth: int, early_stop: Optional[engines.EarlyStop] = None) -> EngineAnalysis:
+        """Analyzes a board, restarting the engine and trying again after a crash or timeout."""
+        for _ in range(self._policy.max_attempts):
+            timed_out = threading.Event()
+            try:
+                if self._needs_restart:
+                    self._restart()
+                watchdog = self._start_watchdog(self.uci_engine, timed_out)
+                start = time.perf_counter()
+                try:
+                    engine_analysis = engines.analyze_board(self.uci_engine, self.nickname, board, depth, early_stop)
+                finally:
+                    if watchdog is not None:
+                        watchdog.cancel()
+            except (engine.EngineError, OSError) as error:
+                self._record_failure(error, timed_out.is_set())
+                continue
+            # The watchdog may have closed the engine just as the analysis finished
+            self._needs_restart = timed_out.is_set()
+            self._health = self._health._replace(
+                analyses=self._health.analyses + 1,
+                analysis_seconds=self._health.analysis_seconds + time.perf_counter() - start,
+                consecutive_failures=0)
+            return engine_analysis
+        raise EngineFailure(f'{self.nickname} failed to analyze {board.fen()} {self._policy.max_attempts} times')
+
+    def _start_watchdog(self, uci_engine: engine.SimpleEngine, timed_out: threading.Event) -> Optional[threading.Timer]:
+        """Closes the engine if the analysis is still running when the timeout passes, which ends the analysis."""
+        if self._policy.timeout is None:
+            return None
+
+        def _stop() -> None:
+            timed_out.set()
+            uci_engine.close()
+
+        watchdog = threading.Timer(self._policy.timeout, _stop)
+        watchdog.daemon = True
+        watchdog.start()
+        return watchdog
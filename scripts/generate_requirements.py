@@ -23,7 +23,8 @@ class NestedRequirements(NamedTuple):
 
 
 # Categorized requirements
-REQUIREMENTS_PROD = ['chess']
+# numpy 2 needs a newer python than the one ci runs on
+REQUIREMENTS_PROD = ['chess', 'numpy<2']
 REQUIREMENTS_STYLE = ['pydocstyle', 'pylint', 'pylint-quotes', 'yapf']
 REQUIREMENTS_COVERAGE = ['coverage']
 
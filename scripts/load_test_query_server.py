@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""A script which measures the throughput and latency of a running query server."""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import time
+import urllib.parse
+import urllib.request
+
+from opex import query_server
+
+from typing import List, NamedTuple
+
+
+class LoadTestResult(NamedTuple):
+    """The latency in seconds of each request and how long all of them took."""
+    latencies: List[float]
+    seconds: float
+
+
+def percentile(sorted_latencies: List[float], fraction: float) -> float:
+    """The latency below which a fraction of the sorted latencies are."""
+    return sorted_latencies[min(int(fraction * len(sorted_latencies)), len(sorted_latencies) - 1)]
+
+
+def sample_fens(database_path: str, count: int) -> List[str]:
+    """Random fens of analyzed positions."""
+    uri = f'file:{urllib.request.pathname2url(os.path.abspath(database_path))}?mode=ro'
+    with contextlib.closing(sqlite3.connect(uri, uri=True)) as connection:
+        rows = connection.execute('SELECT fen FROM openings ORDER BY random() LIMIT ?', (count,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def position_request(host: str, fen: str) -> bytes:
+    """A request for a single position."""
+    query = urllib.parse.urlencode({'fen': fen})
+    return f'GET /position?{query} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode()
+
+
+def positions_request(host: str, fens: List[str]) -> bytes:
+    """A request for a batch of positions."""
+    body = json.dumps({'fens': fens}).encode()
+    head = f'POST /positions HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n'
+    return head.encode() + body
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    """Reads an http response and returns its status."""
+    status = int((await reader.readline()).split()[1])
+    headers = await query_server.read_headers(reader)
+    await reader.readexactly(int(headers.get('content-length', '0')))
+    return status
+
+
+async def run_client(host: str, port: int, requests: List[bytes], latencies: List[float]) -> None:
+    """Sends requests one after another on a single connection, as a service which looks up positions would."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for request in requests:
+        start = time.perf_counter()
+        writer.write(request)
+        status = await read_response(reader)
+        latencies.append(time.perf_counter() - start)
+        if status not in (200, 404):
+            raise RuntimeError(f'Unexpected status {status}')
+    writer.close()
+    await writer.wait_closed()
+
+
+async def load_test(
+        host: str, port: int, fens: List[str], connections: int, request_count: int, batch_size: int) -> LoadTestResult:
+    """Sends request_count requests for random fens over a number of connections at once."""
+    generator = random.Random(0)
+
+    def request() -> bytes:
+        if batch_size == 1:
+            return position_request(host, generator.choice(fens))
+        return positions_request(host, generator.choices(fens, k=batch_size))
+
+    latencies: List[float] = []
+    requests = [request() for _ in range(request_count)]
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(run_client(host, port, requests[client::connections], latencies) for client in range(connections)))
+    return LoadTestResult(latencies, time.perf_counter() - start)
+
+
+def main() -> None:
+    """Load tests a query server started with 'opex serve'."""
+    parser = argparse.ArgumentParser(description='Load test a running query server.')
+    parser.add_argument('database', help='database which the server reads, to sample fens from')
+    parser.add_argument('--host', default=query_server.DEFAULT_HOST, help='address of the server')
+    parser.add_argument('--port', type=int, default=query_server.DEFAULT_PORT, help='port of the server')
+    parser.add_argument('--connections', type=int, default=16, help='number of clients sending requests at once')
+    parser.add_argument('--requests', type=int, default=20000, help='number of requests to send')
+    parser.add_argument('--batch-size', type=int, default=1, help='number of fens in each request')
+    parser.add_argument('--fens', type=int, default=10000, help='number of distinct fens to request')
+    args = parser.parse_args()
+
+    fens = sample_fens(args.database, args.fens)
+    if not fens:
+        raise ValueError(f'{args.database} has no positions')
+    result = asyncio.run(load_test(args.host, args.port, fens, args.connections, args.requests, args.batch_size))
+    latencies = sorted(result.latencies)
+    print(
+        f'{len(latencies)} requests of {args.batch_size} positions in {result.seconds:.2f}s, '
+        f'{len(latencies) / result.seconds:.0f} requests per second')
+    print(
+        f'p50 {percentile(latencies, 0.5) * 1000:.2f}ms, p99 {percentile(latencies, 0.99) * 1000:.2f}ms, '
+        f'max {latencies[-1] * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""A minimal uci engine for tests, which scores positions deterministically from their fen.
+
+Run as 'mock_engine.py crash|stall PATH' it fails instead of searching while the count in the file at PATH is positive,
+and decrements the count each time, so that a failure can be shared across restarts.
+"""
+
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import zlib
+
+import chess
+
+from typing import List, Optional, Tuple
+
+
+def send(line: str) -> None:
+    print(line, flush=True)
+
+
+def score_board(board: chess.Board) -> int:
+    """A score in [-50, 50] which only depends on the position."""
+    return zlib.crc32(board.fen().encode()) % 101 - 50  # type: ignore
+
+
+def is_checkmate_after(board: chess.Board, move: chess.Move) -> bool:
+    """Whether a move mates."""
+    board.push(move)
+    checkmate = board.is_checkmate()
+    board.pop()
+    return checkmate
+
+
+def parse_position(tokens: List[str]) -> chess.Board:
+    """Parses the arguments of a uci 'position' command."""
+    if tokens[0] == 'startpos':
+        board = chess.Board()
+        tokens = tokens[1:]
+    else:
+        fen_end = tokens.index('moves') if 'moves' in tokens else len(tokens)
+        board = chess.Board(' '.join(tokens[1:fen_end]))
+        tokens = tokens[fen_end:]
+    for move in tokens[1:]:
+        board.push_uci(move)
+    return board
+
+
+def search(board: chess.Board, tokens: List[str]) -> None:
+    """Reports a search to the requested depth, or to an arbitrary depth until stopped.
+
+    The score and best move are the same at every depth.
+    """
+    depth = int(tokens[tokens.index('depth') + 1]) if 'depth' in tokens else 30
+    moves = list(board.legal_moves)
+    score = f'cp {score_board(board)}'
+    for move in moves:
+        if board.gives_check(move) and is_checkmate_after(board, move):
+            # Mates in one are found at every depth
+            (moves, score) = ([move], 'mate 1')
+            break
+    for current_depth in range(1, depth + 1):
+        send(f'info depth {current_depth} seldepth {current_depth} score {score} nodes {current_depth} pv {moves[0]}')
+    if 'infinite' in tokens or 'depth' not in tokens:
+        for line in sys.stdin:
+            if line.strip() == 'stop':
+                break
+    send(f'bestmove {moves[0]}')
+
+
+def take_failure(failure: Optional[Tuple[str, str]]) -> Optional[str]:
+    """The kind of failure to simulate instead of the next search, if any are left."""
+    if failure is None:
+        return None
+    (kind, path) = failure
+    with open(path) as count_file:
+        count = int(count_file.read())
+    if count <= 0:
+        return None
+    with open(path, 'w') as count_file:
+        count_file.write(str(count - 1))
+    return kind
+
+
+def fail(kind: str) -> None:
+    """Exits without a word, or stops responding to everything."""
+    if kind == 'crash':
+        os._exit(1)  # pylint: disable=protected-access
+    while True:
+        time.sleep(1)
+
+
+def main() -> None:
+    """Responds to uci commands on stdin."""
+    failure = (sys.argv[1], sys.argv[2]) if len(sys.argv) == 3 else None
+    board = chess.Board()
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == 'uci':
+            send('id name MockEngine')
+            send('option name Threads type spin default 1 min 1 max 64')
+            send('option name Hash type spin default 16 min 1 max 1024')
+            send('uciok')
+        elif command == 'isready':
+            send('readyok')
+        elif command == 'position':
+            board = parse_position(tokens[1:])
+        elif command == 'go':
+            kind = take_failure(failure)
+            if kind is not None:
+                fail(kind)
+            search(board, tokens[1:])
+        elif command == 'quit':
+            return
+
+
+if __name__ == '__main__':
+    main()
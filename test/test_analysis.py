@@ -0,0 +1,49 @@
+"""Tests for analysis."""
+
+import unittest
+
+from opex import analysis
+from opex.analysis import EngineAnalysis
+from opex.analysis import Position
+
+TEST_FEN = 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1'
+
+TEST_ANALYSES = [
+    EngineAnalysis('shallow', -20, 18, 'e7e5'),
+    EngineAnalysis('deep', -40, 24, 'c7c5 g1f3'),
+    EngineAnalysis('deep_too', 30, 24, 'e7e6'),
+]
+
+
+class TestAnalysis(unittest.TestCase):
+
+    def test_reconcile_analyses__deepest__first_deepest_engine_wins(self):
+        self.assertEqual(
+            Position(None, TEST_FEN, -40, 24, 'c7c5 g1f3'),
+            analysis.reconcile_analyses(TEST_FEN, TEST_ANALYSES, 'deepest'))
+
+    def test_reconcile_analyses__mean__averages_scores(self):
+        self.assertEqual(
+            Position(None, TEST_FEN, -10, 24, 'c7c5 g1f3'),
+            analysis.reconcile_analyses(TEST_FEN, TEST_ANALYSES, 'mean'))
+
+    def test_reconcile_analyses__pessimistic__lowest_score(self):
+        self.assertEqual(
+            Position(None, TEST_FEN, -40, 24, 'c7c5 g1f3'),
+            analysis.reconcile_analyses(TEST_FEN, TEST_ANALYSES, 'pessimistic'))
+
+    def test_reconcile_analyses__single_analysis(self):
+        for policy in analysis.RECONCILIATION_POLICIES:
+            self.assertEqual(
+                Position(None, TEST_FEN, -20, 18, 'e7e5'),
+                analysis.reconcile_analyses(TEST_FEN, TEST_ANALYSES[:1], policy))
+
+    def test_reconcile_analyses__no_analyses(self):
+        with self.assertRaises(ValueError) as error:
+            analysis.reconcile_analyses(TEST_FEN, [], 'deepest')
+        self.assertTrue('No analysis to reconcile' in str(error.exception))
+
+    def test_reconcile_analyses__unknown_policy(self):
+        with self.assertRaises(ValueError) as error:
+            analysis.reconcile_analyses(TEST_FEN, TEST_ANALYSES, 'unknown')
+        self.assertTrue('Unknown reconciliation policy \'unknown\'' in str(error.exception))
@@ -0,0 +1,104 @@
+"""Tests for annotate."""
+
+import io
+import os
+import tempfile
+import unittest
+
+import chess
+from chess import pgn
+
+from opex import annotate
+from opex import db_wrapper
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+
+GAMES = """[Event "One"]
+[White "A"]
+[Black "B"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 1-0
+
+[Event "Two"]
+[White "C"]
+[Black "D"]
+[Result "0-1"]
+
+1. d4 d5 0-1
+"""
+
+
+def build_book(database: db_wrapper.Database) -> None:
+    """Stores the positions after 1. e4 e5 2. Nf3 and after 1. d4, with scores relative to the side to move."""
+    lines = {'e2e4': -20, 'e2e4 e7e5': 25, 'e2e4 e7e5 g1f3': -30, 'd2d4': -20}
+    board = chess.Board()
+    root_id = database.insert_position(Position(None, board.fen(), 20, 20, ''), None).position_id
+    ids = {'': typing.cast(int, root_id)}
+    for moves, score in lines.items():
+        board = chess.Board()
+        for move in moves.split():
+            board.push_uci(move)
+        relationship = ParentRelationship(ids[' '.join(moves.split()[:-1])], moves.split()[-1])
+        position = database.insert_position(Position(None, board.fen(), score, 20, ''), relationship)
+        ids[moves] = typing.cast(int, position.position_id)
+
+
+class TestAnnotate(unittest.TestCase):
+
+    def test_split_games(self):
+        texts = list(annotate.split_games(io.StringIO(GAMES)))
+        self.assertEqual(2, len(texts))
+        self.assertTrue(texts[1].startswith('[Event "Two"]'))
+
+    def test_annotate_game__leaves_book__drops_of_book_moves(self):
+        with db_wrapper.Database() as database:
+            build_book(database)
+            game = typing.cast(pgn.Game, pgn.read_game(io.StringIO(GAMES)))
+            positions = database.get_positions(annotate.game_fens(game))
+            # e4 keeps the score of the start, e5 loses 5 and Nf3 gains, which is no loss
+            self.assertEqual(annotate.GameAnnotation(3, 'Nc6', [0, 5, 0]), annotate.annotate_game(game, positions))
+
+    def test_annotate_game__ends_in_book(self):
+        with db_wrapper.Database() as database:
+            build_book(database)
+            game = typing.cast(pgn.Game, pgn.read_game(io.StringIO('1. e4 e5 *')))
+            positions = database.get_positions(annotate.game_fens(game))
+            self.assertEqual(annotate.GameAnnotation(2, None, [0, 5]), annotate.annotate_game(game, positions))
+
+    def test_annotate_files__csv__rows_in_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_path = os.path.join(directory, 'test.db')
+            with db_wrapper.Database(database_path) as database:
+                build_book(database)
+            pgn_path = os.path.join(directory, 'games.pgn')
+            with open(pgn_path, 'w') as pgn_file:
+                pgn_file.write(GAMES * 3)
+            output = io.StringIO()
+            self.assertEqual(6, annotate.annotate_files(database_path, [pgn_path], output, 'csv', 2, batch_size=1))
+            lines = output.getvalue().splitlines()
+            self.assertEqual(','.join(annotate.CSV_COLUMNS), lines[0])
+            self.assertEqual('1,A,B,1-0,3,Nc6,5,0 5 0', lines[1])
+            self.assertEqual('2,C,D,0-1,1,d5,0,0', lines[2])
+            self.assertEqual([str(number) for number in range(1, 7)], [line.split(',')[0] for line in lines[1:]])
+
+    def test_annotate_files__pgn__book_moves_commented(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database_path = os.path.join(directory, 'test.db')
+            with db_wrapper.Database(database_path) as database:
+                build_book(database)
+            pgn_path = os.path.join(directory, 'games.pgn')
+            with open(pgn_path, 'w') as pgn_file:
+                pgn_file.write(GAMES)
+            output = io.StringIO()
+            annotate.annotate_files(database_path, [pgn_path], output, 'pgn', 1)
+            game = typing.cast(pgn.Game, pgn.read_game(io.StringIO(output.getvalue())))
+            self.assertEqual(
+                ['book, drop 0', 'book, drop 5', 'book, drop 0', 'left book'],
+                [node.comment for node in game.mainline()])
+
+    def test_annotate_files__unknown_format__raises(self):
+        with self.assertRaises(ValueError):
+            annotate.annotate_files('missing.db', [], io.StringIO(), 'json')
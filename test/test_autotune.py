@@ -0,0 +1,110 @@
+"""Tests for autotune."""
+
+from test import test_engines
+import unittest
+
+from chess import engine
+
+from opex import autotune
+from opex import engines
+from opex.autotune import EngineConfiguration
+
+from typing import List
+
+
+def open_mock_engine(options: engine.ConfigMapping) -> engine.SimpleEngine:
+    return engines.open_engine_with_options(test_engines.MOCK_ENGINE_COMMAND, options)  # type: ignore
+
+
+def mock_engine_options() -> List[engine.Option]:
+    with engine.SimpleEngine.popen_uci(test_engines.MOCK_ENGINE_COMMAND) as uci_engine:
+        return list(uci_engine.options.values())
+
+
+class TestAutotune(unittest.TestCase):
+
+    def test_sample_boards__every_line_legal(self):
+        boards = autotune.sample_boards()
+        self.assertEqual(len(autotune.SAMPLE_LINES), len({board.fen() for board in boards}))  # type: ignore
+        self.assertEqual(2, len(autotune.sample_boards(2)))
+
+    def test_candidate_configurations__every_core_used(self):
+        self.assertEqual(
+            [
+                EngineConfiguration(6, 1, 64),
+                EngineConfiguration(3, 2, 64),
+                EngineConfiguration(3, 2, 256),
+                EngineConfiguration(1, 4, 64),
+                EngineConfiguration(1, 4, 256),
+            ], autotune.candidate_configurations(6, [64, 256], max_total_hash=800))
+
+    def test_default_max_total_hash__part_of_memory(self):
+        self.assertGreater(autotune.default_max_total_hash(), 0)
+
+    def test_configured_options__out_of_range__raises(self):
+        default_options = mock_engine_options()
+        self.assertEqual(
+            {
+                'Threads': 2,
+                'Hash': 32
+            }, autotune.configured_options(default_options, {}, EngineConfiguration(1, 2, 32)))
+        with self.assertRaises(ValueError):
+            autotune.configured_options(default_options, {}, EngineConfiguration(1, 128, 32))
+
+    def test_autotune__configurations_benchmarked_best_first(self):
+        configurations = [EngineConfiguration(2, 1, 16), EngineConfiguration(1, 2, 16), EngineConfiguration(1, 2, 4096)]
+        results = autotune.autotune(
+            open_mock_engine, mock_engine_options(), {}, configurations, autotune.sample_boards(2), 5)
+        self.assertEqual({configurations[0], configurations[1]}, {result.configuration for result in results})
+        self.assertGreaterEqual(results[0].positions_per_hour, results[1].positions_per_hour)
+        for result in results:
+            self.assertGreater(result.time_to_depth, 0)
+        self.assertEqual(3, len(autotune.format_results(results)))
+
+    def test_tuned_engine_settings__copies_replace_previous_copies(self):
+        engine_settings = [
+            {
+                'nickname': 'other',
+                'path': 'other'
+            },
+            {
+                'nickname': 'sf',
+                'path': 'stockfish'
+            },
+            {
+                'nickname': 'sf-2',
+                'path': 'stockfish'
+            },
+            {
+                'nickname': 'sf-old',
+                'path': 'stockfish'
+            },
+        ]
+        self.assertEqual(
+            [
+                {
+                    'nickname': 'other',
+                    'path': 'other'
+                },
+                {
+                    'nickname': 'sf',
+                    'path': 'stockfish'
+                },
+                {
+                    'nickname': 'sf-2',
+                    'path': 'stockfish'
+                },
+                {
+                    'nickname': 'sf-3',
+                    'path': 'stockfish'
+                },
+                {
+                    'nickname': 'sf-old',
+                    'path': 'stockfish'
+                },
+            ], autotune.tuned_engine_settings(engine_settings, 'sf', 3))  # type: ignore
+        self.assertEqual(
+            [{
+                'nickname': 'sf',
+                'path': 'stockfish'
+            }], autotune.tuned_engine_settings(engine_settings[1:3], 'sf', 1))  # type: ignore
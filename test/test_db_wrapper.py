@@ -1,14 +1,20 @@
 """Tests for db_wrapper."""
 
+import os
+import sqlite3
+import tempfile
 import unittest
 
 import chess
 
+from opex import analysis
 from opex import db_wrapper
+from opex.analysis import EngineAnalysis
 from opex.analysis import ParentRelationship
 from opex.analysis import Position
 
 import typing
+from typing import Dict
 
 
 class TestDBWrapper(unittest.TestCase):
@@ -22,6 +28,29 @@ class TestDBWrapper(unittest.TestCase):
             self.assertEqual(2, cursor.fetchone()['count()'])
             self.assertEqual(None, cursor.fetchone())
 
+    def test_init__database_of_earlier_schema__migrated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'old.db')
+            connection = sqlite3.connect(path)
+            connection.executescript(
+                'CREATE TABLE openings (id INTEGER PRIMARY KEY AUTOINCREMENT, fen UNIQUE, score, depth, pv, '
+                '  visits DEFAULT 0);'
+                'CREATE TABLE game_dag (parent_id, child_id, move);'
+                'CREATE TABLE frontier (parent_id, move, status, claimed_at, PRIMARY KEY (parent_id, move));'
+                'INSERT INTO openings (fen, score, depth, pv) VALUES (\'root\', 10, 20, \'e2e4\');'
+                'INSERT INTO game_dag VALUES (1, 1, \'e2e4\');'
+                'INSERT INTO game_dag VALUES (1, 1, \'e2e4\');')
+            connection.close()
+            with db_wrapper.Database(path) as database:
+                root = typing.cast(Position, database.get_position('root'))
+                self.assertEqual((10, 0, 0), (root.score, root.legal_move_count, root.terminal))
+                database.enqueue_expansions([(ParentRelationship(1, 'd2d4'), 5)])
+                self.assertEqual([analysis.FrontierEntry(1, 'd2d4', 'root')], database.claim_pending_expansions(1))
+                self.assertEqual(1, database.query('SELECT count() AS count FROM game_dag').fetchone()['count'])
+                self.assertEqual(
+                    db_wrapper.SCHEMA_VERSION,
+                    database.query('PRAGMA user_version').fetchone()['user_version'])
+
     def test_insert_position(self):
         with db_wrapper.Database() as database:
             board = chess.Board()
@@ -36,3 +65,255 @@ class TestDBWrapper(unittest.TestCase):
             insert_position = database.insert_position(Position(None, fen, 0.0, 1, 'e4'), ParentRelationship(0, 'e2e4'))
             position = typing.cast(Position, database.get_position(fen))
             self.assertEqual(insert_position.position_id, position.position_id)
+
+    def test_insert_position__duplicate_fen__nothing_inserted(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            database.insert_position(Position(None, fen, 0.0, 1, 'e4'), None)
+            with self.assertRaises(sqlite3.IntegrityError):
+                database.insert_position(Position(None, fen, 0.0, 1, 'e4'), ParentRelationship(1, 'e2e4'))
+            self.assertEqual({}, database.get_child_positions(1))
+
+    def test_checkpoint__writes_visible_to_other_connections_after_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            fen = chess.Board().fen()  # type: ignore
+            with db_wrapper.Database(path, checkpoint_interval=10) as database:
+                database.insert_position(Position(None, fen, 0.0, 1, 'e4'), None)
+                with db_wrapper.Database(path) as other_database:
+                    self.assertIsNone(other_database.get_position(fen))
+                    database.checkpoint()
+                    self.assertIsNotNone(other_database.get_position(fen))
+
+    def test_close__uncommitted_writes_are_saved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            fen = chess.Board().fen()  # type: ignore
+            with db_wrapper.Database(path, checkpoint_interval=10) as database:
+                database.insert_position(Position(None, fen, 0.0, 1, 'e4'), None)
+            with db_wrapper.Database(path) as database:
+                self.assertIsNotNone(database.get_position(fen))
+
+    def test_read_only__reads_existing_database__writes_fail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            fen = chess.Board().fen()  # type: ignore
+            with db_wrapper.Database(path) as database:
+                database.insert_position(Position(None, fen, 0.0, 1, 'e4'), None)
+            with db_wrapper.Database(path, read_only=True) as database:
+                self.assertIsNotNone(database.get_position(fen))
+                with self.assertRaises(sqlite3.OperationalError):
+                    database.insert_position(Position(None, 'other', 0.0, 1, ''), None)
+            with self.assertRaises(sqlite3.OperationalError):
+                db_wrapper.Database(os.path.join(directory, 'missing.db'), read_only=True)
+
+    def test_increment_visits(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            position_id = typing.cast(
+                int,
+                database.insert_position(Position(None, fen, 0.0, 1, 'e4'), None).position_id)
+            database.increment_visits(position_id)
+            database.increment_visits(position_id)
+            self.assertEqual(2, typing.cast(Position, database.get_position(fen)).visits)
+
+    def test_insert_position__completes_claimed_expansion(self):
+        with db_wrapper.Database() as database:
+            board = chess.Board()
+            root = database.insert_position(Position(None, board.fen(), 0.0, 1, 'e2e4'), None)  # type: ignore
+            relationship = ParentRelationship(typing.cast(int, root.position_id), 'e2e4')
+            database.claim_expansions([relationship])
+            board.push_uci('e2e4')
+            database.insert_position(Position(None, board.fen(), 0.0, 1, 'e7e5'), relationship)  # type: ignore
+            self.assertEqual(0, database.requeue_in_flight())
+            self.assertEqual([], database.claim_pending_expansions(1))
+
+    def test_requeue_in_flight__pending_expansions_can_be_claimed(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            root_id = typing.cast(int, database.insert_position(Position(None, fen, 0.0, 1, 'e2e4'), None).position_id)
+            database.claim_expansions([ParentRelationship(root_id, 'e2e4'), ParentRelationship(root_id, 'd2d4')])
+            self.assertEqual([], database.claim_pending_expansions(1))
+            self.assertEqual(2, database.requeue_in_flight())
+            self.assertEqual([analysis.FrontierEntry(root_id, 'e2e4', fen)], database.claim_pending_expansions(1))
+            self.assertEqual([analysis.FrontierEntry(root_id, 'd2d4', fen)], database.claim_pending_expansions(1))
+            self.assertEqual([], database.claim_pending_expansions(1))
+
+    def test_requeue_expansions__repeated_failures__lowered_then_given_up(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            root_id = typing.cast(int, database.insert_position(Position(None, fen, 0.0, 1, 'e2e4'), None).position_id)
+            relationship = ParentRelationship(root_id, 'e2e4')
+            database.enqueue_expansions([(relationship, 50), (ParentRelationship(root_id, 'a2a3'), 0)])
+            self.assertEqual([analysis.FrontierEntry(root_id, 'e2e4', fen)], database.claim_pending_expansions(1))
+            self.assertEqual(0, database.requeue_expansions([relationship]))
+            # The failed expansion is now behind the other one
+            self.assertEqual(['a2a3', 'e2e4'], [entry.move for entry in database.claim_pending_expansions(2)])
+            for _ in range(db_wrapper.MAX_EXPANSION_ATTEMPTS - 2):
+                self.assertEqual(0, database.requeue_expansions([relationship]))
+                database.claim_expansions([relationship])
+            self.assertEqual(1, database.requeue_expansions([relationship]))
+            # Only the other expansion, which is still in flight, is claimed again
+            self.assertEqual(1, database.requeue_in_flight())
+            self.assertEqual(['a2a3'], [entry.move for entry in database.claim_pending_expansions(2)])
+
+    def test_claim_pending_expansions__highest_priority_first(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            root_id = typing.cast(int, database.insert_position(Position(None, fen, 0.0, 1, 'e2e4'), None).position_id)
+            database.enqueue_expansions(
+                [(ParentRelationship(root_id, 'a2a3'), -10), (ParentRelationship(root_id, 'e2e4'), 50)])
+            # Moves which are already in the frontier keep their priority
+            database.enqueue_expansions([(ParentRelationship(root_id, 'a2a3'), 100)])
+            self.assertEqual([analysis.FrontierEntry(root_id, 'e2e4', fen)], database.claim_pending_expansions(1))
+            self.assertEqual([analysis.FrontierEntry(root_id, 'a2a3', fen)], database.claim_pending_expansions(1))
+
+    def test_increment_visits__priority_penalty__pending_moves_lowered(self):
+        with db_wrapper.Database() as database:
+            fen = chess.Board().fen()  # type: ignore
+            root_id = typing.cast(int, database.insert_position(Position(None, fen, 0.0, 1, 'e2e4'), None).position_id)
+            database.enqueue_expansions([(ParentRelationship(root_id, 'e2e4'), 0)])
+            database.increment_visits(root_id, 10)
+            cursor = database.query('SELECT priority FROM frontier WHERE parent_id = ?', (root_id,))
+            self.assertEqual(-10, cursor.fetchone()['priority'])
+
+    def test_insert_position__child__parent_bookkeeping_updated(self):
+        with db_wrapper.Database() as database:
+            board = chess.Board()
+            root = database.insert_position(
+                Position(None, board.fen(), 0.0, 1, '').with_status(20, 0), None)  # type: ignore
+            root_id = typing.cast(int, root.position_id)
+            self.assertFalse(typing.cast(Position, database.get_position(root.fen)).is_fully_expanded())
+            board.push_uci('e2e4')
+            child = Position(None, board.fen(), 0.0, 1, '').with_status(20, 0)  # type: ignore
+            database.insert_position(child, ParentRelationship(root_id, 'e2e4'))
+            root = typing.cast(Position, database.get_position(root.fen))
+            self.assertEqual(20, root.legal_move_count)
+            self.assertEqual(1, root.expanded_count)
+            self.assertFalse(root.is_fully_expanded())
+            self.assertEqual(20, database.get_child_positions(root_id)['e2e4'].legal_move_count)
+
+    def test_insert_transposition__last_move__parent_fully_expanded(self):
+        with db_wrapper.Database() as database:
+            board = chess.Board('7k/8/8/8/8/8/8/K7 w - - 0 1')
+            parent = database.insert_position(
+                Position(None, board.fen(), 0.0, 1, '').with_status(1, 0), None)  # type: ignore
+            board.push_uci('a1a2')
+            child = database.insert_position(Position(None, board.fen(), 0.0, 1, ''), None)  # type: ignore
+            parent_id = typing.cast(int, parent.position_id)
+            database.insert_transposition(ParentRelationship(parent_id, 'a1a2'), typing.cast(int, child.position_id))
+            self.assertTrue(typing.cast(Position, database.get_position(parent.fen)).is_fully_expanded())
+            self.assertEqual(child.position_id, database.get_child_positions(parent_id)['a1a2'].position_id)
+            # pylint: disable=protected-access
+            cursor = database._db.execute('SELECT fully_expanded FROM openings WHERE id = ?', (parent_id,))
+            self.assertEqual(1, cursor.fetchone()['fully_expanded'])
+
+    def test_get_positions__more_fens_than_a_chunk__keyed_by_fen(self):
+        with db_wrapper.Database() as database:
+            count = db_wrapper.BULK_LOOKUP_CHUNK_SIZE * 2 + 1
+            for i in range(count):
+                database.insert_position(Position(None, f'fen {i}', i, 1, ''), None)
+            fens = [f'fen {i}' for i in range(count)] + ['missing', 'fen 0']
+            positions = database.get_positions(fens)
+            self.assertEqual(count, len(positions))
+            for i in range(count):
+                self.assertEqual(database.get_position(f'fen {i}'), positions[f'fen {i}'])
+
+    def test_get_children_many__every_parent_is_a_key(self):
+        with db_wrapper.Database() as database:
+            root_id = typing.cast(int, database.insert_position(Position(None, 'root', 0, 1, ''), None).position_id)
+            child = database.insert_position(Position(None, 'child', 0, 1, ''), ParentRelationship(root_id, 'e2e4'))
+            child_id = typing.cast(int, child.position_id)
+            children = database.get_children_many([root_id, child_id])
+            self.assertEqual({root_id: database.get_child_positions(root_id), child_id: {}}, children)
+            self.assertEqual(child, children[root_id]['e2e4'])
+
+    def test_get_subtree_levels__transposition__returned_once(self):
+        with db_wrapper.Database() as database:
+            root_id = typing.cast(int, database.insert_position(Position(None, 'root', 0, 1, ''), None).position_id)
+            ids: Dict[str, int] = {}
+            for name, parent, move in [('a', 'root', 'a'), ('b', 'root', 'b'), ('ac', 'a', 'c'), ('acd', 'ac', 'd')]:
+                parent_id = ids.get(parent, root_id)
+                position = database.insert_position(Position(None, name, 0, 1, ''), ParentRelationship(parent_id, move))
+                ids[name] = typing.cast(int, position.position_id)
+            database.insert_transposition(ParentRelationship(ids['b'], 'c'), ids['ac'])
+            levels = [set(level) for level in database.get_subtree_levels(root_id)]
+            self.assertEqual([{ids['a'], ids['b']}, {ids['ac']}, {ids['acd']}], levels)
+            self.assertEqual(2, len(list(database.get_subtree_levels(root_id, max_depth=2))))
+
+    def test_merge__positions_matched_by_fen__deeper_analysis_kept(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source_path = os.path.join(directory, 'source.db')
+            board = chess.Board()
+            root_fen = board.fen()  # type: ignore
+            board.push_uci('e2e4')
+            e4_fen = board.fen()  # type: ignore
+            with db_wrapper.Database(source_path) as source:
+                # The source has another position first, so its ids differ from the target's
+                source.insert_position(Position(None, 'other', 0, 1, ''), None)
+                root = source.insert_position(Position(None, root_fen, 30, 25, 'e2e4').with_status(20, 0), None)
+                root_id = typing.cast(int, root.position_id)
+                e4_position = source.insert_position(
+                    Position(None, e4_fen, -30, 25, 'e7e5').with_status(20, 0), ParentRelationship(root_id, 'e2e4'),
+                    [EngineAnalysis('one', -30, 25, 'e7e5')])
+                source.enqueue_expansions([(ParentRelationship(typing.cast(int, e4_position.position_id), 'e7e5'), 0)])
+            with db_wrapper.Database() as database:
+                root = database.insert_position(Position(None, root_fen, 20, 20, 'd2d4').with_status(20, 0), None)
+                database.increment_visits(typing.cast(int, root.position_id))
+                root_id = typing.cast(int, root.position_id)
+                database.enqueue_expansions([(ParentRelationship(root_id, 'e2e4'), 0)])
+                self.assertEqual((2, 1), database.merge(source_path, batch_size=1))
+                root = typing.cast(Position, database.get_position(root_fen))
+                self.assertEqual(
+                    (30, 25, 'e2e4', 1, 1), (root.score, root.depth, root.pv, root.visits, root.expanded_count))
+                e4_position = database.get_child_positions(root_id)['e2e4']
+                self.assertEqual(e4_fen, e4_position.fen)
+                self.assertEqual(
+                    [EngineAnalysis('one', -30, 25, 'e7e5')],
+                    database.get_engine_analyses(typing.cast(int, e4_position.position_id)))
+                # The expansion of e2e4 was completed by the merge, the expansion of e7e5 is merged
+                self.assertEqual(
+                    [analysis.FrontierEntry(typing.cast(int, e4_position.position_id), 'e7e5', e4_fen)],
+                    database.claim_pending_expansions(2))
+                self.assertEqual((0, 0), database.merge(source_path))
+                self.assertEqual(1, len(database.get_engine_analyses(typing.cast(int, e4_position.position_id))))
+
+    def test_merge__missing_source__raises(self):
+        with db_wrapper.Database() as database:
+            with self.assertRaises(FileNotFoundError):
+                database.merge('missing.db')
+
+    def test_prune__hopeless_moves_and_unreachable_positions_deleted(self):
+        with db_wrapper.Database() as database:
+            ids: Dict[str, int] = {}
+            # Scores are relative to the side to move, so the move to a is the best move from the root
+            for name, score, legal_move_count in [('root', 0, 3), ('a', 0, 1), ('b', 400, 2), ('c', 350, 0),
+                                                  ('t', 0, 0), ('u', 0, 0)]:
+                position = Position(None, name, score, 20, '').with_status(legal_move_count, 0)
+                ids[name] = typing.cast(int, database.insert_position(position, None).position_id)
+            for parent, child in [('root', 'a'), ('root', 'b'), ('root', 'c'), ('a', 't'), ('b', 't'), ('b', 'u')]:
+                database.insert_transposition(ParentRelationship(ids[parent], child), ids[child])
+            database.enqueue_expansions([(ParentRelationship(ids['root'], 'b'), 0)], 'deepen')
+            database.enqueue_expansions([(ParentRelationship(ids['u'], 'x'), 0)])
+            database.insert_position(Position(None, 'other root', 0, 20, ''), None)
+            result = database.prune(300, keep=[ParentRelationship(ids['root'], 'c')])
+            self.assertEqual(db_wrapper.PruneResult(1, 2), result)
+            self.assertEqual(['a', 'c'], sorted(database.get_child_positions(ids['root'])))
+            # t is still reached from a, and the other root is kept
+            self.assertIsNotNone(database.get_position('t'))
+            self.assertIsNotNone(database.get_position('other root'))
+            self.assertIsNone(database.get_position('b'))
+            self.assertIsNone(database.get_position('u'))
+            self.assertEqual([], database.claim_pending_expansions(2))
+            self.assertEqual(3, typing.cast(Position, database.get_position('root')).expanded_count)
+
+    def test_prune__shallow_or_partially_expanded__kept(self):
+        with db_wrapper.Database() as database:
+            root = database.insert_position(Position(None, 'root', 0, 20, '').with_status(3, 0), None)
+            root_id = typing.cast(int, root.position_id)
+            for name, score, depth in [('a', 0, 20), ('b', 400, 8)]:
+                database.insert_position(Position(None, name, score, depth, ''), ParentRelationship(root_id, name))
+            self.assertEqual(db_wrapper.PruneResult(0, 0), database.prune(300))
+            database.insert_position(Position(None, 'c', 0, 20, ''), ParentRelationship(root_id, 'c'))
+            self.assertEqual(db_wrapper.PruneResult(0, 0), database.prune(300, min_depth=10))
+            self.assertEqual(db_wrapper.PruneResult(1, 1), database.prune(300))
@@ -0,0 +1,160 @@
+"""Tests for distributed."""
+
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+import chess
+from chess import engine
+
+from opex import db_wrapper
+from opex import distributed
+from opex import query
+from opex import search
+from opex import supervisor
+from opex.analysis import Position
+from opex.settings_loader import Json
+
+import typing
+from typing import List
+
+MOCK_ENGINE_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_engine.py')]
+
+
+class FakeClock:
+    """A clock which only moves when told to."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def result_for(job: distributed.Job, score: int = 0) -> typing.Dict[str, typing.Any]:
+    return {'job_id': job.job_id, 'fen': job.fen, 'engine': 'test', 'score': score, 'depth': job.depth, 'pv': ''}
+
+
+def count_positions(database: db_wrapper.Database) -> int:
+    # pylint: disable=protected-access
+    return database._db.execute('SELECT count() FROM openings').fetchone()['count()']
+
+
+def run_mock_worker(address: distributed.Address) -> None:
+    with engine.SimpleEngine.popen_uci(MOCK_ENGINE_COMMAND) as uci_engine:
+        distributed.run_worker(
+            address, supervisor.EngineSupervisor('mock', uci_engine), batch_size=2, poll_interval=0.05)
+
+
+class TestCoordinator(unittest.TestCase):
+
+    def test_request_jobs__empty_database__root_is_leased_once(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database))
+            jobs = coordinator.request_jobs('worker1', 4)
+            self.assertEqual([distributed.Job('root', chess.STARTING_FEN, 20)], jobs)
+            self.assertEqual([], coordinator.request_jobs('worker2', 4))
+
+    def test_submit_results__root__children_are_leased_to_different_workers(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database))
+            root_job = coordinator.request_jobs('worker1', 1)[0]
+            self.assertEqual(1, coordinator.submit_results('worker1', [result_for(root_job, 30)]))
+            self.assertEqual(30, typing.cast(Position, database.get_position(chess.STARTING_FEN)).score)
+            jobs1 = coordinator.request_jobs('worker1', 8)
+            jobs2 = coordinator.request_jobs('worker2', 16)
+            self.assertEqual(8, len(jobs1))
+            self.assertEqual(12, len(jobs2))
+            self.assertEqual(20, len({job.fen for job in jobs1 + jobs2}))
+            self.assertEqual([], coordinator.request_jobs('worker3', 1))
+            self.assertEqual(20, coordinator.outstanding_jobs())
+
+    def test_request_jobs__lease_expired__job_is_leased_again(self):
+        clock = FakeClock()
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database), lease_timeout=10, clock=clock)
+            coordinator.submit_results('worker1', [result_for(coordinator.request_jobs('worker1', 1)[0])])
+            lost_job = coordinator.request_jobs('worker1', 1)[0]
+            clock.now = 5
+            self.assertNotIn(lost_job, coordinator.request_jobs('worker2', 1))
+            clock.now = 10
+            self.assertEqual([lost_job], coordinator.request_jobs('worker3', 1))
+            self.assertEqual(1, coordinator.submit_results('worker3', [result_for(lost_job)]))
+            # The result of the first worker arrives after the job has been completed
+            self.assertEqual(0, coordinator.submit_results('worker1', [result_for(lost_job)]))
+
+    def test_handle_message__unknown_type(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database))
+            self.assertEqual(
+                {'error': 'Unknown message type \'unknown\''},
+                coordinator.handle_message({
+                    'type': 'unknown',
+                    'worker': 'worker1'
+                }))
+
+    def test_server__several_worker_processes__positions_are_stored(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database), lease_timeout=30)
+            with distributed.CoordinatorServer(('127.0.0.1', 0), coordinator) as server:
+                server.timeout = 0.1
+                address = typing.cast(distributed.Address, server.server_address)
+                workers: List[multiprocessing.Process] = [
+                    multiprocessing.Process(target=run_mock_worker, args=(address,), daemon=True) for _ in range(3)
+                ]
+                for worker in workers:
+                    worker.start()
+                try:
+                    deadline = time.monotonic() + 60
+                    while count_positions(database) < 30 and time.monotonic() < deadline:
+                        server.handle_request()
+                finally:
+                    for worker in workers:
+                        worker.terminate()
+                        worker.join()
+            self.assertGreaterEqual(count_positions(database), 30)
+            root = typing.cast(Position, database.get_position(chess.STARTING_FEN))
+            # Every stored position is connected to the root and was analyzed to the requested depth
+            stats = query.get_tree_stats(database, typing.cast(int, root.position_id))
+            self.assertEqual(count_positions(database), stats.node_count)
+            self.assertEqual([20], [row['depth'] for row in database.query('SELECT DISTINCT depth FROM openings')])
+
+    def test_server__malformed_messages__error_replies(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database))
+            with distributed.CoordinatorServer(('127.0.0.1', 0), coordinator) as server:
+                address = typing.cast(distributed.Address, server.server_address)
+                lines = [b'\xff garbage\n', b'{"type": "request_jobs", "wor\n', b'{"type": "request_jobs"}\n', b'[1]\n']
+                for line in lines:
+                    with self.subTest(line=line), socket.create_connection(address) as connection:
+                        connection.sendall(line)
+                        server.handle_request()
+                        with connection.makefile('rb') as reply:
+                            self.assertIn('Malformed message', json.loads(reply.readline())['error'])
+
+    def test_server__stalled_worker__disconnected_and_next_worker_served(self):
+        with db_wrapper.Database() as database:
+            coordinator = distributed.Coordinator(search.TreeSearch(database))
+            with distributed.CoordinatorServer(('127.0.0.1', 0), coordinator, request_timeout=0.1) as server:
+                address = typing.cast(distributed.Address, server.server_address)
+                replies: List[Json] = []
+                with socket.create_connection(address):
+                    # The stalled connection is accepted first and given up on after the timeout
+                    worker = threading.Thread(
+                        target=lambda: replies.append(
+                            distributed.send_message(
+                                address, {
+                                    'type': 'request_jobs',
+                                    'worker': 'worker1',
+                                    'count': 1
+                                })))
+                    worker.start()
+                    server.handle_request()
+                    server.handle_request()
+                    worker.join()
+            self.assertEqual(1, len(typing.cast(List[Json], replies[0]['jobs'])))
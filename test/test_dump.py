@@ -0,0 +1,100 @@
+"""Tests for dump."""
+
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+from test import test_memory_tree
+import unittest
+
+from opex import db_wrapper
+from opex import dump
+from opex.analysis import Position
+
+import typing
+from typing import Dict, List
+
+_ORDERS = {
+    'openings': 'id',
+    'game_dag': 'parent_id, move',
+    'engine_analysis': 'position_id, engine',
+    'frontier': 'parent_id, move',
+}
+
+
+def table_rows(path: str) -> Dict[str, str]:
+    """The rows of every table, as text which tells integers and floats apart."""
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        return {
+            table: repr(connection.execute(f'SELECT * FROM {table} ORDER BY {order}').fetchall())
+            for table, order in _ORDERS.items()
+        }
+
+
+class TestDump(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db')
+        self.restored_path = os.path.join(self.directory.name, 'restored.db')
+        with db_wrapper.Database(self.path) as database:
+            ids = test_memory_tree.build_tree(database, 2)
+            root_id = min(ids.values())
+            # Rows which cannot be packed: a position which is not a fen, a null pv and a move which is not uci
+            other = database.insert_position(
+                Position(None, 'not a fen', 0.5, 3, None), (root_id, 'resign'))  # type: ignore
+            database.insert_transposition((typing.cast(int, other.position_id), 'e2e4'), max(ids.values()))
+            database.set_tree_scores([(root_id, 12), (typing.cast(int, other.position_id), -0.25)])
+            database.query(
+                'INSERT INTO engine_analysis VALUES (?, ?, ?, ?, ?)', (root_id, 'stockfish', 25, 20, 'e2e4 e7e5'))
+            database.query('INSERT INTO engine_analysis VALUES (?, ?, ?, ?, ?)', (root_id, 'lc0', 18.5, 12, ''))
+            database.query(
+                'INSERT INTO frontier VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (root_id, 'a7a8q', db_wrapper.FRONTIER_IN_FLIGHT, 1234.5, 2.5, 'deepen', 1))
+            database.query(
+                'INSERT INTO frontier (parent_id, move, status, claimed_at) VALUES (?, ?, ?, ?)',
+                (root_id, 'h2h4', db_wrapper.FRONTIER_PENDING, None))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def dump(self, compression: str = dump.DEFAULT_COMPRESSION, chunk_size: int = 7) -> bytes:
+        """Dumps the test database in chunks of a few rows."""
+        output = io.BytesIO()
+        dump.dump_database(self.path, output, compression, chunk_size)
+        return output.getvalue()
+
+    def test_restore_database__dump__same_rows_and_indexes(self):
+        for compression in dump.COMPRESSIONS:
+            with self.subTest(compression=compression):
+                restored_path = os.path.join(self.directory.name, f'{compression}.db')
+                result = dump.restore_database(io.BytesIO(self.dump(compression)), restored_path)
+                self.assertEqual(table_rows(self.path), table_rows(restored_path))
+                self.assertEqual((2, 2), (result.engine_analysis_count, result.frontier_count))
+                with db_wrapper.Database(restored_path) as restored:
+                    index_names = [
+                        row['name'] for row in restored.query('SELECT name FROM sqlite_master WHERE type = \'index\'')
+                    ]
+                    # A position inserted after the restore gets a new id
+                    position = restored.insert_position(Position(None, 'new', 0, 1, ''), None)
+                self.assertIn('game_dag_parent_id_move', index_names)
+                self.assertEqual(result.position_count + 1, position.position_id)
+
+    def test_restore_database__existing_database__refused(self):
+        open(self.restored_path, 'w').close()
+        with self.assertRaises(FileExistsError):
+            dump.restore_database(io.BytesIO(self.dump()), self.restored_path)
+
+    def test_restore_database__bad_dumps__error_and_no_database(self):
+        data = self.dump()
+        bad_dumps: List[bytes] = [b'NOTADUMP' + data[len(dump.MAGIC):], data[:-20], data[:len(dump.MAGIC)]]
+        for bad_dump in bad_dumps:
+            with self.subTest(bad_dump=bad_dump[:10]):
+                with self.assertRaises(ValueError):
+                    dump.restore_database(io.BytesIO(bad_dump), self.restored_path)
+                self.assertFalse(os.path.exists(self.restored_path))
+
+    def test_dump_database__unknown_compression__error(self):
+        with self.assertRaises(ValueError):
+            self.dump('gzip')
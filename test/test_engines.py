@@ -0,0 +1,79 @@
+"""Tests for engines."""
+
+import os
+import sys
+import unittest
+
+import chess
+from chess import engine
+
+from opex import analysis
+from opex import engines
+from opex.analysis import EngineAnalysis
+from opex.engines import DepthInfo
+
+import typing
+
+MOCK_ENGINE_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_engine.py')]
+
+EARLY_STOP = engines.EarlyStop(min_depth=6, stable_depths=3, tolerance=10, decisive_score=400)
+
+
+class InfoEngine:
+    """Finishes every analysis with the same info."""
+
+    def __init__(self, info: engine.InfoDict) -> None:
+        self.info = info
+
+    def analyse(self, board: chess.Board, limit: engine.Limit) -> engine.InfoDict:
+        """The info, whatever the board and limit."""
+        del board, limit
+        return self.info
+
+
+class TestEngines(unittest.TestCase):
+
+    def test_should_stop_early__below_min_depth__continues(self):
+        infos = [DepthInfo(depth, 20, 'e2e4', False) for depth in range(1, 6)]
+        self.assertFalse(engines.should_stop_early(EARLY_STOP, infos))
+
+    def test_should_stop_early__stable_for_enough_depths__stops(self):
+        infos = [DepthInfo(depth, 20 + depth, 'e2e4', False) for depth in range(1, 8)]
+        infos[3] = DepthInfo(4, 24, 'd2d4', False)
+        self.assertFalse(engines.should_stop_early(EARLY_STOP, infos[:7]))
+        infos.append(DepthInfo(8, 28, 'e2e4', False))
+        self.assertTrue(engines.should_stop_early(EARLY_STOP, infos))
+
+    def test_should_stop_early__score_changing__continues(self):
+        infos = [DepthInfo(depth, 20 * depth, 'e2e4', False) for depth in range(1, 12)]
+        self.assertFalse(engines.should_stop_early(EARLY_STOP, infos))
+
+    def test_should_stop_early__decisive_score__stops(self):
+        infos = [DepthInfo(depth, 150 * depth, 'e2e4', False) for depth in range(1, 7)]
+        self.assertTrue(engines.should_stop_early(EARLY_STOP, infos))
+
+    def test_should_stop_early__forced_mate__stops(self):
+        infos = [DepthInfo(5, 0, 'e2e4', False), DepthInfo(6, analysis.MATE_SCORE - 3, 'd1h5', True)]
+        self.assertTrue(engines.should_stop_early(EARLY_STOP, infos))
+
+    def test_analyze_board__early_stop__records_depth_reached(self):
+        with engine.SimpleEngine.popen_uci(MOCK_ENGINE_COMMAND) as uci_engine:
+            # The mock engine reports the same score and best move at every depth
+            early = engines.analyze_board(uci_engine, 'mock', chess.Board(), 20, EARLY_STOP)
+            self.assertEqual(6, early.depth)
+            full = engines.analyze_board(uci_engine, 'mock', chess.Board(), 20)
+            self.assertEqual(20, full.depth)
+            self.assertEqual((full.score, full.pv), (early.score, early.pv))
+
+    def test_analyze_board__early_stop__mate_found(self):
+        board = chess.Board()
+        for move in ['f2f3', 'e7e5', 'g2g4']:
+            board.push_uci(move)
+        with engine.SimpleEngine.popen_uci(MOCK_ENGINE_COMMAND) as uci_engine:
+            engine_analysis = engines.analyze_board(uci_engine, 'mock', board, 20, EARLY_STOP)
+            self.assertEqual(EngineAnalysis('mock', analysis.MATE_SCORE - 1, 6, 'd8h4'), engine_analysis)
+
+    def test_analyze_board__no_score__engine_error(self):
+        uci_engine = typing.cast(engine.SimpleEngine, InfoEngine({'depth': 20}))
+        with self.assertRaises(engine.EngineError):
+            engines.analyze_board(uci_engine, 'mock', chess.Board(), 20)
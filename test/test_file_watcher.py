@@ -0,0 +1,40 @@
+"""Tests for file_watcher."""
+
+import os
+import tempfile
+import unittest
+
+from opex import file_watcher
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'settings.json')
+        with open(self.path, 'w') as file:
+            file.write('{}')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_changed__unchanged__false(self):
+        self.assertFalse(file_watcher.FileWatcher([self.path]).changed())
+
+    def test_changed__modified__true_until_watched_again(self):
+        watcher = file_watcher.FileWatcher([self.path])
+        with open(self.path, 'w') as file:
+            file.write('{"analysis_depth": 30}')
+        self.assertTrue(watcher.changed())
+        watcher.watch([self.path])
+        self.assertFalse(watcher.changed())
+
+    def test_changed__created_and_deleted__true(self):
+        created_path = os.path.join(self.directory.name, 'one.uci')
+        watcher = file_watcher.FileWatcher([created_path])
+        with open(created_path, 'w') as file:
+            file.write('Hash=64')
+        self.assertTrue(watcher.changed())
+        watcher = file_watcher.FileWatcher([self.path])
+        os.remove(self.path)
+        self.assertTrue(watcher.changed())
@@ -0,0 +1,138 @@
+"""Tests for memory_tree."""
+
+import os
+import sqlite3
+import tempfile
+from test import test_opex
+import unittest
+
+import chess
+
+from opex import analysis
+from opex import db_wrapper
+from opex import memory_tree
+from opex import opex
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import Dict, List
+
+
+def build_tree(database: db_wrapper.Database, plies: int) -> Dict[str, int]:
+    """Inserts every position up to a number of plies from the start, returning their ids keyed by fen."""
+    board = chess.Board()
+    root = database.insert_position(Position(None, board.fen(), 0, 1, '').with_status(20, 0), None)  # type: ignore
+    ids = {root.fen: typing.cast(int, root.position_id)}
+    level = [board]
+    for _ in range(plies):
+        next_level: List[chess.Board] = []
+        for parent_board in level:
+            for move in parent_board.legal_moves:
+                board = chess.Board(parent_board.fen())  # type: ignore
+                board.push(move)
+                relationship = ParentRelationship(ids[parent_board.fen()], move.uci())  # type: ignore
+                fen = board.fen()  # type: ignore
+                if fen in ids:
+                    database.insert_transposition(relationship, ids[fen])
+                    continue
+                position = Position(None, fen, len(ids), 10, move.uci()).with_status(board.legal_moves.count(), 0)
+                ids[fen] = typing.cast(int, database.insert_position(position, relationship).position_id)
+                next_level.append(board)
+        level = next_level
+    return ids
+
+
+class TestMemoryTree(unittest.TestCase):
+
+    def test_encode_move__decode_move(self):
+        for uci in ['e2e4', 'a7a8q', 'h2h1n', 'e1g1']:
+            self.assertEqual(uci, memory_tree.decode_move(memory_tree.encode_move(uci)))
+
+    def test_get_child_positions__fens_recomputed(self):
+        with memory_tree.MemoryTree() as tree:
+            ids = build_tree(tree, 2)
+            root_id = ids[chess.STARTING_FEN]
+            children = tree.get_child_positions(root_id)
+            self.assertEqual(20, len(children))
+            board = chess.Board()
+            board.push_uci('e2e4')
+            self.assertEqual(board.fen(), children['e2e4'].fen)  # type: ignore
+            self.assertEqual(children['e2e4'], tree.get_position(board.fen()))  # type: ignore
+            root = typing.cast(Position, tree.get_position(chess.STARTING_FEN))
+            self.assertTrue(root.is_fully_expanded())
+            self.assertIsNone(tree.get_position('missing'))
+
+    def test_insert_position__fen_not_reached_by_move__kept(self):
+        with memory_tree.MemoryTree() as tree:
+            root_id = typing.cast(int, tree.insert_position(Position(None, 'root', 0, 1, ''), None).position_id)
+            tree.insert_position(Position(None, 'child', 5, 1, ''), ParentRelationship(root_id, 'e2e4'))
+            self.assertEqual('child', tree.get_child_positions(root_id)['e2e4'].fen)
+            self.assertEqual(5, typing.cast(Position, tree.get_position('child')).score)
+
+    def test_insert_position__duplicate_fen__raises(self):
+        with memory_tree.MemoryTree() as tree:
+            tree.insert_position(Position(None, chess.STARTING_FEN, 0, 1, ''), None)
+            with self.assertRaises(sqlite3.IntegrityError):
+                tree.insert_position(Position(None, chess.STARTING_FEN, 0, 1, ''), None)
+
+    def test_insert_position__frontier_write_fails__memory_unchanged(self):
+        with memory_tree.MemoryTree() as tree:
+            root_id = typing.cast(int, tree.insert_position(Position(None, 'root', 0, 1, ''), None).position_id)
+            # pylint: disable=protected-access
+            tree._db.execute('DROP TABLE frontier')
+            with self.assertRaises(sqlite3.OperationalError):
+                tree.insert_position(Position(None, 'child', 5, 1, ''), ParentRelationship(root_id, 'e2e4'))
+            self.assertEqual(1, len(tree))
+            self.assertIsNone(tree.get_position('child'))
+            self.assertEqual({}, tree.get_child_positions(root_id))
+            self.assertEqual(0, typing.cast(Position, tree.get_position('root')).expanded_count)
+
+    def test_checkpoint__tree_written_to_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            engine_analysis = analysis.EngineAnalysis('one', 10, 20, 'e7e5')
+            with memory_tree.MemoryTree(path, checkpoint_interval=1000) as tree:
+                ids = build_tree(tree, 2)
+                board = chess.Board()
+                board.push_uci('e2e4')
+                child = typing.cast(Position, tree.get_position(board.fen()))  # type: ignore
+                tree.deepen_position(Position(child.position_id, child.fen, 10, 20, 'e7e5'), None, [engine_analysis])
+                tree.increment_visits(ids[chess.STARTING_FEN])
+                with db_wrapper.Database(path) as database:
+                    self.assertIsNone(database.get_position(chess.STARTING_FEN))
+                    tree.checkpoint()
+                    for fen, position_id in ids.items():
+                        self.assertEqual(tree.get_position(fen), database.get_position(fen))
+                        self.assertEqual(
+                            tree.get_child_positions(position_id), database.get_child_positions(position_id))
+                    self.assertEqual(
+                        [engine_analysis], database.get_engine_analyses(typing.cast(int, child.position_id)))
+            with memory_tree.MemoryTree(path) as tree:
+                root = typing.cast(Position, tree.get_position(chess.STARTING_FEN))
+                self.assertEqual(1, root.visits)
+                self.assertEqual(10, tree.get_child_positions(ids[chess.STARTING_FEN])['e2e4'].score)
+                self.assertEqual(len(ids), len(tree))
+
+    def test_claim_pending_expansions__unflushed_parent(self):
+        with memory_tree.MemoryTree(checkpoint_interval=1000) as tree:
+            root_id = typing.cast(
+                int,
+                tree.insert_position(Position(None, chess.STARTING_FEN, 0, 1, ''), None).position_id)
+            tree.enqueue_expansions([(ParentRelationship(root_id, 'e2e4'), 0)])
+            self.assertEqual(
+                [analysis.FrontierEntry(root_id, 'e2e4', chess.STARTING_FEN)], tree.claim_pending_expansions(1))
+
+    def test_memory_usage__under_100_bytes_per_position(self):
+        with memory_tree.MemoryTree(checkpoint_interval=100000) as tree:
+            build_tree(tree, 2)
+            self.assertLess(tree.memory_usage() / len(tree), 100)
+
+    def test_search__same_tree_as_sqlite(self):
+        trees: List[List[Dict[int, Position]]] = []
+        for database in [db_wrapper.Database(), memory_tree.MemoryTree(checkpoint_interval=10)]:
+            with database, opex.OpeningExplorer(database, test_opex.fake_engines(one=10, two=20)) as explorer:
+                for _ in range(10):
+                    explorer.search(chess.Board())
+                trees.append(list(database.get_subtree_levels(test_opex.get_position_id(database, chess.STARTING_FEN))))
+        self.assertEqual(trees[0], trees[1])
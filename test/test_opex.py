@@ -0,0 +1,341 @@
+"""Tests for opex."""
+
+import argparse
+import json
+import os
+import stat
+import tempfile
+from test import test_engines
+import unittest
+
+import chess
+from chess import engine
+
+from opex import analysis
+from opex import db_wrapper
+from opex import engines
+from opex import opex
+from opex import settings_loader
+from opex.analysis import EngineAnalysis
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+from opex.settings_loader import EngineSettings
+
+import typing
+from typing import Dict, List
+
+
+class FakeEngine:
+    """Analyzes positions instantly with a fixed score and the first legal move as the pv."""
+
+    def __init__(self, score: int = 0) -> None:
+        self.score = score
+        self.analyzed_fens: List[str] = []
+        self.closed = False
+
+    def analyse(self, board: chess.Board, limit: engine.Limit) -> Dict[str, object]:
+        """Records the position and returns the same info keys as a uci engine."""
+        self.analyzed_fens.append(board.fen())  # type: ignore
+        pv = list(board.legal_moves)[:1]
+        return {'score': engine.PovScore(engine.Cp(self.score), board.turn), 'pv': pv, 'depth': limit.depth}
+
+    def quit(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def fake_engines(**scores: int) -> Dict[str, engine.SimpleEngine]:
+    return {nickname: typing.cast(engine.SimpleEngine, FakeEngine(score)) for nickname, score in scores.items()}
+
+
+def get_position_id(database: db_wrapper.Database, fen: str) -> int:
+    return typing.cast(int, typing.cast(Position, database.get_position(fen)).position_id)
+
+
+class TestOpeningExplorer(unittest.TestCase):
+
+    def test_search__empty_database__inserts_root(self):
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, fake_engines(one=10)) as explorer:
+                explorer.search(chess.Board())
+                root = database.get_position(chess.STARTING_FEN)
+                self.assertIsNotNone(root)
+
+    def test_search__split__each_engine_analyzes_a_different_move(self):
+        uci_engines = fake_engines(one=10, two=20, three=30)
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                explorer.search(chess.Board())
+                explorer.search(chess.Board())
+                root = get_position_id(database, chess.STARTING_FEN)
+                children = database.get_child_positions(root)
+                self.assertEqual(3, len(children))
+                analyzed_fens = [
+                    typing.cast(FakeEngine, uci_engine).analyzed_fens for uci_engine in uci_engines.values()
+                ]
+                self.assertEqual(3, len({fens[-1] for fens in analyzed_fens}))
+                for child in children.values():
+                    self.assertEqual(1, len(database.get_engine_analyses(typing.cast(int, child.position_id))))
+
+    def test_search__ensemble__every_engine_analyzes_the_same_move(self):
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, fake_engines(one=10, two=20), True, 'mean') as explorer:
+                explorer.search(chess.Board())
+                explorer.search(chess.Board())
+                root = get_position_id(database, chess.STARTING_FEN)
+                children = database.get_child_positions(root)
+                self.assertEqual(1, len(children))
+                child = next(iter(children.values()))
+                self.assertEqual(15, child.score)
+                analyses = database.get_engine_analyses(typing.cast(int, child.position_id))
+                self.assertEqual(['one', 'two'], [engine_analysis.nickname for engine_analysis in analyses])
+
+    def test_search__root_analyzed__principal_variation_first(self):
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, fake_engines(one=0)) as explorer:
+                for _ in range(3):
+                    explorer.search(chess.Board())
+                root = get_position_id(database, chess.STARTING_FEN)
+                self.assertEqual(['g1h3'], list(database.get_child_positions(root)))
+                child = get_position_id(database, database.get_child_positions(root)['g1h3'].fen)
+                self.assertEqual(['g8h6'], list(database.get_child_positions(child)))
+
+    def test_analyze_board__creates_engine_analysis(self):
+        uci_engine = fake_engines(one=25)['one']
+        self.assertEqual(
+            EngineAnalysis('one', 25, 20, 'g1h3'), engines.analyze_board(uci_engine, 'one', chess.Board(), 20))
+
+    def test_search__restart__in_flight_expansion_is_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            with db_wrapper.Database(path) as database:
+                with opex.OpeningExplorer(database, fake_engines(one=0)) as explorer:
+                    explorer.search(chess.Board())
+                    root = get_position_id(database, chess.STARTING_FEN)
+                    # The process stops while the next expansion is being analyzed
+                    [entry] = database.claim_pending_expansions(1)
+            with db_wrapper.Database(path) as database:
+                self.assertEqual(1, database.requeue_in_flight())
+                uci_engines = fake_engines(one=0)
+                with opex.OpeningExplorer(database, uci_engines) as explorer:
+                    explorer.search(chess.Board())
+                    self.assertEqual([entry.move], list(database.get_child_positions(root)))
+                    self.assertEqual(1, len(typing.cast(FakeEngine, uci_engines['one']).analyzed_fens))
+
+    def test_search__checkmate__inserted_without_analysis(self):
+        board = chess.Board()
+        for move in ['f2f3', 'e7e5', 'g2g4', 'd8h4']:
+            board.push_uci(move)
+        uci_engines = fake_engines(one=0)
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                explorer.search(board)
+                explorer.search(board)
+                position = typing.cast(Position, database.get_position(board.fen()))  # type: ignore
+                self.assertEqual(analysis.CHECKMATE, position.terminal)
+                self.assertEqual(-analysis.MATE_SCORE, position.score)
+                self.assertTrue(position.is_fully_expanded())
+                self.assertEqual([], typing.cast(FakeEngine, uci_engines['one']).analyzed_fens)
+
+    def test_expand_moves__stored_position__linked_as_transposition(self):
+        uci_engines = fake_engines(one=0)
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                transposed_board = chess.Board()
+                for move in ['g1f3', 'g8f6', 'b1c3']:
+                    transposed_board.push_uci(move)
+                explorer.search(transposed_board)
+                board = chess.Board()
+                for move in ['b1c3', 'g8f6']:
+                    board.push_uci(move)
+                explorer.search(board)
+                parent_id = get_position_id(database, board.fen())  # type: ignore
+                explorer.expand(
+                    explorer.tree_search.prepare_expansions([(board, ParentRelationship(parent_id, 'g1f3'))]))
+                self.assertEqual(2, len(typing.cast(FakeEngine, uci_engines['one']).analyzed_fens))
+                child = database.get_child_positions(parent_id)['g1f3']
+                self.assertEqual(get_position_id(database, transposed_board.fen()), child.position_id)  # type: ignore
+                parent = typing.cast(Position, database.get_position(board.fen()))  # type: ignore
+                self.assertEqual(1, parent.expanded_count)
+
+    def test_add_engine__split__added_engine_analyzes_next_search(self):
+        uci_engines = fake_engines(one=0)
+        added = FakeEngine()
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                explorer.search(chess.Board())
+                explorer.add_engine('two', lambda: typing.cast(engine.SimpleEngine, added))
+                self.assertEqual(2, explorer.expansions_per_search())
+                explorer.search(chess.Board())
+                self.assertEqual(1, len(added.analyzed_fens))
+            self.assertTrue(added.closed)
+            with self.assertRaises(ValueError):
+                explorer.add_engine('one', FakeEngine)  # type: ignore
+
+    def test_remove_engine__closed_and_not_used(self):
+        uci_engines = fake_engines(one=0, two=0)
+        removed = typing.cast(FakeEngine, uci_engines['two'])
+        with db_wrapper.Database() as database:
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                explorer.remove_engine('two')
+                self.assertTrue(removed.closed)
+                explorer.search(chess.Board())
+                explorer.search(chess.Board())
+                self.assertEqual([], removed.analyzed_fens)
+                self.assertEqual(2, len(typing.cast(FakeEngine, uci_engines['one']).analyzed_fens))
+                with self.assertRaises(ValueError):
+                    explorer.remove_engine('two')
+
+
+def configured_option(uci_engine: engine.SimpleEngine, name: str) -> engine.ConfigValue:
+    """The value an option of a uci engine was last configured with."""
+    return typing.cast(engine.UciProtocol, uci_engine.protocol).config[name]
+
+
+class TestCheckSettings(unittest.TestCase):
+
+    def test_check_settings__default_engine_settings__only_engine_commands_fail(self):
+        settings = settings_loader.load_default_settings()
+        for command in ['dump', 'restore', 'stats', 'serve', 'merge']:
+            opex.check_settings(settings, command)
+        for command in opex.ENGINE_COMMANDS:
+            with self.subTest(command=command):
+                with self.assertRaises(ValueError):
+                    opex.check_settings(settings, command)
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_load_supervisor_policy__zero_timeout__no_timeout(self):
+        settings = settings_loader.parse_settings(settings_loader.merge_default_settings({'engine_timeout': 0}))
+        self.assertIsNone(opex.load_supervisor_policy(settings).timeout)
+
+    def test_merge_databases_prune_tree__sharded_database__refused_before_opening(self):
+        with tempfile.TemporaryDirectory() as directory:
+            settings = settings_loader.parse_settings(settings_loader.load_default_settings())._replace(
+                data_directory=directory, shard_count=2)
+            args = argparse.Namespace(
+                sources=[os.path.join(directory, 'other.db')],
+                batch_size=1,
+                fen=chess.STARTING_FEN,
+                window=0,
+                min_depth=0,
+                keep=[])
+            for command in [opex.merge_databases, opex.prune_tree]:
+                with self.subTest(command=command.__name__):
+                    with self.assertRaises(ValueError):
+                        command(settings, args)
+            self.assertEqual([], os.listdir(directory))
+
+
+class TestReloadSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_path = os.path.join(self.directory.name, 'opex-settings.json')
+        # A script which runs the mock engine, since the path of an engine is a single command
+        self.engine_path = os.path.join(self.directory.name, 'mock_engine')
+        with open(self.engine_path, 'w') as engine_file:
+            engine_file.write('#!/bin/sh\nexec ' + ' '.join(test_engines.MOCK_ENGINE_COMMAND) + '\n')
+        os.chmod(self.engine_path, os.stat(self.engine_path).st_mode | stat.S_IEXEC)
+        self.database = db_wrapper.Database()
+        self.uci_engines: Dict[str, engine.SimpleEngine] = {}
+        # The settings of the running explorer, loaded by start
+        self.settings = settings_loader.parse_settings(settings_loader.load_default_settings())
+        self.engine_settings: Dict[str, EngineSettings] = {}
+
+    def tearDown(self):
+        for uci_engine in self.uci_engines.values():
+            uci_engine.close()
+        self.database.close()
+        self.directory.cleanup()
+
+    def write_settings(self, nicknames: List[str]) -> None:
+        """Writes settings with a mock engine for each nickname."""
+        with open(self.settings_path, 'w') as settings_file:
+            json.dump(
+                {
+                    'engine_options_directory': os.path.join(self.directory.name, 'engines'),
+                    'engines': [{
+                        'nickname': nickname,
+                        'path': self.engine_path
+                    } for nickname in nicknames]
+                }, settings_file)
+
+    def write_options(self, nickname: str, lines: List[str]) -> None:
+        """Writes the options file of an engine."""
+        settings = opex.load_settings(self.settings_path)
+        with open(opex.engine_options_path_of(settings, nickname), 'w') as options_file:
+            options_file.writelines(f'{line}\n' for line in lines)
+
+    def start(self, nicknames: List[str]) -> opex.OpeningExplorer:
+        """Loads settings with a mock engine for each nickname and explores with them."""
+        self.write_settings(nicknames)
+        self.settings = opex.load_settings(self.settings_path)
+        self.engine_settings = opex.load_engine_settings(self.settings)
+        openers = {nickname: opex.engine_opener(settings) for nickname, settings in self.engine_settings.items()}
+        self.uci_engines = {nickname: open_engine() for nickname, open_engine in openers.items()}
+        return opex.OpeningExplorer(self.database, self.uci_engines, engine_reopeners=openers)
+
+    def reload(self, explorer: opex.OpeningExplorer) -> None:
+        """Reloads the settings into a running explorer."""
+        self.settings, self.engine_settings = opex.reload_settings(
+            explorer, self.settings, self.engine_settings, self.settings_path)
+
+    def test_apply_engine_settings__added_removed_and_configured(self):
+        with self.start(['one', 'two']) as explorer:
+            new_engine_settings = {
+                'one': EngineSettings('one', self.engine_path, {'Hash': 32}),
+                'three': EngineSettings('three', self.engine_path, {})
+            }
+            running = opex.apply_engine_settings(explorer, self.engine_settings, new_engine_settings)
+            self.assertEqual(new_engine_settings, running)
+            self.assertEqual(['one', 'three'], sorted(explorer.supervisors))
+            self.assertEqual(32, configured_option(explorer.supervisors['one'].uci_engine, 'Hash'))
+            self.assertEqual(['one', 'three'], sorted(explorer.uci_engines))
+            explorer.search(chess.Board())
+            explorer.search(chess.Board())
+            self.assertEqual(1, explorer.health()['three'].analyses)
+
+    def test_reload_settings__options_file_changed__engine_configured(self):
+        with self.start(['one']) as explorer:
+            uci_engine = explorer.uci_engines['one']
+            self.write_options('one', ['Threads=4', 'Hash=32'])
+            self.reload(explorer)
+            self.assertEqual({'Threads': 4, 'Hash': 32}, self.engine_settings['one'].options)
+            self.assertIs(uci_engine, explorer.supervisors['one'].uci_engine)
+            self.assertEqual(4, configured_option(uci_engine, 'Threads'))
+            self.assertEqual(32, configured_option(uci_engine, 'Hash'))
+            self.write_options('one', ['Threads=4'])
+            self.reload(explorer)
+            self.assertEqual(16, configured_option(uci_engine, 'Hash'))
+
+    def test_reload_settings__engine_added__analyzes_next_search(self):
+        with self.start(['one']) as explorer:
+            self.write_settings(['one', 'two'])
+            self.reload(explorer)
+            self.assertEqual(['one', 'two'], sorted(self.engine_settings))
+            explorer.search(chess.Board())
+            explorer.search(chess.Board())
+            self.assertEqual(1, explorer.health()['two'].analyses)
+
+    def test_reload_settings__invalid_options__previous_settings_kept(self):
+        with self.start(['one']) as explorer:
+            settings, engine_settings = self.settings, self.engine_settings
+            self.write_options('one', ['Threads=1000'])
+            self.reload(explorer)
+            self.assertIs(settings, self.settings)
+            self.assertIs(engine_settings, self.engine_settings)
+            self.write_settings([])
+            self.reload(explorer)
+            self.assertIs(engine_settings, self.engine_settings)
+            self.assertEqual(['one'], list(explorer.supervisors))
+
+    def test_watched_paths__settings_and_options_files(self):
+        self.write_settings(['one'])
+        settings = opex.load_settings(self.settings_path)
+        self.assertEqual(
+            [self.settings_path, 'opex-default-settings.json',
+             opex.engine_options_path_of(settings, 'one')], opex.watched_paths(settings, self.settings_path))
@@ -0,0 +1,54 @@
+"""Tests for prune."""
+
+import os
+import tempfile
+import unittest
+
+import chess
+
+from opex import db_wrapper
+from opex import prune
+from opex import query
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+
+
+class TestPrune(unittest.TestCase):
+
+    def test_line_moves__stops_at_first_missing_position(self):
+        with db_wrapper.Database() as database:
+            board = chess.Board()
+            root = database.insert_position(Position(None, board.fen(), 0, 20, ''), None)  # type: ignore
+            board.push_uci('e2e4')
+            e4_position = database.insert_position(
+                Position(None, board.fen(), 0, 20, ''),  # type: ignore
+                ParentRelationship(typing.cast(int, root.position_id), 'e2e4'))
+            self.assertEqual(
+                [
+                    ParentRelationship(typing.cast(int, root.position_id), 'e2e4'),
+                    ParentRelationship(typing.cast(int, e4_position.position_id), 'e7e5')
+                ], prune.line_moves(database, chess.STARTING_FEN, ['e2e4', 'e7e5', 'g1f3', 'b8c6']))
+
+    def test_prune_tree__space_reclaimed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            with db_wrapper.Database(path, checkpoint_interval=1000) as database:
+                board = chess.Board()
+                root = database.insert_position(
+                    Position(None, board.fen(), 0, 20, '').with_status(20, 0), None)  # type: ignore
+                root_id = typing.cast(int, root.position_id)
+                for index, move in enumerate(board.legal_moves):
+                    board.push(move)
+                    position = Position(None, board.fen(), 1000 * index, 20, 'x' * 10000)  # type: ignore
+                    board.pop()
+                    database.insert_position(position, ParentRelationship(root_id, move.uci()))
+                report = prune.prune_tree(database, path, keep_lines=[['g1f3']])
+                self.assertEqual(db_wrapper.PruneResult(18, 18), report.result)
+                self.assertLess(report.size_after, report.size_before)
+                self.assertIsNotNone(report.traversal_after)
+                self.assertEqual(['g1f3', 'g1h3'], sorted(database.get_child_positions(root_id)))
+                self.assertEqual(4, len(prune.format_prune_report(report)))
+                stats = query.get_tree_stats(database, root_id)
+                self.assertEqual((3, 2, 0.0), (stats.node_count, stats.edge_count, stats.transposition_rate))
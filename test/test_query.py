@@ -0,0 +1,96 @@
+"""Tests for query."""
+
+import unittest
+
+import chess
+
+from opex import db_wrapper
+from opex import query
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+
+
+def board_after(moves: str) -> chess.Board:
+    """The board after a space separated sequence of uci moves from the starting position."""
+    board = chess.Board()
+    for move in moves.split():
+        board.push_uci(move)
+    return board
+
+
+def get_position_id(database: db_wrapper.Database, moves: str) -> int:
+    return typing.cast(int, typing.cast(Position, database.get_position(board_after(moves).fen())).position_id)
+
+
+def add_position(database: db_wrapper.Database, moves: str, score: float) -> int:
+    """Inserts the position after a sequence of moves as a child of the position before the last move."""
+    board = board_after(moves)
+    position = Position(None, board.fen(), score, 20, '').with_status(board.legal_moves.count(), 0)
+    if not board.move_stack:
+        return typing.cast(int, database.insert_position(position, None).position_id)
+    move = board.pop()
+    relationship = ParentRelationship(get_position_id(database, ' '.join(moves.split()[:-1])), move.uci())
+    return typing.cast(int, database.insert_position(position, relationship).position_id)
+
+
+def build_tree(database: db_wrapper.Database) -> int:
+    """Builds a small tree with one transposition and returns the id of its root."""
+    root_id = add_position(database, '', 0)
+    add_position(database, 'e2e4', -30)
+    add_position(database, 'd2d4', -20)
+    add_position(database, 'g1f3', -10)
+    add_position(database, 'e2e4 e7e5', 25)
+    add_position(database, 'e2e4 c7c5', 40)
+    add_position(database, 'g1f3 e7e5', 5)
+    transposition_id = add_position(database, 'e2e4 e7e5 g1f3', -20)
+    database.insert_transposition(ParentRelationship(get_position_id(database, 'g1f3 e7e5'), 'e2e4'), transposition_id)
+    return root_id
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_get_tree_stats(self):
+        with db_wrapper.Database() as database:
+            stats = query.get_tree_stats(database, build_tree(database))
+            self.assertEqual(8, stats.node_count)
+            self.assertEqual(8, stats.edge_count)
+            self.assertEqual({0: 1, 1: 3, 2: 3, 3: 1}, stats.depth_histogram)
+            self.assertAlmostEqual(8 / 5, stats.branching_factor)
+            self.assertAlmostEqual(1 / 8, stats.transposition_rate)
+            self.assertEqual(0.0, stats.fully_expanded_ratio)
+
+    def test_get_tree_stats__leaf__only_the_root(self):
+        with db_wrapper.Database() as database:
+            build_tree(database)
+            stats = query.get_tree_stats(database, get_position_id(database, 'e2e4 e7e5 g1f3'))
+            self.assertEqual(query.TreeStats(1, 0, {0: 1}, 0.0, 0.0, 0.0), stats)
+
+    def test_get_tree_stats__fully_expanded_position(self):
+        with db_wrapper.Database() as database:
+            root_id = add_position(database, '', 0)
+            for move in chess.Board().legal_moves:
+                add_position(database, move.uci(), 0)
+            self.assertEqual(1 / 21, query.get_tree_stats(database, root_id).fully_expanded_ratio)
+
+    def test_get_principal_lines(self):
+        with db_wrapper.Database() as database:
+            root_id = build_tree(database)
+            self.assertEqual(
+                [query.PrincipalLine(['e2e4', 'e7e5', 'g1f3'], 30),
+                 query.PrincipalLine(['d2d4'], 20)], query.get_principal_lines(database, root_id, 2))
+
+    def test_get_principal_lines__max_length(self):
+        with db_wrapper.Database() as database:
+            root_id = build_tree(database)
+            self.assertEqual(
+                [query.PrincipalLine(['e2e4', 'e7e5'], 30)], query.get_principal_lines(database, root_id, 1, 2))
+
+    def test_format_tree_stats(self):
+        stats = query.TreeStats(3, 2, {0: 1, 1: 2}, 2.0, 0.0, 0.5)
+        output = query.format_tree_stats(stats, [query.PrincipalLine(['e2e4', 'e7e5'], 30)])
+        self.assertIn('Positions: 3', output)
+        self.assertIn('Fully expanded: 50.00%', output)
+        self.assertIn('    1: 2', output)
+        self.assertIn('      +30 e2e4 e7e5', output)
@@ -0,0 +1,152 @@
+"""Tests for query_server."""
+
+import asyncio
+import json
+import os
+import tempfile
+from test import test_distributed
+from test import test_memory_tree
+import unittest
+import urllib.parse
+
+import chess
+
+from opex import db_wrapper
+from opex import query_server
+from opex.analysis import Position
+
+import typing
+from typing import Any, Dict, List, Tuple
+
+
+class TestLruCache(unittest.TestCase):
+
+    def test_get_many__expired__missed(self):
+        clock = test_distributed.FakeClock()
+        cache = query_server.LruCache(10, 5.0, clock)
+        cache.put_many({'one': {'score': 1}, 'two': None})
+        clock.now = 4.0
+        self.assertEqual({'one': {'score': 1}, 'two': None}, cache.get_many(['one', 'two', 'three']))
+        clock.now = 5.0
+        self.assertEqual({}, cache.get_many(['one']))
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_put_many__over_capacity__least_recently_used_evicted(self):
+        cache = query_server.LruCache(2, 5.0, test_distributed.FakeClock())
+        cache.put_many({'one': None, 'two': None})
+        cache.get_many(['one'])
+        cache.put_many({'three': None})
+        self.assertEqual(['one', 'three'], sorted(cache.get_many(['one', 'two', 'three'])))
+        self.assertEqual(2, len(cache))
+
+
+class TestLookupPositions(unittest.TestCase):
+
+    def test_lookup_positions__moves_best_first_from_side_to_move(self):
+        with db_wrapper.Database() as database:
+            root = database.insert_position(Position(None, 'root', 5, 20, 'e2e4'), None)
+            root_id = typing.cast(int, root.position_id)
+            database.insert_position(Position(None, 'e4', -30, 18, ''), (root_id, 'e2e4'))
+            database.insert_position(Position(None, 'd4', 10, 16, ''), (root_id, 'd2d4'))
+            answers = query_server.lookup_positions(database, ['root', 'unknown', 'root'])
+        self.assertEqual(['root', 'unknown'], list(answers))
+        self.assertIsNone(answers['unknown'])
+        root_answer = typing.cast(Dict[str, Any], answers['root'])
+        self.assertEqual((5, 20, 'e2e4'), (root_answer['score'], root_answer['depth'], root_answer['pv']))
+        self.assertEqual(
+            [
+                {
+                    'move': 'e2e4',
+                    'fen': 'e4',
+                    'score': 30,
+                    'depth': 18
+                }, {
+                    'move': 'd2d4',
+                    'fen': 'd4',
+                    'score': -10,
+                    'depth': 16
+                }
+            ], root_answer['moves'])
+
+
+class TestQueryServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):  # pylint: disable=invalid-name
+        """Serves a tree one move deep from a pool of two connections, and connects a client."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'test.db')
+        self.database = db_wrapper.Database(path)
+        self.addCleanup(self.database.close)
+        self.ids = test_memory_tree.build_tree(self.database, 1)
+        self.lookups: List[List[str]] = []
+        self.pool = query_server.ConnectionPool(path, 2)
+        self.addCleanup(self.pool.close)
+
+        def lookup(fens: List[str]):
+            self.lookups.append(fens)
+            return self.pool.lookup(fens)
+
+        self.cache = query_server.LruCache(100, 60.0)
+        server = await asyncio.start_server(
+            query_server.QueryServer(lookup, self.cache).handle_connection, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.reader, self.writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        self.addCleanup(self.writer.close)
+
+    async def request(self, method: str, target: str, body: bytes = b'') -> Tuple[int, Any]:
+        """Sends a request on the connection and reads the status and json body of its response."""
+        self.writer.write(f'{method} {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        status = int((await self.reader.readline()).split()[1])
+        headers = await query_server.read_headers(self.reader)
+        return status, json.loads(await self.reader.readexactly(int(headers['content-length'])))
+
+    async def test_position__analyzed__children_and_evals(self):
+        status, answer = await self.request('GET', '/position?' + urllib.parse.urlencode({'fen': chess.STARTING_FEN}))
+        self.assertEqual(200, status)
+        self.assertEqual(chess.STARTING_FEN, answer['fen'])
+        self.assertEqual(20, len(answer['moves']))
+
+    async def test_position__same_position_again__answered_from_cache(self):
+        target = '/position?' + urllib.parse.urlencode({'fen': chess.STARTING_FEN})
+        first = await self.request('GET', target)
+        self.assertEqual(first, await self.request('GET', target))
+        self.assertEqual([[chess.STARTING_FEN]], self.lookups)
+        self.assertEqual(1, self.cache.hits)
+
+    async def test_position__not_analyzed__not_found(self):
+        status, answer = await self.request('GET', '/position?fen=unknown')
+        self.assertEqual(404, status)
+        self.assertIn('unknown', answer['error'])
+
+    async def test_positions__batch__one_lookup_in_request_order(self):
+        fens = [fen for fen in self.ids if fen != chess.STARTING_FEN][:5] + ['unknown']
+        status, answer = await self.request('POST', '/positions', json.dumps({'fens': fens}).encode())
+        self.assertEqual(200, status)
+        self.assertEqual(fens, list(answer['positions']))
+        self.assertIsNone(answer['positions']['unknown'])
+        self.assertEqual(1, len(self.lookups))
+
+    async def test_positions__bad_requests__errors_and_connection_kept(self):
+        self.assertEqual(400, (await self.request('POST', '/positions', b'{"fen": []}'))[0])
+        self.assertEqual(400, (await self.request('POST', '/positions', b'{"fens": [1]}'))[0])
+        too_many = json.dumps({'fens': ['fen'] * (query_server.MAX_BATCH_SIZE + 1)}).encode()
+        self.assertEqual(413, (await self.request('POST', '/positions', too_many))[0])
+        self.assertEqual(405, (await self.request('GET', '/positions'))[0])
+        self.assertEqual(404, (await self.request('GET', '/unknown'))[0])
+        self.assertEqual(400, (await self.request('GET', '/position'))[0])
+        status, stats = await self.request('GET', '/stats')
+        self.assertEqual(200, status)
+        self.assertEqual(7, stats['requests'])
+
+    async def test_position__written_after_start__seen_once_committed(self):
+        await self.request('GET', '/position?fen=new')
+        self.database.insert_position(Position(None, 'new', 0, 1, ''), None)
+        status, _ = await self.request('POST', '/positions', json.dumps({'fens': ['new', 'other']}).encode())
+        self.assertEqual(200, status)
+        # The cached answer for new has not expired yet
+        self.assertEqual([['new'], ['other']], self.lookups)
+        uncached = query_server.LruCache(100, 0.0)
+        answers = await query_server.QueryServer(self.pool.lookup, uncached).lookup(['new'])
+        self.assertIsNotNone(answers['new'])
@@ -0,0 +1,68 @@
+"""Tests for recompute."""
+
+import unittest
+
+import numpy as np
+
+from opex import db_wrapper
+from opex import recompute
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import Dict
+
+
+def build_dag(database: db_wrapper.Database) -> Dict[str, int]:
+    """Stores a root with two moves, a and b, which both lead to c by transposition. Only the root is partial.
+
+    Scores are relative to the side to move.
+    """
+    ids: Dict[str, int] = {}
+    for name, score, legal_move_count in [('root', 0, 3), ('a', 10, 1), ('b', -30, 1), ('c', 20, 0)]:
+        position = Position(None, name, score, 1, '').with_status(legal_move_count, 0)
+        ids[name] = typing.cast(int, database.insert_position(position, None).position_id)
+    for parent, move, child in [('root', 'a', 'a'), ('root', 'b', 'b'), ('a', 'c', 'c'), ('b', 'c', 'c')]:
+        database.insert_transposition(ParentRelationship(ids[parent], move), ids[child])
+    return ids
+
+
+def tree_scores(database: db_wrapper.Database) -> Dict[str, float]:
+    return {row['fen']: row['tree_score'] for row in database.query('SELECT fen, tree_score FROM openings')}
+
+
+class TestRecompute(unittest.TestCase):
+
+    def test_topological_levels__children_before_parents(self):
+        with db_wrapper.Database() as database:
+            ids = build_dag(database)
+            dag = recompute.read_dag(database)
+            levels = [set(dag.position_ids[level].tolist()) for level in recompute.topological_levels(dag)]
+            self.assertEqual([{ids['c']}, {ids['a'], ids['b']}, {ids['root']}], levels)
+
+    def test_recompute_tree_scores__minimax(self):
+        with db_wrapper.Database() as database:
+            build_dag(database)
+            self.assertEqual(4, recompute.recompute_tree_scores(database, 'minimax'))
+            # The root is not fully expanded, but its own score is worse than moving to a
+            self.assertEqual({'root': 20, 'a': -20, 'b': -20, 'c': 20}, tree_scores(database))
+
+    def test_recompute_tree_scores__expectation(self):
+        with db_wrapper.Database() as database:
+            build_dag(database)
+            recompute.recompute_tree_scores(database, 'expectation')
+            # The score of the root stands in for its third move
+            self.assertEqual({'root': 40 / 3, 'a': -20, 'b': -20, 'c': 20}, tree_scores(database))
+
+    def test_read_dag__edge_to_missing_position__left_out(self):
+        with db_wrapper.Database() as database:
+            root_id = typing.cast(int, database.insert_position(Position(None, 'root', 0, 1, ''), None).position_id)
+            database.insert_transposition(ParentRelationship(root_id, 'e2e4'), root_id + 1)
+            dag = recompute.read_dag(database)
+            self.assertEqual(0, len(dag.parents))
+            np.testing.assert_array_equal([0], recompute.backup_scores(dag))
+
+    def test_backup_scores__unknown_policy__raises(self):
+        with db_wrapper.Database() as database:
+            with self.assertRaises(ValueError):
+                recompute.backup_scores(recompute.read_dag(database), 'unknown')
@@ -0,0 +1,148 @@
+"""Tests for search."""
+
+import unittest
+
+import chess
+
+from opex import db_wrapper
+from opex import memory_tree
+from opex import search
+from opex.analysis import EngineAnalysis
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+from opex.analysis import STAGE_DEEPEN
+
+import typing
+from typing import List
+
+
+def analyses(score: float, pv: str = '') -> List[EngineAnalysis]:
+    return [EngineAnalysis('one', score, 20, pv)]
+
+
+def store_child(tree_search: search.TreeSearch, parent: Position, move: str, score: float) -> Position:
+    """Stores the analysis of a move from a stored position."""
+    board = chess.Board(parent.fen)
+    board.push_uci(move)
+    relationship = ParentRelationship(typing.cast(int, parent.position_id), move)
+    return tree_search.store_analysis(search.Expansion(board, relationship, 20), analyses(score))
+
+
+class TestSearch(unittest.TestCase):
+
+    def test_expansion_priority(self):
+        self.assertGreater(search.expansion_priority(0, 0, False), search.expansion_priority(1, 0, False))
+        self.assertGreater(search.expansion_priority(1, 0, False), search.expansion_priority(1, 10, False))
+        self.assertGreater(search.expansion_priority(1, 0, True), search.expansion_priority(1, 0, False))
+
+    def test_store_analysis__root__legal_moves_are_queued(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database)
+            tree_search.store_analysis(search.Expansion(chess.Board(), None, 20), analyses(0, 'd2d4 d7d5'))
+            entries = database.claim_pending_expansions(100)
+            self.assertEqual(20, len(entries))
+            # The first move of the pv has the highest priority
+            self.assertEqual('d2d4', entries[0].move)
+
+    def test_store_analysis__worse_sibling__moves_queued_behind_best_sibling(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database)
+            root = tree_search.store_analysis(search.Expansion(chess.Board(), None, 20), analyses(0))
+            # Scores are relative to black, so e2e4 is better for white
+            best = store_child(tree_search, root, 'e2e4', -30)
+            worse = store_child(tree_search, root, 'a2a4', 40)
+            parent_ids = [entry.parent_id for entry in database.claim_pending_expansions(100)]
+            self.assertLess(
+                max(index for index, parent_id in enumerate(parent_ids) if parent_id == best.position_id),
+                min(index for index, parent_id in enumerate(parent_ids) if parent_id == worse.position_id))
+
+    def test_select_expansions__stored_root__boards_rebuilt_from_frontier(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database)
+            root = tree_search.store_analysis(search.Expansion(chess.Board(), None, 20), analyses(0, 'e2e4'))
+            expansions = tree_search.select_expansions(chess.Board(), 3)
+            self.assertEqual(3, len(expansions))
+            self.assertEqual(ParentRelationship(root.position_id, 'e2e4'), expansions[0].relationship)
+            expected_board = chess.Board()
+            expected_board.push_uci('e2e4')
+            self.assertEqual(expected_board.fen(), expansions[0].board.fen())  # type: ignore
+            self.assertEqual(1, typing.cast(Position, database.get_position(root.fen)).visits)
+            # Selected expansions are in flight and are not selected again
+            self.assertEqual(17, len(tree_search.select_expansions(chess.Board(), 100)))
+            self.assertEqual([], tree_search.select_expansions(chess.Board(), 1))
+
+    def test_select_expansions__terminal_root__inserted_without_expansions(self):
+        board = chess.Board('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')
+        with db_wrapper.Database() as database:
+            self.assertEqual([], search.TreeSearch(database).select_expansions(board, 1))
+            self.assertIsNotNone(database.get_position(board.fen()))  # type: ignore
+
+    def test_store_analysis__position_stored_meanwhile__linked_as_transposition(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database)
+            root = tree_search.store_analysis(search.Expansion(chess.Board(), None, 20), analyses(0))
+            first = store_child(tree_search, store_child(tree_search, root, 'g1f3', 0), 'g8f6', 0)
+            second = store_child(tree_search, store_child(tree_search, root, 'b1c3', 0), 'g8f6', 0)
+            transposition = store_child(tree_search, first, 'b1c3', 0)
+            self.assertEqual(transposition, store_child(tree_search, second, 'g1f3', 0))
+            children = database.get_child_positions(typing.cast(int, second.position_id))
+            self.assertEqual(transposition.position_id, children['g1f3'].position_id)
+
+    def test_select_expansions__screen__new_positions_analyzed_shallow(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database, analysis_depth=20, screen=search.Screen(8, 50, 1))
+            root_expansion = tree_search.select_expansions(chess.Board(), 1)[0]
+            self.assertEqual(20, root_expansion.depth)
+            tree_search.store_analysis(root_expansion, analyses(0))
+            expansions = tree_search.select_expansions(chess.Board(), 100)
+            self.assertEqual(20, len(expansions))
+            self.assertEqual({8}, {expansion.depth for expansion in expansions})
+
+    def test_store_analysis__screen__moves_passing_screen_deepened_first(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database, analysis_depth=20, screen=search.Screen(8, 50, 2))
+            tree_search.store_analysis(tree_search.select_expansions(chess.Board(), 1)[0], analyses(0))
+            # Scores are relative to black, the best move for white has the lowest score
+            scores = {'e2e4': -40, 'd2d4': -20, 'c2c4': 30, 'g1f3': 100}
+            for expansion in tree_search.select_expansions(chess.Board(), 100):
+                move = typing.cast(ParentRelationship, expansion.relationship).move
+                score = scores.get(move, 500)
+                self.assertEqual([], database.claim_pending_expansions(1))
+                tree_search.store_analysis(expansion, [EngineAnalysis('one', score, 8, '')])
+            # The screen is done once every move has been analyzed shallow
+            entries = database.claim_pending_expansions(100)
+            self.assertEqual({STAGE_DEEPEN}, {entry.stage for entry in entries})
+            self.assertEqual(20, len(entries))
+            # The top 2 and the moves within the window come first, the rest follow
+            self.assertEqual(['e2e4', 'd2d4', 'c2c4', 'g1f3'], [entry.move for entry in entries[:4]])
+
+    def test_requeue__move_given_up__siblings_passing_screen_deepened(self):
+        for database_type in [db_wrapper.Database, memory_tree.MemoryTree]:
+            with self.subTest(database_type=database_type.__name__), database_type() as database:
+                tree_search = search.TreeSearch(database, analysis_depth=20, screen=search.Screen(8, 50, 1))
+                tree_search.store_analysis(tree_search.select_expansions(chess.Board(), 1)[0], analyses(0))
+                (*expansions, failing) = tree_search.select_expansions(chess.Board(), 100)
+                for expansion in expansions:
+                    tree_search.store_analysis(expansion, [EngineAnalysis('one', 0, 8, '')])
+                self.assertEqual(
+                    [False] * (db_wrapper.MAX_EXPANSION_ATTEMPTS - 1) + [True],
+                    [tree_search.requeue(failing) for _ in range(db_wrapper.MAX_EXPANSION_ATTEMPTS)])
+                entries = database.claim_pending_expansions(100)
+                self.assertEqual([STAGE_DEEPEN] * 19, [entry.stage for entry in entries])
+
+    def test_store_analysis__deepen__analysis_replaced_and_moves_queued(self):
+        with db_wrapper.Database() as database:
+            tree_search = search.TreeSearch(database, analysis_depth=20, screen=search.Screen(8, 50, 1))
+            tree_search.store_analysis(tree_search.select_expansions(chess.Board(), 1)[0], analyses(0))
+            for expansion in tree_search.select_expansions(chess.Board(), 100):
+                tree_search.store_analysis(expansion, [EngineAnalysis('one', 0, 8, '')])
+            deepen = tree_search.select_expansions(chess.Board(), 1)[0]
+            self.assertEqual((20, STAGE_DEEPEN), (deepen.depth, deepen.stage))
+            position = tree_search.store_analysis(deepen, [EngineAnalysis('one', 15, 20, '')])
+            self.assertEqual(position, database.get_position(position.fen))
+            self.assertEqual((15, 20), (position.score, position.depth))
+            position_id = typing.cast(int, position.position_id)
+            self.assertEqual(
+                [8, 20], [engine_analysis.depth for engine_analysis in database.get_engine_analyses(position_id)])
+            entries = database.claim_pending_expansions(100)
+            self.assertEqual(20, len([entry for entry in entries if entry.parent_id == position_id]))
@@ -60,7 +60,25 @@ class TestSettingsLoader(unittest.TestCase):
     def test_default_settings__has_expected_keys(self):
         settings = settings_loader.load_default_settings()
         self.assertTrue('data_directory' in settings)
+        self.assertTrue('database_file_name' in settings)
+        self.assertTrue('checkpoint_interval' in settings)
         self.assertTrue('engine_options_directory' in settings)
+        self.assertTrue('engine_mode' in settings)
+        self.assertTrue('reconciliation_policy' in settings)
+        self.assertTrue('analysis_depth' in settings)
+        self.assertTrue('screen_depth' in settings)
+        self.assertTrue('screen_window' in settings)
+        self.assertTrue('screen_top_k' in settings)
+        self.assertTrue('shard_count' in settings)
+        self.assertTrue('tree_backend' in settings)
+        self.assertTrue('analysis_mode' in settings)
+        self.assertTrue('early_stop_min_depth' in settings)
+        self.assertTrue('early_stop_stable_depths' in settings)
+        self.assertTrue('early_stop_tolerance' in settings)
+        self.assertTrue('early_stop_decisive_score' in settings)
+        self.assertTrue('engine_timeout' in settings)
+        self.assertTrue('engine_max_attempts' in settings)
+        self.assertTrue('engine_restart_backoff' in settings)
         self.assertTrue('engines' in settings)
         self.assertEqual(1, len(engine_settings(settings)))
         self.assertTrue('nickname' in engine_settings(settings)[0])
@@ -74,15 +92,51 @@ class TestSettingsLoader(unittest.TestCase):
     def test_load_settings__use_defaults_false__empty_file__loads_default_keys(self):
         with tempfile.NamedTemporaryFile() as settings_file:
             default_settings = settings_loader.load_default_settings()
+            default_settings['analysis_depth'] = ''
+            default_settings['analysis_mode'] = ''
+            default_settings['checkpoint_interval'] = ''
             default_settings['data_directory'] = ''
+            default_settings['early_stop_decisive_score'] = ''
+            default_settings['early_stop_min_depth'] = ''
+            default_settings['early_stop_stable_depths'] = ''
+            default_settings['early_stop_tolerance'] = ''
+            default_settings['database_file_name'] = ''
+            default_settings['engine_max_attempts'] = ''
+            default_settings['engine_mode'] = ''
             default_settings['engine_options_directory'] = ''
+            default_settings['engine_restart_backoff'] = ''
+            default_settings['engine_timeout'] = ''
+            default_settings['reconciliation_policy'] = ''
+            default_settings['screen_depth'] = ''
+            default_settings['screen_top_k'] = ''
+            default_settings['screen_window'] = ''
+            default_settings['shard_count'] = ''
+            default_settings['tree_backend'] = ''
             self.assertEqual(default_settings, settings_loader.load_settings(settings_file, False))
 
     def test_load_settings__use_defaults_false__after_save__loads_default_keys(self):
         with tempfile.NamedTemporaryFile(mode='r+') as settings_file:
             default_settings = settings_loader.load_default_settings()
+            default_settings['analysis_depth'] = ''
+            default_settings['analysis_mode'] = ''
+            default_settings['checkpoint_interval'] = ''
             default_settings['data_directory'] = ''
+            default_settings['early_stop_decisive_score'] = ''
+            default_settings['early_stop_min_depth'] = ''
+            default_settings['early_stop_stable_depths'] = ''
+            default_settings['early_stop_tolerance'] = ''
+            default_settings['database_file_name'] = ''
+            default_settings['engine_max_attempts'] = ''
+            default_settings['engine_mode'] = ''
             default_settings['engine_options_directory'] = ''
+            default_settings['engine_restart_backoff'] = ''
+            default_settings['engine_timeout'] = ''
+            default_settings['reconciliation_policy'] = ''
+            default_settings['screen_depth'] = ''
+            default_settings['screen_top_k'] = ''
+            default_settings['screen_window'] = ''
+            default_settings['shard_count'] = ''
+            default_settings['tree_backend'] = ''
             settings = settings_loader.load_settings(settings_file, False)
             json.dump(settings, settings_file)
             settings_file.seek(0)
@@ -178,6 +232,140 @@ class TestSettingsLoader(unittest.TestCase):
                 ])
         self.assertTrue('\'nickname\' not unique [\'test1\', \'test3\']' in str(error.exception))
 
+    def test_parse_settings__defaults__every_setting_typed(self):
+        default_settings = settings_loader.load_default_settings()
+        settings = settings_loader.parse_settings(default_settings)
+        self.assertEqual(sorted(default_settings), sorted(settings_loader.Settings._fields))
+        self.assertEqual(
+            (20, 'split', 'sqlite'), (settings.analysis_depth, settings.engine_mode, settings.tree_backend))
+
+    def test_check_ensemble_settings__defaults(self):
+        self.assertIsNone(settings_loader.check_ensemble_settings(settings_loader.load_default_settings()))
+
+    def test_check_ensemble_settings__unknown_engine_mode(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['engine_mode'] = 'unknown'
+            settings_loader.check_ensemble_settings(settings)
+        self.assertTrue('Unknown engine mode \'unknown\'' in str(error.exception))
+
+    def test_check_ensemble_settings__unknown_reconciliation_policy(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['reconciliation_policy'] = 'unknown'
+            settings_loader.check_ensemble_settings(settings)
+        self.assertTrue('Unknown reconciliation policy \'unknown\'' in str(error.exception))
+
+    def test_check_analysis_settings__defaults(self):
+        self.assertIsNone(settings_loader.check_analysis_settings(settings_loader.load_default_settings()))
+
+    def test_check_analysis_settings__unknown_analysis_mode(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['analysis_mode'] = 'unknown'
+            settings_loader.check_analysis_settings(settings)
+        self.assertTrue('Unknown analysis mode \'unknown\'' in str(error.exception))
+
+    def test_check_analysis_settings__depth_not_an_integer(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['screen_depth'] = 'deep'
+            settings_loader.check_analysis_settings(settings)
+        self.assertTrue('\'screen_depth\' must be a positive integer' in str(error.exception))
+
+    def test_check_analysis_settings__early_stop_not_above_screen(self):
+        settings = settings_loader.load_default_settings()
+        settings['early_stop_min_depth'] = settings['screen_depth']
+        with self.assertRaises(ValueError) as error:
+            settings_loader.check_analysis_settings(settings)
+        self.assertTrue('\'early_stop_min_depth\' must be above \'screen_depth\'' in str(error.exception))
+        # Without early stopping or without a screen the minimum depth does not matter
+        settings['analysis_mode'] = 'fixed_depth'
+        self.assertIsNone(settings_loader.check_analysis_settings(settings))
+        settings['analysis_mode'] = 'early_stop'
+        settings['screen_depth'] = settings['analysis_depth']
+        self.assertIsNone(settings_loader.check_analysis_settings(settings))
+
+    def test_check_analysis_settings__no_stable_depths(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['early_stop_stable_depths'] = 0
+            settings_loader.check_analysis_settings(settings)
+        self.assertTrue('\'early_stop_stable_depths\' must be a positive integer' in str(error.exception))
+
+    def test_check_analysis_settings__negative_or_not_a_number_score(self):
+        for key, value in [('early_stop_tolerance', -1), ('early_stop_decisive_score', 'high')]:
+            with self.subTest(key=key):
+                with self.assertRaises(ValueError) as error:
+                    settings = settings_loader.load_default_settings()
+                    settings[key] = value
+                    settings_loader.check_analysis_settings(settings)
+                self.assertTrue(f'\'{key}\' must be a number of centipawns' in str(error.exception))
+
+    def test_check_analysis_settings__screen_negative_or_not_an_integer(self):
+        for key, value in [('screen_top_k', -1), ('screen_window', 12.5), ('screen_window', True)]:
+            with self.subTest(key=key, value=value):
+                with self.assertRaises(ValueError) as error:
+                    settings = settings_loader.load_default_settings()
+                    settings[key] = value
+                    settings_loader.check_analysis_settings(settings)
+                self.assertTrue(f'\'{key}\' must be an integer which is not negative' in str(error.exception))
+
+    def test_check_analysis_settings__screen_zero__merged_and_valid(self):
+        settings = settings_loader.merge_default_settings({'screen_top_k': 0, 'screen_window': 0})
+        self.assertEqual((0, 0), (settings['screen_top_k'], settings['screen_window']))
+        self.assertIsNone(settings_loader.check_analysis_settings(settings))
+
+    def test_check_database_settings__defaults(self):
+        self.assertIsNone(settings_loader.check_database_settings(settings_loader.load_default_settings()))
+
+    def test_check_database_settings__unknown_tree_backend(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['tree_backend'] = 'unknown'
+            settings_loader.check_database_settings(settings)
+        self.assertTrue('Unknown tree backend \'unknown\'' in str(error.exception))
+
+    def test_check_database_settings__shard_count_not_positive(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['shard_count'] = 0
+            settings_loader.check_database_settings(settings)
+        self.assertTrue('\'shard_count\' must be a positive integer' in str(error.exception))
+
+    def test_check_database_settings__checkpoint_interval_not_positive(self):
+        for value in [0, -1]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError) as error:
+                    settings = settings_loader.merge_default_settings({'checkpoint_interval': value})
+                    settings_loader.check_database_settings(settings)
+                self.assertTrue('\'checkpoint_interval\' must be a positive integer' in str(error.exception))
+
+    def test_check_database_settings__memory_backend_with_shards(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['shard_count'] = 4
+            settings['tree_backend'] = 'memory'
+            settings_loader.check_database_settings(settings)
+        self.assertTrue('more than one shard' in str(error.exception))
+
+    def test_check_supervisor_settings__defaults(self):
+        self.assertIsNone(settings_loader.check_supervisor_settings(settings_loader.load_default_settings()))
+
+    def test_check_supervisor_settings__negative_timeout(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['engine_timeout'] = -1
+            settings_loader.check_supervisor_settings(settings)
+        self.assertTrue('\'engine_timeout\' must be a number of seconds' in str(error.exception))
+
+    def test_check_supervisor_settings__no_attempts(self):
+        with self.assertRaises(ValueError) as error:
+            settings = settings_loader.load_default_settings()
+            settings['engine_max_attempts'] = 0
+            settings_loader.check_supervisor_settings(settings)
+        self.assertTrue('\'engine_max_attempts\' must be a positive integer' in str(error.exception))
+
     def test_load_engine_options__empty_file__loads_empty_options(self):
         with tempfile.NamedTemporaryFile() as options_file:
             options = settings_loader.load_engine_options(TEST_ENGINE_OPTIONS, options_file)
@@ -427,3 +615,37 @@ class TestSettingsLoader(unittest.TestCase):
             options['unknown2'] = ''
             settings_loader.check_engine_options(TEST_ENGINE_OPTIONS, options)
         self.assertTrue('Unknown options [\'unknown1\', \'unknown2\']' in str(error.exception))
+
+    def test_load_default_settings__modified__does_not_change_cached_settings(self):
+        settings = settings_loader.load_default_settings()
+        settings['analysis_depth'] = -1
+        typing.cast(List[Json], settings['engines']).append({})
+        default_settings = settings_loader.load_default_settings()
+        self.assertEqual(20, default_settings['analysis_depth'])
+        self.assertEqual(1, len(engine_settings(default_settings)))
+
+    def test_merge_default_settings__user_settings_unchanged(self):
+        user_settings: Json = {'analysis_depth': 30}
+        settings = settings_loader.merge_default_settings(user_settings)
+        self.assertEqual({'analysis_depth': 30}, user_settings)
+        self.assertEqual(30, settings['analysis_depth'])
+        self.assertEqual(settings_loader.load_default_settings().keys(), settings.keys())
+
+    def test_merge_default_settings__zero_and_none__zero_kept_and_none_defaulted(self):
+        settings = settings_loader.merge_default_settings({'engine_timeout': 0, 'engine_restart_backoff': None})
+        self.assertEqual(0, settings['engine_timeout'])
+        self.assertEqual(1, settings['engine_restart_backoff'])
+
+    def test_changed_engine_options__changed_and_removed_options(self):
+        old_options: engine.ConfigMapping = {'spin': 10, 'combo': 'two', 'check_true': False}
+        new_options: engine.ConfigMapping = {'spin': 20, 'check_true': False, 'string_something': 'else'}
+        self.assertEqual(
+            {
+                'string_something': 'else',
+                'spin': 20,
+                'combo': 'one'
+            }, settings_loader.changed_engine_options(TEST_ENGINE_OPTIONS, old_options, new_options))
+
+    def test_changed_engine_options__same_options__empty(self):
+        options: engine.ConfigMapping = {'spin': 10}
+        self.assertEqual({}, settings_loader.changed_engine_options(TEST_ENGINE_OPTIONS, options, dict(options)))
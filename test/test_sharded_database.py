@@ -0,0 +1,135 @@
+"""Tests for sharded_database."""
+
+import os
+import sqlite3
+import tempfile
+from test import test_memory_tree
+from test import test_opex
+import unittest
+
+import chess
+
+from opex import db_wrapper
+from opex import memory_tree
+from opex import opex
+from opex import query
+from opex import recompute
+from opex import sharded_database
+from opex.analysis import EngineAnalysis
+from opex.analysis import FrontierEntry
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import List, Set, Tuple
+
+
+def tree_without_ids(database: db_wrapper.Database) -> List[Set[Tuple[str, float, int, str, int, int, int, int]]]:
+    """The positions of each level below the start, without their ids which differ between backends."""
+    root_id = test_opex.get_position_id(database, chess.STARTING_FEN)
+    return [{position[1:] for position in level.values()} for level in database.get_subtree_levels(root_id)]
+
+
+class TestShardedDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shard_paths(self):
+        self.assertEqual(
+            ['data/opex-1-of-2.db', 'data/opex-2-of-2.db'], sharded_database.shard_paths('data/opex.db', 2))
+
+    def test_init__too_many_shards__raises(self):
+        with self.assertRaises(ValueError):
+            sharded_database.ShardedDatabase(self.path, sharded_database.MAX_SHARD_COUNT + 1)
+
+    def test_insert_position__stored_on_shard_of_fen_with_edge_on_shard_of_parent(self):
+        with sharded_database.ShardedDatabase(self.path, 3) as database:
+            ids = test_memory_tree.build_tree(database, 1)
+        for index, shard_path in enumerate(sharded_database.shard_paths(self.path, 3)):
+            with db_wrapper.Database(shard_path) as shard:
+                for row in shard.query('SELECT id, fen FROM openings'):
+                    self.assertEqual(ids[row['fen']], row['id'])
+                    self.assertEqual(index, row['id'] % 3)
+                    self.assertEqual(index, memory_tree.fen_key(row['fen']) % 3)
+                parent_ids = {row['parent_id'] for row in shard.query('SELECT parent_id FROM game_dag')}
+                self.assertEqual(
+                    {ids[chess.STARTING_FEN]} if index == ids[chess.STARTING_FEN] % 3 else set(), parent_ids)
+
+    def test_get_child_positions__children_on_other_shards(self):
+        engine_analysis = EngineAnalysis('one', 10, 20, 'e7e5')
+        with sharded_database.ShardedDatabase(self.path, 4) as database:
+            ids = test_memory_tree.build_tree(database, 2)
+            root_id = ids[chess.STARTING_FEN]
+            children = database.get_child_positions(root_id)
+            self.assertEqual(20, len(children))
+            board = chess.Board()
+            board.push_uci('e2e4')
+            self.assertEqual(children['e2e4'], database.get_position(board.fen()))  # type: ignore
+            e4_position = children['e2e4']
+            database.deepen_position(
+                Position(e4_position.position_id, e4_position.fen, 10, 20, 'e7e5'), None, [engine_analysis])
+            self.assertEqual(10, database.get_child_positions(root_id)['e2e4'].score)
+            self.assertEqual([engine_analysis], database.get_engine_analyses(typing.cast(int, e4_position.position_id)))
+            self.assertEqual(len(ids) - 1, sum(len(level) for level in database.get_subtree_levels(root_id)))
+
+    def test_init__reopened__ids_continue(self):
+        with sharded_database.ShardedDatabase(self.path, 2) as database:
+            first = database.insert_position(Position(None, 'first', 0, 1, ''), None)
+        with sharded_database.ShardedDatabase(self.path, 2) as database:
+            self.assertEqual(first, database.get_position('first'))
+            ids = {
+                typing.cast(int,
+                            database.insert_position(Position(None, str(n), 0, 1, ''), None).position_id)
+                for n in range(10)
+            }
+            self.assertNotIn(first.position_id, ids)
+            self.assertEqual(10, len(ids))
+
+    def test_insert_position__duplicate_fen__raised_by_next_read(self):
+        with sharded_database.ShardedDatabase(self.path, 2) as database:
+            database.insert_position(Position(None, 'fen', 0, 1, ''), None)
+            database.insert_position(Position(None, 'fen', 0, 1, ''), None)
+            with self.assertRaises(sqlite3.IntegrityError):
+                database.get_position('fen')
+            self.assertIsNotNone(database.get_position('fen'))
+
+    def test_claim_pending_expansions__highest_priority_across_shards(self):
+        with sharded_database.ShardedDatabase(self.path, 3) as database:
+            parents = [database.insert_position(Position(None, str(n), 0, 1, ''), None) for n in range(3)]
+            database.enqueue_expansions(
+                (ParentRelationship(typing.cast(int, parent.position_id), 'e2e4'), priority)
+                for parent, priority in zip(parents, [1, 3, 2]))
+            self.assertEqual(
+                [
+                    FrontierEntry(typing.cast(int, parents[1].position_id), 'e2e4', '1'),
+                    FrontierEntry(typing.cast(int, parents[2].position_id), 'e2e4', '2')
+                ], database.claim_pending_expansions(2))
+            self.assertEqual(2, database.requeue_in_flight())
+
+    def test_query__over_every_shard(self):
+        with sharded_database.ShardedDatabase(self.path, 4) as database:
+            ids = test_memory_tree.build_tree(database, 2)
+            stats = query.get_tree_stats(database, ids[chess.STARTING_FEN])
+            self.assertEqual(len(ids), stats.node_count)
+            self.assertEqual(len(ids), recompute.recompute_tree_scores(database))
+            tree_scores = database.query('SELECT count() AS count FROM openings WHERE tree_score IS NOT NULL')
+            self.assertEqual(len(ids), tree_scores.fetchone()['count'])
+
+    def test_merge__raises(self):
+        with sharded_database.ShardedDatabase(self.path, 2) as database:
+            with self.assertRaises(ValueError):
+                database.merge(self.path)
+
+    def test_search__same_tree_as_sqlite(self):
+        trees: List[List[Set[Tuple[str, float, int, str, int, int, int, int]]]] = []
+        for database in [db_wrapper.Database(), sharded_database.ShardedDatabase(self.path, 3)]:
+            with database, opex.OpeningExplorer(database, test_opex.fake_engines(one=10, two=20)) as explorer:
+                for _ in range(10):
+                    explorer.search(chess.Board())
+                trees.append(tree_without_ids(database))
+        self.assertEqual(trees[0], trees[1])
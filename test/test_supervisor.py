@@ -0,0 +1,114 @@
+"""Tests for supervisor."""
+
+import os
+import tempfile
+from test import test_engines
+from test import test_opex
+import unittest
+
+import chess
+from chess import engine
+
+from opex import db_wrapper
+from opex import opex
+from opex import supervisor
+from opex.analysis import FrontierEntry
+from opex.analysis import ParentRelationship
+from opex.analysis import Position
+
+import typing
+from typing import Dict, List
+
+
+class CrashingEngine:
+    """Fails every analysis as if the engine process had died."""
+
+    @staticmethod
+    def analyse(board: chess.Board, limit: engine.Limit) -> Dict[str, object]:
+        raise engine.EngineTerminatedError('engine process died unexpectedly')
+
+    def close(self) -> None:
+        pass
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.failures_path = os.path.join(self.directory.name, 'failures')
+        self.sleeps: List[float] = []
+        self.engines: List[engine.SimpleEngine] = []
+
+    def tearDown(self):
+        for uci_engine in self.engines:
+            uci_engine.close()
+        self.directory.cleanup()
+
+    def open_failing_engine(self, kind: str) -> engine.SimpleEngine:
+        """Opens a mock engine which fails while there are failures left in the failures file."""
+        uci_engine = engine.SimpleEngine.popen_uci(test_engines.MOCK_ENGINE_COMMAND + [kind, self.failures_path])
+        self.engines.append(uci_engine)
+        return uci_engine
+
+    def supervise(
+            self, kind: str, failure_count: int, policy: supervisor.SupervisorPolicy) -> supervisor.EngineSupervisor:
+        """Supervises a mock engine which fails failure_count times, and is restarted as the same kind of engine."""
+        with open(self.failures_path, 'w') as failures_file:
+            failures_file.write(str(failure_count))
+        return supervisor.EngineSupervisor(
+            'mock', self.open_failing_engine(kind), lambda: self.open_failing_engine(kind),
+            policy._replace(sleep=self.sleeps.append))
+
+    def test_analyze_board__crash__restarted_and_analyzed(self):
+        engine_supervisor = self.supervise('crash', 1, supervisor.SupervisorPolicy(backoff=0.5))
+        engine_analysis = engine_supervisor.analyze_board(chess.Board(), 10)
+        self.assertEqual(10, engine_analysis.depth)
+        self.assertEqual([0.5], self.sleeps)
+        health = engine_supervisor.health()
+        self.assertEqual((1, 0, 1, 1), (health.analyses, health.timeouts, health.crashes, health.restarts))
+        engine_supervisor.close()
+
+    def test_analyze_board__stall__timed_out_and_restarted(self):
+        engine_supervisor = self.supervise('stall', 1, supervisor.SupervisorPolicy(timeout=1.0))
+        self.assertEqual(10, engine_supervisor.analyze_board(chess.Board(), 10).depth)
+        health = engine_supervisor.health()
+        self.assertEqual((1, 1, 0, 1), (health.analyses, health.timeouts, health.crashes, health.restarts))
+        engine_supervisor.close()
+
+    def test_analyze_board__every_attempt_fails__raises_after_backoff(self):
+        engine_supervisor = self.supervise('crash', 5, supervisor.SupervisorPolicy(max_attempts=4, max_backoff=3))
+        with self.assertRaises(supervisor.EngineFailure):
+            engine_supervisor.analyze_board(chess.Board(), 10)
+        self.assertEqual([1, 2, 3], self.sleeps)
+        # The next analysis restarts the engine first, and the last failure is followed by a success
+        self.assertEqual(10, engine_supervisor.analyze_board(chess.Board(), 10).depth)
+        self.assertEqual([1, 2, 3, 3, 3], self.sleeps)
+        engine_supervisor.analyze_board(chess.Board(), 10)
+        self.assertEqual(5, len(self.sleeps))
+        engine_supervisor.close()
+
+    def test_analyze_board__cannot_reopen__raises(self):
+        engine_supervisor = supervisor.EngineSupervisor('crash', typing.cast(engine.SimpleEngine, CrashingEngine()))
+        with self.assertRaises(supervisor.EngineFailure):
+            engine_supervisor.analyze_board(chess.Board(), 10)
+        self.assertEqual(1, engine_supervisor.health().crashes)
+
+    def test_configure__failed_engine__restarted_with_new_reopen(self):
+        engine_supervisor = supervisor.EngineSupervisor('crash', typing.cast(engine.SimpleEngine, CrashingEngine()))
+        with self.assertRaises(supervisor.EngineFailure):
+            engine_supervisor.analyze_board(chess.Board(), 10)
+        engine_supervisor.configure({'Hash': 32}, lambda: test_opex.fake_engines(one=0)['one'])
+        self.assertEqual(10, engine_supervisor.analyze_board(chess.Board(), 10).depth)
+        self.assertEqual(1, engine_supervisor.health().restarts)
+
+    def test_search__engine_fails__expansion_requeued(self):
+        with db_wrapper.Database() as database:
+            root = database.insert_position(Position(None, chess.STARTING_FEN, 0, 20, '').with_status(20, 0), None)
+            root_id = typing.cast(int, root.position_id)
+            database.enqueue_expansions([(ParentRelationship(root_id, 'e2e4'), 0)])
+            uci_engines = {'crash': typing.cast(engine.SimpleEngine, CrashingEngine())}
+            with opex.OpeningExplorer(database, uci_engines) as explorer:
+                explorer.search(chess.Board())
+                self.assertEqual({}, database.get_child_positions(root_id))
+                self.assertEqual(1, explorer.health()['crash'].crashes)
+            self.assertEqual([FrontierEntry(root_id, 'e2e4', chess.STARTING_FEN)], database.claim_pending_expansions(1))